@@ -9,13 +9,24 @@ sleep 2
 # Define the project directory on the remote hosts
 REMOTE_PROJECT_DIR="~/projects/mac-mini-connect"
 
+# The harness to run: test_sharding (default) or test_modes
+TEST_MODULE="${1:-test_sharding}"
+
+# Optional-mode settings are passed on to both nodes if set here
+MODE_ENV=""
+for name in REBALANCE DRAFT_MODEL PARALLELISM WIRE_CODEC TRACE; do
+    if [ -n "${!name}" ]; then
+        MODE_ENV="${MODE_ENV}export ${name}=\"${!name}\" && "
+    fi
+done
+
 # Set the model name
 export MODEL_NAME="gpt2-medium"
 export TEXT="Hello, my name is"
 
 # Start master node (mini-red) first
 echo "Starting master node (mini-red)..."
-ssh mini-red@192.168.2.171 "export MODEL_NAME=\"${MODEL_NAME}\" && export TEXT=\"${TEXT}\" && export NODE_NAME=mini-red && export PYTORCH_ENABLE_MPS_FALLBACK=1 && cd ${REMOTE_PROJECT_DIR} && PYTHONPATH=${REMOTE_PROJECT_DIR} ${REMOTE_PROJECT_DIR}/venv/bin/python -m src.tests.test_sharding" 2>&1 | tee mini-red.log &
+ssh mini-red@192.168.2.171 "${MODE_ENV}export MODEL_NAME=\"${MODEL_NAME}\" && export TEXT=\"${TEXT}\" && export NODE_NAME=mini-red && export PYTORCH_ENABLE_MPS_FALLBACK=1 && cd ${REMOTE_PROJECT_DIR} && PYTHONPATH=${REMOTE_PROJECT_DIR} ${REMOTE_PROJECT_DIR}/venv/bin/python -m src.tests.${TEST_MODULE}" 2>&1 | tee mini-red.log &
 MASTER_PID=$!
 
 # Give master node time to start up
@@ -24,7 +35,7 @@ sleep 5
 
 # Start worker node (mini-yellow)
 echo "Starting worker node (mini-yellow)..."
-ssh mini-yellow@192.168.2.224 "export MODEL_NAME=\"${MODEL_NAME}\" && export TEXT=\"${TEXT}\" && export NODE_NAME=mini-yellow && export PYTORCH_ENABLE_MPS_FALLBACK=1 && cd ${REMOTE_PROJECT_DIR} && PYTHONPATH=${REMOTE_PROJECT_DIR} ${REMOTE_PROJECT_DIR}/venv/bin/python -m src.tests.test_sharding" 2>&1 | tee mini-yellow.log &
+ssh mini-yellow@192.168.2.224 "${MODE_ENV}export MODEL_NAME=\"${MODEL_NAME}\" && export TEXT=\"${TEXT}\" && export NODE_NAME=mini-yellow && export PYTORCH_ENABLE_MPS_FALLBACK=1 && cd ${REMOTE_PROJECT_DIR} && PYTHONPATH=${REMOTE_PROJECT_DIR} ${REMOTE_PROJECT_DIR}/venv/bin/python -m src.tests.${TEST_MODULE}" 2>&1 | tee mini-yellow.log &
 WORKER_PID=$!
 
 # Wait for both to finish
@@ -0,0 +1,27 @@
+#!/bin/bash
+
+# Start a stage daemon on each Mac Mini. They load their shards once and then
+# wait for jobs from scripts/submit_job.py, e.g.
+#   python scripts/submit_job.py --host 192.168.2.171 generate "Hello, my name is"
+#   python scripts/submit_job.py --host 192.168.2.171 shutdown
+
+# Define the project directory on the remote hosts
+REMOTE_PROJECT_DIR="~/projects/mac-mini-connect"
+
+# The model loaded at startup; swap it later with `submit_job.py load-model`
+export MODEL_NAME="${MODEL_NAME:-gpt2-medium}"
+
+# Rank 0 takes jobs on every interface so the control machine can reach it
+DAEMON_ENV="export MODEL_NAME=\"${MODEL_NAME}\" && export PYTORCH_ENABLE_MPS_FALLBACK=1 && export DAEMON_HOST=0.0.0.0"
+
+echo "Starting daemon on master node (mini-red)..."
+ssh mini-red@192.168.2.171 "${DAEMON_ENV} && export NODE_NAME=mini-red && cd ${REMOTE_PROJECT_DIR} && PYTHONPATH=${REMOTE_PROJECT_DIR} nohup ${REMOTE_PROJECT_DIR}/venv/bin/python -m src.stage_daemon > daemon.log 2>&1 &"
+
+# Give master node time to start up
+sleep 5
+
+echo "Starting daemon on worker node (mini-yellow)..."
+ssh mini-yellow@192.168.2.224 "${DAEMON_ENV} && export NODE_NAME=mini-yellow && cd ${REMOTE_PROJECT_DIR} && PYTHONPATH=${REMOTE_PROJECT_DIR} nohup ${REMOTE_PROJECT_DIR}/venv/bin/python -m src.stage_daemon > daemon.log 2>&1 &"
+
+echo "Daemons started; logs are in ${REMOTE_PROJECT_DIR}/daemon.log on each node."
+echo "Check on them with: python scripts/submit_job.py --host 192.168.2.171 status"
@@ -0,0 +1,86 @@
+"""
+Submit jobs to the stage daemons (src/stage_daemon.py) and print the result.
+Only needs the standard library, so it starts instantly:
+
+    python scripts/submit_job.py generate "Hello, my name is" --max-new-tokens 20
+    python scripts/submit_job.py load-model gpt2-large
+    python scripts/submit_job.py status
+    python scripts/submit_job.py shutdown
+
+Rank 0's address comes from --host/--port, or DAEMON_HOST/DAEMON_PORT.
+"""
+import argparse
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+
+def request(url, payload=None):
+    """GET `url`, or POST `payload` as JSON to it; returns the status and the decoded reply."""
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+def main():
+    parser = argparse.ArgumentParser(description="Submit a job to the stage daemons")
+    parser.add_argument("--host", default=os.environ.get("DAEMON_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("DAEMON_PORT", "8100")))
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="Generate a completion for a prompt")
+    generate.add_argument("prompt")
+    generate.add_argument("--max-new-tokens", type=int, default=20)
+    generate.add_argument("--temperature", type=float, default=0.0)
+    generate.add_argument("--top-k", type=int, default=0)
+    generate.add_argument("--top-p", type=float, default=1.0)
+    generate.add_argument("--seed", type=int)
+    generate.add_argument("--no-speculative", action="store_true",
+                          help="Decode one token per pipeline pass even if a draft model is loaded")
+
+    load_model = commands.add_parser("load-model", help="Swap every node to another model")
+    load_model.add_argument("model_name")
+    load_model.add_argument("--architecture", help="MODEL_REGISTRY entry, if the model name is a local path")
+    load_model.add_argument("--draft-model", help="Small model rank 0 uses for speculative decoding")
+
+    commands.add_parser("status", help="Show what the daemons are running")
+    commands.add_parser("shutdown", help="Stop every daemon")
+    args = parser.parse_args()
+
+    base_url = f"http://{args.host}:{args.port}"
+    if args.command == "status":
+        status, reply = request(f"{base_url}/status")
+    else:
+        if args.command == "generate":
+            job = {
+                "type": "generate",
+                "prompt": args.prompt,
+                "max_new_tokens": args.max_new_tokens,
+                "temperature": args.temperature,
+                "top_k": args.top_k,
+                "top_p": args.top_p,
+                "seed": args.seed,
+            }
+            if args.no_speculative:
+                job["speculative"] = False
+        elif args.command == "load-model":
+            job = {
+                "type": "load_model",
+                "model_name": args.model_name,
+                "architecture": args.architecture,
+                "draft_model": args.draft_model,
+            }
+        else:
+            job = {"type": "shutdown"}
+        status, reply = request(f"{base_url}/jobs", job)
+
+    print(json.dumps(reply, indent=2))
+    if status != 200:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
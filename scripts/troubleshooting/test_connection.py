@@ -1,6 +1,34 @@
+"""
+Network checks between the minis, from "can they talk at all" to "can the
+link carry pipeline traffic".
+
+    server/client      one "hello" each way over a plain socket
+    tcp-server         a sink/echo server for tcp-bench (runs until Ctrl-C)
+    tcp-bench          TCP round-trip latency and throughput over a sweep of
+                       message sizes and parallel streams
+    gloo               send/recv, broadcast and all-reduce latency and
+                       bandwidth for activation-shaped tensors, over the
+                       process group `setup_distributed` creates
+    loopback           all of the above on this machine, e.g. for CI
+
+    python scripts/troubleshooting/test_connection.py tcp-server 0.0.0.0 29502          # on mini-red
+    python scripts/troubleshooting/test_connection.py tcp-bench 192.168.2.171 29502     # on mini-yellow
+    NODE_NAME=mini-red PYTHONPATH=. python scripts/troubleshooting/test_connection.py gloo   # on every node
+    PYTHONPATH=. python scripts/troubleshooting/test_connection.py loopback --output net.json
+
+The benchmarks print a table and, with --output, write the numbers as JSON.
+"""
 import socket
 import argparse
+import json
+import os
+import platform
+import queue
+import statistics
+import struct
 import sys
+import tempfile
+import threading
 import time
 
 def log_message(message):
@@ -47,8 +75,284 @@ def run_client(host, port):
             sys.exit(1)
     log_message("Client finished successfully.")
 
+# --- TCP benchmark ---
+
+# A tcp-bench connection opens with (mode, message size, message count).
+TCP_HEADER = struct.Struct("!BQQ")
+TCP_PING, TCP_STREAM = 0, 1
+
+def parse_size(text):
+    """"64", "16K", "4M" -> bytes"""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    if text[-1:].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+def format_size(nbytes):
+    for unit, scale in (("G", 1024**3), ("M", 1024**2), ("K", 1024)):
+        if nbytes >= scale and nbytes % scale == 0:
+            return f"{nbytes // scale}{unit}"
+    return str(nbytes)
+
+def recv_exact(conn, buffer):
+    """Fill `buffer` (a bytearray or memoryview) from the socket."""
+    view = memoryview(buffer)
+    while view:
+        received = conn.recv_into(view)
+        if not received:
+            raise ConnectionError("Connection closed mid-message")
+        view = view[received:]
+
+def _serve_bench_connection(conn):
+    with conn:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        header = bytearray(TCP_HEADER.size)
+        recv_exact(conn, header)
+        mode, size, count = TCP_HEADER.unpack(header)
+        buffer = bytearray(size)
+        for _ in range(count):
+            recv_exact(conn, buffer)
+            if mode == TCP_PING:
+                conn.sendall(buffer)
+        if mode == TCP_STREAM:
+            conn.sendall(struct.pack("!Q", size * count))
+
+def run_tcp_server(host, port, ready=None):
+    """
+    Answer tcp-bench connections, each on its own thread, until interrupted.
+    `ready`, if given, is called with the port once listening (port 0 picks one).
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(64)
+        log_message(f"Benchmark server listening on {host}:{sock.getsockname()[1]}")
+        if ready is not None:
+            ready(sock.getsockname()[1])
+        while True:
+            conn, _ = sock.accept()
+            threading.Thread(target=_serve_bench_connection, args=(conn,), daemon=True).start()
+
+def _connect(host, port, mode, size, count):
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(TCP_HEADER.pack(mode, size, count))
+    return sock
+
+def tcp_latency(host, port, size, rounds):
+    """Round trips of a `size`-byte message; returns the times in seconds."""
+    message, reply = bytes(size), bytearray(size)
+    times = []
+    with _connect(host, port, TCP_PING, size, rounds) as sock:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            sock.sendall(message)
+            recv_exact(sock, reply)
+            times.append(time.perf_counter() - start)
+    return times
+
+def tcp_throughput(host, port, size, total_bytes, streams):
+    """Push `total_bytes` in `size`-byte messages over `streams` connections at once; returns bytes/s."""
+    count = max(1, total_bytes // (size * streams))
+    message = bytes(size)
+    sockets = [_connect(host, port, TCP_STREAM, size, count) for _ in range(streams)]
+    barrier = threading.Barrier(streams + 1)
+
+    def push(sock):
+        barrier.wait()
+        for _ in range(count):
+            sock.sendall(message)
+        acknowledged = bytearray(8)
+        recv_exact(sock, acknowledged)
+
+    threads = [threading.Thread(target=push, args=(sock,)) for sock in sockets]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for sock in sockets:
+        sock.close()
+    return size * count * streams / elapsed
+
+def run_tcp_bench(host, port, sizes, streams, rounds, total_bytes):
+    """Sweep message sizes (latency and throughput) and stream counts (throughput)."""
+    results = []
+    for size in sizes:
+        # Big messages need fewer round trips for a stable figure.
+        times = tcp_latency(host, port, size, max(3, min(rounds, total_bytes // size)))
+        for count in streams:
+            bandwidth = tcp_throughput(host, port, size, total_bytes, count)
+            results.append({
+                "message_bytes": size,
+                "streams": count,
+                "latency_us_p50": statistics.median(times) * 1e6,
+                "latency_us_min": min(times) * 1e6,
+                "throughput_mb_per_s": bandwidth / 1024**2,
+            })
+            log_message(f"TCP {format_size(size)} x{count}: {results[-1]['throughput_mb_per_s']:.1f} MB/s")
+    return results
+
+# --- gloo benchmark ---
+
+def _timed(operation, iterations):
+    """Mean seconds per call of `operation`, after a warm-up call."""
+    operation()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        operation()
+    return (time.perf_counter() - start) / iterations
+
+def gloo_benchmark(shapes, dtype_name, iterations):
+    """
+    Time point-to-point and collective ops on activation-shaped tensors.
+    Every rank of an initialized process group calls this; rank 0 returns
+    the results, the others None.
+    """
+    import torch
+    import torch.distributed as dist
+
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    dtype = getattr(torch, dtype_name)
+    results = []
+    for shape in shapes:
+        tensor = torch.zeros(shape, dtype=dtype)
+        nbytes = tensor.numel() * tensor.element_size()
+
+        def ping_pong():
+            # Rank 0 and rank 1 only, like neighbouring pipeline stages.
+            if rank == 0:
+                dist.send(tensor, dst=1)
+                dist.recv(tensor, src=1)
+            elif rank == 1:
+                dist.recv(tensor, src=0)
+                dist.send(tensor, dst=0)
+
+        timings = {
+            # One way is half a round trip.
+            "send_recv": _timed(ping_pong, iterations) / 2,
+            "broadcast": _timed(lambda: dist.broadcast(tensor, src=0), iterations),
+            "all_reduce": _timed(lambda: dist.all_reduce(tensor), iterations),
+        }
+        # A collective takes as long as its slowest rank.
+        slowest = torch.tensor([timings["broadcast"], timings["all_reduce"]], dtype=torch.float64)
+        dist.all_reduce(slowest, op=dist.ReduceOp.MAX)
+        timings["broadcast"], timings["all_reduce"] = slowest.tolist()
+        # An all-reduce moves 2 (n - 1) / n of the tensor through every link (the usual "bus bandwidth").
+        moved = {"send_recv": nbytes, "broadcast": nbytes, "all_reduce": 2 * (world_size - 1) / world_size * nbytes}
+        for op, seconds in timings.items():
+            results.append({
+                "op": op,
+                "shape": list(shape),
+                "dtype": dtype_name,
+                "bytes": nbytes,
+                "world_size": world_size,
+                "latency_us": seconds * 1e6,
+                "bandwidth_mb_per_s": moved[op] / seconds / 1024**2,
+            })
+        if rank == 0:
+            log_message(f"gloo {list(shape)}: " + ", ".join(
+                f"{op} {seconds * 1e6:.0f} us" for op, seconds in timings.items()))
+    return results if rank == 0 else None
+
+def _run_gloo(node_config, shapes, dtype_name, iterations, result_path):
+    from src.common.distributed import setup_distributed, cleanup_distributed
+
+    setup_distributed(node_config)
+    try:
+        results = gloo_benchmark(shapes, dtype_name, iterations)
+        if results is not None and result_path:
+            with open(result_path, "w") as f:
+                json.dump(results, f)
+    finally:
+        cleanup_distributed()
+    return results
+
+def _run_local_gloo_rank(rank, world_size, port, shapes, dtype_name, iterations, result_path):
+    from src.common.config import NodeConfig
+
+    node_config = NodeConfig(name=f"loopback{rank}", address="127.0.0.1", rank=rank, world_size=world_size,
+                             master_addr="127.0.0.1", master_port=port)
+    _run_gloo(node_config, shapes, dtype_name, iterations, result_path)
+
+def run_local_gloo(world_size, shapes, dtype_name, iterations):
+    """Run the gloo benchmark with `world_size` processes on this machine."""
+    import torch.multiprocessing as mp
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    with tempfile.TemporaryDirectory() as directory:
+        result_path = os.path.join(directory, "gloo.json")
+        mp.spawn(_run_local_gloo_rank, args=(world_size, port, shapes, dtype_name, iterations, result_path),
+                 nprocs=world_size, join=True)
+        with open(result_path) as f:
+            return json.load(f)
+
+# --- Reporting ---
+
+def format_table(rows, columns):
+    """`rows` (dicts) as a right-aligned table of `columns`, (key, header, format) triples."""
+    cells = [[header for _, header, _ in columns]]
+    cells += [[fmt(row[key]) for key, _, fmt in columns] for row in rows]
+    widths = [max(len(line[column]) for line in cells) for column in range(len(columns))]
+    return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(line, widths)) for line in cells)
+
+TCP_COLUMNS = [
+    ("message_bytes", "message", format_size),
+    ("streams", "streams", str),
+    ("latency_us_p50", "p50 rtt us", lambda value: f"{value:.1f}"),
+    ("latency_us_min", "min rtt us", lambda value: f"{value:.1f}"),
+    ("throughput_mb_per_s", "MB/s", lambda value: f"{value:.1f}"),
+]
+GLOO_COLUMNS = [
+    ("op", "op", str),
+    ("shape", "shape", lambda shape: "x".join(map(str, shape))),
+    ("bytes", "bytes", format_size),
+    ("latency_us", "latency us", lambda value: f"{value:.1f}"),
+    ("bandwidth_mb_per_s", "MB/s", lambda value: f"{value:.1f}"),
+]
+
+def report(tcp=None, gloo=None, output=None):
+    """Print the tables and write the JSON report."""
+    if tcp:
+        print("\nTCP\n" + format_table(tcp, TCP_COLUMNS), flush=True)
+    if gloo:
+        print("\ngloo\n" + format_table(gloo, GLOO_COLUMNS), flush=True)
+    if output:
+        with open(output, "w") as f:
+            json.dump({
+                "environment": {"host": socket.gethostname(), "platform": platform.platform(),
+                                "python": platform.python_version()},
+                "tcp": tcp or [],
+                "gloo": gloo or [],
+            }, f, indent=2)
+            f.write("\n")
+        log_message(f"Wrote {output}")
+
+def activation_shapes(args):
+    """(batch, tokens, hidden) for every requested batch size and token count."""
+    return [(batch, tokens, args.hidden_size) for batch in args.batch_sizes for tokens in args.tokens]
+
+def add_tcp_arguments(parser):
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=[parse_size(size) for size in
+                        ("64", "1K", "16K", "256K", "4M")], help="Message sizes, e.g. 64 16K 4M")
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 2, 4], help="Parallel connections")
+    parser.add_argument("--rounds", type=int, default=200, help="Round trips per latency point")
+    parser.add_argument("--total-mb", type=float, default=64, help="Data pushed per throughput point")
+
+def add_gloo_arguments(parser):
+    parser.add_argument("--hidden-size", type=int, default=1024, help="Activation width (e.g. gpt2-medium's)")
+    parser.add_argument("--tokens", type=int, nargs="+", default=[1, 16, 128, 512],
+                        help="Positions per message: 1 for a decode step, more for prefills")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument("--iterations", type=int, default=20, help="Timed repetitions per op and shape")
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Simple TCP Client/Server")
+    parser = argparse.ArgumentParser(description="TCP connectivity checks and network benchmarks")
     subparsers = parser.add_subparsers(dest="role", required=True)
 
     # Server parser
@@ -61,9 +365,55 @@ if __name__ == "__main__":
     client_parser.add_argument("host", help="Host IP to connect to")
     client_parser.add_argument("port", type=int, help="Port to connect to")
 
+    tcp_server_parser = subparsers.add_parser("tcp-server", help="Serve tcp-bench clients until interrupted")
+    tcp_server_parser.add_argument("host", help="Address to bind to, e.g. 0.0.0.0")
+    tcp_server_parser.add_argument("port", type=int)
+
+    tcp_bench_parser = subparsers.add_parser("tcp-bench", help="Benchmark TCP against a tcp-server")
+    tcp_bench_parser.add_argument("host")
+    tcp_bench_parser.add_argument("port", type=int)
+    add_tcp_arguments(tcp_bench_parser)
+    tcp_bench_parser.add_argument("--output", help="Write the results as JSON to this file")
+
+    gloo_parser = subparsers.add_parser("gloo", help="Benchmark gloo between the nodes (run on every node)")
+    add_gloo_arguments(gloo_parser)
+    gloo_parser.add_argument("--world-size", type=int,
+                             help="Spawn this many local ranks over loopback instead of using NODE_NAME")
+    gloo_parser.add_argument("--output", help="Write the results as JSON to this file (rank 0)")
+
+    loopback_parser = subparsers.add_parser("loopback", help="Run both benchmarks on this machine")
+    add_tcp_arguments(loopback_parser)
+    add_gloo_arguments(loopback_parser)
+    loopback_parser.add_argument("--world-size", type=int, default=2, help="Local gloo ranks")
+    loopback_parser.add_argument("--output", help="Write the results as JSON to this file")
+
     args = parser.parse_args()
 
     if args.role == "server":
         run_server(args.host, args.port)
     elif args.role == "client":
-        run_client(args.host, args.port) 
\ No newline at end of file
+        run_client(args.host, args.port)
+    elif args.role == "tcp-server":
+        try:
+            run_tcp_server(args.host, args.port)
+        except KeyboardInterrupt:
+            log_message("Benchmark server stopped.")
+    elif args.role == "tcp-bench":
+        tcp = run_tcp_bench(args.host, args.port, args.sizes, args.streams, args.rounds, int(args.total_mb * 1024**2))
+        report(tcp=tcp, output=args.output)
+    elif args.role == "gloo":
+        if args.world_size:
+            gloo = run_local_gloo(args.world_size, activation_shapes(args), args.dtype, args.iterations)
+        else:
+            from src.common.config import get_node_config
+            gloo = _run_gloo(get_node_config(), activation_shapes(args), args.dtype, args.iterations, None)
+        if gloo is not None:
+            report(gloo=gloo, output=args.output)
+    elif args.role == "loopback":
+        if args.world_size < 2:
+            parser.error("The gloo benchmark needs at least 2 ranks")
+        ports = queue.Queue()
+        threading.Thread(target=run_tcp_server, args=("127.0.0.1", 0, ports.put), daemon=True).start()
+        tcp = run_tcp_bench("127.0.0.1", ports.get(), args.sizes, args.streams, args.rounds, int(args.total_mb * 1024**2))
+        gloo = run_local_gloo(args.world_size, activation_shapes(args), args.dtype, args.iterations)
+        report(tcp=tcp, gloo=gloo, output=args.output)
@@ -0,0 +1,297 @@
+"""
+Benchmark pipeline inference on a single machine.
+
+Spawns `world_size` local processes that talk gloo over loopback (or
+shared memory, with --shared-memory), loads a small randomly initialized
+model for each family in MODEL_REGISTRY (nothing is downloaded) and
+measures loading, prefill and decode over a matrix of batch sizes, prompt
+lengths and world sizes. Results are emitted as JSON so
+two runs can be diffed to catch regressions before deploying to the minis:
+
+    python -m src.benchmark_pipeline --world-sizes 1 2 --batch-sizes 1 4 --seq-lens 16 128 --output bench.json
+
+With `--parallelism pipeline tensor` every point is also run tensor
+parallel, and the report's "crossover" lists which mode decodes faster at
+each one. Loopback all-reduces are far cheaper than the minis' network, so
+rerun it on the cluster's own link before trusting the crossover.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import socket
+import sys
+import tempfile
+import time
+from typing import List
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import transformers
+from transformers import AutoConfig, AutoModelForCausalLM
+
+from src.common.config import MODEL_CONFIG, MODEL_REGISTRY, NODES, NodeConfig
+from src.common.distributed import setup_distributed, cleanup_distributed
+from src.common.model_sharding import get_partition, load_partial_model, generate
+from src.common.tensor_parallel import load_tensor_parallel_model, tensor_parallel_generate
+
+# Per-family settings for the random configs, on top of the layer count,
+# hidden size and vocab size shared by all of them.
+TINY_HEADS = 4
+TINY_CONFIGS = {
+    "gpt2": lambda hidden: {"n_head": TINY_HEADS, "n_positions": 1024},
+    "gptj": lambda hidden: {"n_head": TINY_HEADS, "rotary_dim": hidden // 8, "n_positions": 1024},
+    "opt": lambda hidden: {
+        "num_attention_heads": TINY_HEADS,
+        "ffn_dim": 4 * hidden,
+        "word_embed_proj_dim": hidden,
+        "max_position_embeddings": 1024,
+    },
+}
+MAX_POSITIONS = 1024
+
+def family_models() -> dict:
+    """The first MODEL_REGISTRY entry of each model family."""
+    families = {}
+    for model_name, arch_config in MODEL_REGISTRY.items():
+        families.setdefault(arch_config["model_type"], model_name)
+    return families
+
+def save_tiny_checkpoint(model_type: str, arch_config: dict, args, directory: str) -> str:
+    """Write a randomly initialized checkpoint of the family and return its path."""
+    config = AutoConfig.for_model(
+        model_type,
+        vocab_size=args.vocab_size,
+        **{arch_config["num_layers_key"]: args.layers, arch_config["hidden_size_key"]: args.hidden_size},
+        **TINY_CONFIGS[model_type](args.hidden_size),
+    )
+    torch.manual_seed(0)
+    model = AutoModelForCausalLM.from_config(config)
+    path = os.path.join(directory, model_type)
+    model.save_pretrained(path)
+    return path
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+def _run_rank(rank: int, world_size: int, port: int, job: dict, result_path: str) -> None:
+    node_config = NodeConfig(
+        name=f"bench-rank{rank}", address="127.0.0.1", rank=rank, world_size=world_size,
+        master_addr="127.0.0.1", master_port=port,
+    )
+    MODEL_CONFIG.update(
+        model_name=job["checkpoint"],
+        model_arch_config=MODEL_REGISTRY[job["model_name"]],
+        device=job["device"],
+        dtype=job["dtype"],
+        shard_cache_dir="",
+        shared_memory_transport=job["shared_memory"],
+        parallelism=job["parallelism"],
+        quantization=job["quantization"],
+    )
+    tensor_parallel = job["parallelism"] == "tensor"
+    load = load_tensor_parallel_model if tensor_parallel else load_partial_model
+    run = tensor_parallel_generate if tensor_parallel else generate
+    # The transport pairs up co-located neighbours by their address in NODES.
+    NODES.clear()
+    for peer in range(world_size):
+        NODES[f"bench-rank{peer}"] = NodeConfig(name=f"bench-rank{peer}", address="127.0.0.1", rank=peer,
+                                               world_size=world_size)
+    setup_distributed(node_config)
+    try:
+        # The loader and the pipeline log every step; keep the JSON readable.
+        with contextlib.redirect_stdout(io.StringIO()):
+            load_start = time.perf_counter()
+            model = load(node_config, device=job["device"])
+            load_time = time.perf_counter() - load_start
+            # Tensor parallel ranks each hold a slice of every layer.
+            layer_range = (0, job["layers"]) if tensor_parallel else get_partition(model.config, world_size)[rank]
+
+            results = []
+            for batch_size in job["batch_sizes"]:
+                for seq_len in job["seq_lens"]:
+                    generator = torch.Generator().manual_seed(batch_size * 1000 + seq_len)
+                    input_ids = torch.randint(
+                        job["vocab_size"], (batch_size, seq_len), generator=generator
+                    ).to(job["device"])
+                    # Warm up allocators and the transport's buffer sizes.
+                    run(model, input_ids, node_config, max_new_tokens=2)
+                    _, stats = run(model, input_ids, node_config, max_new_tokens=job["new_tokens"],
+                                   return_stats=True)
+                    results.append((batch_size, seq_len, stats))
+
+        rank_info = {
+            "rank": rank,
+            "layer_range": list(layer_range),
+            "load_time": load_time,
+            "peak_rss_mb": _peak_rss_mb(),
+            "runs": [
+                {"bytes_sent": stats.bytes_sent, "bytes_received": stats.bytes_received}
+                for _, _, stats in results
+            ],
+        }
+        gathered = [None] * world_size
+        dist.all_gather_object(gathered, rank_info)
+
+        if rank == 0:
+            records = []
+            for index, (batch_size, seq_len, stats) in enumerate(results):
+                decode = sorted(stats.decode_times)
+                total = stats.prefill_time + sum(decode)
+                records.append({
+                    "family": job["family"],
+                    "model_name": job["model_name"],
+                    "world_size": world_size,
+                    "parallelism": job["parallelism"],
+                    "transport": "shared_memory" if job["shared_memory"] and world_size > 1 else "gloo",
+                    "batch_size": batch_size,
+                    "seq_len": seq_len,
+                    "new_tokens": job["new_tokens"],
+                    "load_time": max(info["load_time"] for info in gathered),
+                    "prefill_latency": stats.prefill_time,
+                    "decode_latency_mean": sum(decode) / len(decode) if decode else None,
+                    "decode_latency_p50": decode[len(decode) // 2] if decode else None,
+                    "decode_latency_max": decode[-1] if decode else None,
+                    "tokens_per_second": batch_size * job["new_tokens"] / total if total > 0 else None,
+                    "stages": [
+                        {
+                            "rank": info["rank"],
+                            "layer_range": info["layer_range"],
+                            "load_time": info["load_time"],
+                            "peak_rss_mb": info["peak_rss_mb"],
+                            **info["runs"][index],
+                        }
+                        for info in gathered
+                    ],
+                })
+            with open(result_path, "w") as f:
+                json.dump(records, f)
+    finally:
+        cleanup_distributed()
+
+def summarize_crossover(results: List[dict]) -> List[dict]:
+    """Pair up pipeline and tensor parallel runs of the same point and say which decodes faster."""
+    runs = {}
+    for record in results:
+        key = (record["family"], record["world_size"], record["batch_size"], record["seq_len"])
+        runs.setdefault(key, {})[record["parallelism"]] = record
+    crossover = []
+    for (family, world_size, batch_size, seq_len), modes in runs.items():
+        if "pipeline" not in modes or "tensor" not in modes or world_size == 1:
+            continue
+        pipeline, tensor = modes["pipeline"]["decode_latency_mean"], modes["tensor"]["decode_latency_mean"]
+        if pipeline is None or tensor is None:
+            continue
+        crossover.append({
+            "family": family,
+            "world_size": world_size,
+            "batch_size": batch_size,
+            "seq_len": seq_len,
+            "pipeline_decode_latency": pipeline,
+            "tensor_decode_latency": tensor,
+            "faster": "tensor" if tensor < pipeline else "pipeline",
+        })
+    return crossover
+
+def run_benchmark(args) -> dict:
+    families = family_models()
+    selected = args.families or list(families)
+    unknown = set(selected) - set(families)
+    if unknown:
+        raise ValueError(f"Unknown model families {sorted(unknown)}, expected some of {list(families)}")
+    if max(args.seq_lens) + args.new_tokens > MAX_POSITIONS:
+        raise ValueError(f"Prompt plus new tokens must fit in {MAX_POSITIONS} positions")
+
+    results: List[dict] = []
+    with tempfile.TemporaryDirectory() as directory:
+        for family in selected:
+            model_name = families[family]
+            checkpoint = save_tiny_checkpoint(family, MODEL_REGISTRY[model_name], args, directory)
+            job = {
+                "family": family,
+                "model_name": model_name,
+                "checkpoint": checkpoint,
+                "device": args.device,
+                "dtype": args.dtype,
+                "vocab_size": args.vocab_size,
+                "batch_sizes": args.batch_sizes,
+                "seq_lens": args.seq_lens,
+                "new_tokens": args.new_tokens,
+                "shared_memory": args.shared_memory,
+                "layers": args.layers,
+                "quantization": args.quantization,
+            }
+            for parallelism in args.parallelism:
+                for world_size in args.world_sizes:
+                    # A fresh set of processes per model and world size keeps the
+                    # peak RSS figures from leaking across runs.
+                    result_path = os.path.join(directory, f"{family}-{parallelism}-ws{world_size}.json")
+                    mp.spawn(_run_rank, args=(world_size, _free_port(), dict(job, parallelism=parallelism), result_path),
+                             nprocs=world_size, join=True)
+                    with open(result_path) as f:
+                        results.extend(json.load(f))
+                    print(f"Finished {family} ({parallelism}) with world size {world_size}", file=sys.stderr, flush=True)
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "device": args.device,
+            "dtype": args.dtype,
+            "quantization": args.quantization,
+            "layers": args.layers,
+            "hidden_size": args.hidden_size,
+            "vocab_size": args.vocab_size,
+        },
+        "results": results,
+        "crossover": summarize_crossover(results),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pipeline inference with local gloo processes")
+    parser.add_argument("--families", nargs="+", help="Model families to run (default: all in MODEL_REGISTRY)")
+    parser.add_argument("--world-sizes", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--seq-lens", type=int, nargs="+", default=[16, 128])
+    parser.add_argument("--new-tokens", type=int, default=16, help="Tokens generated per run")
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--vocab-size", type=int, default=1024)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument("--quantization", choices=["none", "int8", "int4"], default="none",
+                        help="Quantize every stage's decoder layers at load time")
+    parser.add_argument("--shared-memory", action="store_true",
+                        help="Pass activations between the local stages through shared memory instead of gloo")
+    parser.add_argument("--parallelism", nargs="+", choices=["pipeline", "tensor"], default=["pipeline"],
+                        help="Run every point in each of these modes")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if max(args.world_sizes) > args.layers:
+        parser.error("Every world size needs at least one layer per stage")
+    if "tensor" in args.parallelism and any(TINY_HEADS % world_size for world_size in args.world_sizes):
+        parser.error(f"Tensor parallelism splits the {TINY_HEADS} attention heads, so world sizes must divide it")
+
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text, flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Offline bulk inference: stream prompts from a JSONL file through the cluster
+and write completions to another JSONL file as they finish.
+
+Each input line is an object with a "prompt" (or "input_ids") and optionally
+an "id", "max_new_tokens" and the HTTP server's sampling fields
+("temperature", "top_k", "top_p", "seed" and "logprobs"). Each output line
+carries the same "id" (the line number if there was none) and the
+completion, or an "error". Start it on every node:
+
+    NODE_NAME=mini-red python -m src.bulk_inference --input prompts.jsonl --output completions.jsonl
+    NODE_NAME=mini-yellow python -m src.bulk_inference
+
+Rank 0 reads the input one window at a time and submits each window sorted
+by prompt length, so the prompts the continuous batcher admits together need
+little padding. At most a window of requests is outstanding, which bounds
+memory however long the input is.
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+from typing import Iterator, List, Tuple
+from transformers import AutoTokenizer
+
+from src.common import (
+    MODEL_CONFIG, SERVER_CONFIG, setup_distributed, cleanup_distributed, is_master, synchronize, write_trace,
+)
+from src.common.config import get_node_config
+from src.common.model_sharding import load_partial_model
+from src.common.serving import ContinuousBatcher, parse_sampling, serve_stage
+
+def read_windows(path: str, window: int) -> Iterator[List[Tuple[int, dict]]]:
+    """Yield the non-empty lines of a JSONL file as (line number, record) lists of up to `window`."""
+    lines = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = {"error": f"Invalid JSON: {e}"}
+            if not isinstance(record, dict):
+                record = {"error": "Expected a JSON object"}
+            lines.append((number, record))
+            if len(lines) == window:
+                yield lines
+                lines = []
+    if lines:
+        yield lines
+
+class BulkRunner:
+    """
+    Feeds a JSONL file to the batcher from one thread and writes results
+    from another, while the caller's thread runs the batcher itself.
+    """
+
+    def __init__(self, batcher: ContinuousBatcher, tokenizer, window: int, max_new_tokens: int, temperature: float):
+        self.batcher = batcher
+        self.tokenizer = tokenizer
+        self.window = window
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.completed = 0
+        self.tokens = 0
+        self._tokenizer_lock = threading.Lock()
+        self._slots = threading.Semaphore(window)
+        self._results: "queue.Queue" = queue.Queue()
+
+    def _encode(self, record: dict) -> List[int]:
+        if "error" in record:
+            raise ValueError(record["error"])
+        if "input_ids" in record:
+            return [int(token) for token in record["input_ids"]]
+        if "prompt" not in record:
+            raise ValueError("Expected a 'prompt' or 'input_ids'")
+        with self._tokenizer_lock:
+            return self.tokenizer(record["prompt"]).input_ids
+
+    def feed(self, input_path: str) -> None:
+        try:
+            for lines in read_windows(input_path, self.window):
+                prepared = []
+                for number, record in lines:
+                    record_id = record.get("id", number)
+                    try:
+                        prepared.append((self._encode(record), record_id, record))
+                    except (ValueError, TypeError) as e:
+                        self._results.put((record_id, None, str(e)))
+
+                # Neighbours in length land in the same prefill and share its padding.
+                for input_ids, record_id, record in sorted(prepared, key=lambda item: len(item[0])):
+                    self._slots.acquire()
+                    try:
+                        self.batcher.submit(
+                            input_ids,
+                            record.get("max_new_tokens", self.max_new_tokens),
+                            parse_sampling(record, self.temperature),
+                            on_done=lambda request, record_id=record_id: self._results.put((record_id, request, None)),
+                        )
+                    except (ValueError, TypeError) as e:
+                        self._slots.release()
+                        self._results.put((record_id, None, str(e)))
+
+            # Every slot is free again once all submitted requests are written.
+            for _ in range(self.window):
+                self._slots.acquire()
+        finally:
+            self._results.put(None)
+            self.batcher.stop()
+
+    def write(self, output_path: str) -> None:
+        start = time.perf_counter()
+        with open(output_path, "w") as f:
+            while True:
+                item = self._results.get()
+                if item is None:
+                    break
+                record_id, request, error = item
+                result = {"id": record_id}
+                if error or request.error:
+                    result["error"] = error or request.error
+                else:
+                    with self._tokenizer_lock:
+                        text = self.tokenizer.decode(request.output_ids, skip_special_tokens=True)
+                    result.update(
+                        text=text,
+                        output_ids=request.output_ids,
+                        prompt_tokens=len(request.input_ids),
+                        completion_tokens=len(request.output_ids),
+                    )
+                    if request.sampling.logprobs:
+                        result["logprobs"] = request.output_logprobs
+                    self.tokens += len(request.output_ids)
+                f.write(json.dumps(result) + "\n")
+                f.flush()
+                if request is not None:
+                    self._slots.release()
+
+                self.completed += 1
+                if self.completed % 100 == 0:
+                    elapsed = time.perf_counter() - start
+                    print(f"[bulk] {self.completed} done, {self.tokens / elapsed:.1f} tokens/s", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run every prompt in a JSONL file through the cluster")
+    parser.add_argument("--input", help="JSONL file of prompts (rank 0 only)")
+    parser.add_argument("--output", help="JSONL file for the completions (rank 0 only)")
+    parser.add_argument("--max-new-tokens", type=int, default=SERVER_CONFIG["default_max_new_tokens"])
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--window", type=int, default=256,
+                        help="Prompts sorted together, and the most requests outstanding at once")
+    args = parser.parse_args()
+
+    node_config = get_node_config()
+    if MODEL_CONFIG["parallelism"] != "pipeline":
+        raise ValueError("Continuous batching runs on the pipeline; serve tensor parallel models with src.stage_daemon")
+    if node_config.rank == 0 and not (args.input and args.output):
+        parser.error("--input and --output are required on rank 0")
+
+    setup_distributed(node_config)
+    try:
+        model = load_partial_model(node_config)
+        synchronize()
+
+        if not is_master():
+            serve_stage(model, node_config)
+            write_trace()
+            return
+
+        tokenizer = AutoTokenizer.from_pretrained(MODEL_CONFIG["model_name"])
+        batcher = ContinuousBatcher(model, node_config)
+        runner = BulkRunner(batcher, tokenizer, args.window, args.max_new_tokens, args.temperature)
+        threads = [
+            threading.Thread(target=runner.feed, args=(args.input,), daemon=True),
+            threading.Thread(target=runner.write, args=(args.output,), daemon=True),
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        batcher.run()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        print(f"[bulk] Wrote {runner.completed} results ({runner.tokens} tokens) to {args.output} "
+              f"in {elapsed:.1f}s ({runner.tokens / elapsed:.1f} tokens/s)", flush=True)
+        trace = write_trace()
+        if trace:
+            print(f"[bulk] Wrote the trace to {trace}", flush=True)
+    finally:
+        cleanup_distributed()
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 """
 Common utilities for distributed ML testing.
 """
-from .config import NodeConfig, NODES, MODEL_CONFIG
+from .config import (
+    NodeConfig, NODES, MODEL_CONFIG, PIPELINE_CONFIG, SERVER_CONFIG, DAEMON_CONFIG, TRACE_CONFIG, METRICS_CONFIG,
+    REBALANCE_CONFIG,
+)
 from .distributed import (
     setup_distributed,
     cleanup_distributed,
@@ -9,14 +12,27 @@ from .distributed import (
     get_local_rank,
     synchronize
 )
+from .tracing import span, write_trace
+from .transport import PipelineTransport, send_tensor, recv_tensor
 
 __all__ = [
     'NodeConfig',
     'NODES',
     'MODEL_CONFIG',
+    'PIPELINE_CONFIG',
+    'SERVER_CONFIG',
+    'DAEMON_CONFIG',
+    'TRACE_CONFIG',
+    'METRICS_CONFIG',
+    'REBALANCE_CONFIG',
     'setup_distributed',
     'cleanup_distributed',
     'is_master',
     'get_local_rank',
-    'synchronize'
+    'synchronize',
+    'span',
+    'write_trace',
+    'PipelineTransport',
+    'send_tensor',
+    'recv_tensor'
 ] 
\ No newline at end of file
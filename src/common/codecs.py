@@ -0,0 +1,125 @@
+"""
+Wire codecs for activations sent between pipeline stages.
+
+A codec turns a tensor into a flat uint8 payload and back. Keeping every
+payload as raw bytes lets the transport reuse the same receive buffers no
+matter which codec is active. Lossy codecs only touch floating point
+tensors; anything else (e.g. token ids) always travels uncompressed.
+
+Available specs: "none", "fp16", "bf16", "int8", and any of those followed
+by "+zlib" for lossless compression on top (e.g. "int8+zlib").
+"""
+import zlib
+from typing import Tuple
+import torch
+
+def _as_bytes(tensor: torch.Tensor) -> torch.Tensor:
+    return tensor.contiguous().view(torch.uint8).reshape(-1)
+
+class WireCodec:
+    """Identity codec: sends the tensor's bytes as they are."""
+    name = "none"
+
+    def encode(self, tensor: torch.Tensor) -> Tuple[torch.Tensor, int]:
+        """Return the payload and how many of its leading bytes are meaningful."""
+        wire = _as_bytes(tensor)
+        return wire, wire.numel()
+
+    def decode(self, wire: torch.Tensor, payload_len: int, shape: Tuple[int, ...], dtype: torch.dtype) -> torch.Tensor:
+        return wire[:payload_len].view(dtype).reshape(shape)
+
+class CastCodec(WireCodec):
+    """Downcasts floating point tensors to a 16-bit type on the wire."""
+
+    def __init__(self, name: str, wire_dtype: torch.dtype):
+        self.name = name
+        self.wire_dtype = wire_dtype
+
+    def encode(self, tensor):
+        wire = _as_bytes(tensor.to(self.wire_dtype))
+        return wire, wire.numel()
+
+    def decode(self, wire, payload_len, shape, dtype):
+        return wire[:payload_len].view(self.wire_dtype).reshape(shape).to(dtype)
+
+class Int8Codec(WireCodec):
+    """
+    Symmetric per-token int8 quantization: each vector along the last
+    dimension gets its own float32 scale, stored after the int8 values
+    (padded so the scales stay 4-byte aligned).
+    """
+    name = "int8"
+
+    @staticmethod
+    def _layout(shape) -> Tuple[int, int]:
+        """Number of int8 values, and the byte offset where the scales start."""
+        num_values = 1
+        for dim in shape:
+            num_values *= dim
+        return num_values, -(-num_values // 4) * 4
+
+    def encode(self, tensor):
+        values = tensor.float()
+        scales = values.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / 127.0
+        quantized = torch.round(values / scales).clamp(-127, 127).to(torch.int8)
+        num_values, offset = self._layout(tensor.shape)
+        padding = offset - num_values
+        wire = torch.cat([
+            _as_bytes(quantized),
+            torch.zeros(padding, dtype=torch.uint8, device=tensor.device),
+            _as_bytes(scales),
+        ])
+        return wire, wire.numel()
+
+    def decode(self, wire, payload_len, shape, dtype):
+        num_values, offset = self._layout(shape)
+        quantized = wire[:num_values].view(torch.int8).reshape(shape)
+        scales = wire[offset:payload_len].view(torch.float32).reshape(tuple(shape[:-1]) + (1,))
+        return (quantized.float() * scales).to(dtype)
+
+class ZlibCodec(WireCodec):
+    """
+    Lossless zlib compression of another codec's payload. The output is
+    padded up to a size bucket (at most 1/8 overhead) so the transport sees
+    a small set of recurring payload sizes.
+    """
+
+    def __init__(self, inner: WireCodec, level: int = 1):
+        self.inner = inner
+        self.level = level
+        self.name = f"{inner.name}+zlib"
+
+    @staticmethod
+    def _bucket(size: int) -> int:
+        step = max(64, 1 << max(size.bit_length() - 4, 0))
+        return -(-size // step) * step
+
+    def encode(self, tensor):
+        inner_wire, inner_len = self.inner.encode(tensor)
+        compressed = zlib.compress(inner_wire[:inner_len].cpu().numpy().tobytes(), self.level)
+        wire = torch.zeros(self._bucket(len(compressed)), dtype=torch.uint8)
+        wire[:len(compressed)] = torch.frombuffer(bytearray(compressed), dtype=torch.uint8)
+        return wire, len(compressed)
+
+    def decode(self, wire, payload_len, shape, dtype):
+        raw = zlib.decompress(wire[:payload_len].numpy().tobytes())
+        inner_wire = torch.frombuffer(bytearray(raw), dtype=torch.uint8)
+        return self.inner.decode(inner_wire, len(raw), shape, dtype)
+
+_BASE_CODECS = {
+    "none": WireCodec(),
+    "fp16": CastCodec("fp16", torch.float16),
+    "bf16": CastCodec("bf16", torch.bfloat16),
+    "int8": Int8Codec(),
+}
+
+# Order matters: a codec's index is its code on the wire.
+CODEC_SPECS = list(_BASE_CODECS) + [f"{name}+zlib" for name in _BASE_CODECS]
+
+def get_codec(spec: str) -> WireCodec:
+    """Build the codec for a spec such as "int8" or "fp16+zlib"."""
+    if spec not in CODEC_SPECS:
+        raise ValueError(f"Unknown wire codec '{spec}', expected one of {CODEC_SPECS}")
+    base, _, compression = spec.partition("+")
+    codec = _BASE_CODECS[base]
+    return ZlibCodec(codec) if compression else codec
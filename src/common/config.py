@@ -11,10 +11,15 @@ class NodeConfig:
     name: str
     address: str
     rank: int
-    world_size: int = 2  # Total number of nodes
+    world_size: int = 2  # Total number of nodes, set from NODES below
     master_addr: str = "0.0.0.0"  # Bind to all interfaces
     master_port: int = 29501  # Using a different port to avoid conflicts
     backend: str = "gloo"  # Using gloo as NCCL isn't available on macOS
+    compute_weight: float = 1.0  # Relative speed, used to balance layers across nodes
+    memory_limit_gb: Optional[float] = None  # Cap on this node's shard weights
+    memory_gb: Optional[float] = None  # Memory the node has for its stage, for src.plan_memory
+    prefix_cache_gb: Optional[float] = None  # Budget for cached prompt prefixes; default SERVER_CONFIG's
+    quantization: Optional[str] = None  # This stage's weight quantization; default MODEL_CONFIG's
 
 # Pre-configured nodes
 NODES: Dict[str, NodeConfig] = {
@@ -32,12 +37,47 @@ NODES: Dict[str, NodeConfig] = {
     )
 }
 
+# Ranks form a chain in NODES order, so the world size is simply the node count.
+for _node in NODES.values():
+    _node.world_size = len(NODES)
+
 # --- Model Agnostic Refactor ---
 
+# How each family's decoder layers are split for tensor parallelism (see
+# src/common/tensor_parallel.py), as paths relative to one layer.
+# "column" layers have their output features split across ranks (the value
+# is the number of equal parts the output is fused from, e.g. GPT-2's
+# q/k/v), "row" layers their input features, with the partial outputs summed
+# by an all-reduce. "head_attrs" on the "attention_path" module hold a head
+# count or width that becomes this rank's share.
+GPT2_TENSOR_PARALLEL = {
+    "column": {"attn.c_attn": 3, "mlp.c_fc": 1},
+    "row": ["attn.c_proj", "mlp.c_proj"],
+    "attention_path": "attn",
+    "head_attrs": ["num_heads", "split_size"],
+}
+GPTJ_TENSOR_PARALLEL = {
+    "column": {"attn.q_proj": 1, "attn.k_proj": 1, "attn.v_proj": 1, "mlp.fc_in": 1},
+    "row": ["attn.out_proj", "mlp.fc_out"],
+    "attention_path": "attn",
+    "head_attrs": ["num_attention_heads"],
+}
+OPT_TENSOR_PARALLEL = {
+    "column": {"self_attn.q_proj": 1, "self_attn.k_proj": 1, "self_attn.v_proj": 1, "fc1": 1},
+    "row": ["self_attn.out_proj", "fc2"],
+    "attention_path": "self_attn",
+    "head_attrs": ["num_heads"],
+}
+
 # A registry to hold the architectural details for different model families.
-# This allows the sharding and pipeline logic to be generic.
+# This allows the sharding and pipeline logic to be generic. Optional keys:
+# "positional_embedding_offset" (added to position ids before the lookup),
+# "project_in_path"/"project_out_path" (OPT's embedding projections) and
+# "cache_kwarg" (the name under which decoder layers take the KV cache) and
+# "tensor_parallel" (one of the layouts above).
 MODEL_REGISTRY = {
     "gpt2": {
+        "model_type": "gpt2",
         "num_layers_key": "n_layer",
         "hidden_size_key": "n_embd",
         "layers_path": "transformer.h",
@@ -45,8 +85,10 @@ MODEL_REGISTRY = {
         "positional_embedding_path": "transformer.wpe",
         "final_norm_path": "transformer.ln_f",
         "lm_head_path": "lm_head",
+        "tensor_parallel": GPT2_TENSOR_PARALLEL,
     },
     "distilgpt2": {
+        "model_type": "gpt2",
         "num_layers_key": "n_layer",
         "hidden_size_key": "n_embd",
         "layers_path": "transformer.h",
@@ -54,8 +96,10 @@ MODEL_REGISTRY = {
         "positional_embedding_path": "transformer.wpe",
         "final_norm_path": "transformer.ln_f",
         "lm_head_path": "lm_head",
+        "tensor_parallel": GPT2_TENSOR_PARALLEL,
     },
     "gpt2-medium": {
+        "model_type": "gpt2",
         "num_layers_key": "n_layer",
         "hidden_size_key": "n_embd",
         "layers_path": "transformer.h",
@@ -63,8 +107,10 @@ MODEL_REGISTRY = {
         "positional_embedding_path": "transformer.wpe",
         "final_norm_path": "transformer.ln_f",
         "lm_head_path": "lm_head",
+        "tensor_parallel": GPT2_TENSOR_PARALLEL,
     },
     "gpt2-large": {
+        "model_type": "gpt2",
         "num_layers_key": "n_layer",
         "hidden_size_key": "n_embd",
         "layers_path": "transformer.h",
@@ -72,8 +118,10 @@ MODEL_REGISTRY = {
         "positional_embedding_path": "transformer.wpe",
         "final_norm_path": "transformer.ln_f",
         "lm_head_path": "lm_head",
+        "tensor_parallel": GPT2_TENSOR_PARALLEL,
     },
     "gpt2-xl": {
+        "model_type": "gpt2",
         "num_layers_key": "n_layer",
         "hidden_size_key": "n_embd",
         "layers_path": "transformer.h",
@@ -81,33 +129,45 @@ MODEL_REGISTRY = {
         "positional_embedding_path": "transformer.wpe",
         "final_norm_path": "transformer.ln_f",
         "lm_head_path": "lm_head",
+        "tensor_parallel": GPT2_TENSOR_PARALLEL,
     },
     "EleutherAI/gpt-j-6B": {
+        "model_type": "gptj",
         "num_layers_key": "n_layer",
         "hidden_size_key": "n_embd",
         "layers_path": "transformer.h",
         "embedding_path": "transformer.wte",
-        "positional_embedding_path": "transformer.wpe",
+        "positional_embedding_path": None,  # Rotary positions are applied inside attention
         "final_norm_path": "transformer.ln_f",
         "lm_head_path": "lm_head",
+        "cache_kwarg": "layer_past",
+        "tensor_parallel": GPTJ_TENSOR_PARALLEL,
     },
     "facebook/opt-125m": {
+        "model_type": "opt",
         "num_layers_key": "num_hidden_layers",
         "hidden_size_key": "hidden_size",
         "layers_path": "model.decoder.layers",
         "embedding_path": "model.decoder.embed_tokens",
         "positional_embedding_path": "model.decoder.embed_positions",
+        "positional_embedding_offset": 2,
         "final_norm_path": "model.decoder.final_layer_norm",
         "lm_head_path": "lm_head",
+        "tensor_parallel": OPT_TENSOR_PARALLEL,
     },
     "facebook/opt-350m": {
+        "model_type": "opt",
         "num_layers_key": "num_hidden_layers",
         "hidden_size_key": "hidden_size",
         "layers_path": "model.decoder.layers",
         "embedding_path": "model.decoder.embed_tokens",
         "positional_embedding_path": "model.decoder.embed_positions",
+        "positional_embedding_offset": 2,
         "final_norm_path": "model.decoder.final_layer_norm",
         "lm_head_path": "lm_head",
+        "project_in_path": "model.decoder.project_in",
+        "project_out_path": "model.decoder.project_out",
+        "tensor_parallel": OPT_TENSOR_PARALLEL,
     },
 }
 
@@ -122,6 +182,104 @@ MODEL_CONFIG = {
     "model_arch_config": MODEL_REGISTRY[CURRENT_MODEL],
     "device": "mps",
     "dtype": "float16",
+    # "balanced" uses the cost-model partitioner, "even" splits layers evenly.
+    "partition": os.environ.get("PARTITION", "balanced"),
+    # Encoding of activations between stages, see src/common/codecs.py
+    # ("none", "fp16", "bf16", "int8", optionally with "+zlib").
+    "wire_codec": os.environ.get("WIRE_CODEC", "none"),
+    # Stages whose nodes share an address pass activations through shared
+    # memory instead of gloo. Must match on every node.
+    "shared_memory_transport": os.environ.get("SHARED_MEMORY_TRANSPORT", "1") != "0",
+    # Where pre-sharded checkpoints are read from and written to (e.g.
+    # ~/.cache/mac-mini-connect/shards); empty, the default, disables it.
+    "shard_cache_dir": os.environ.get("SHARD_CACHE_DIR", ""),
+    # Speculative decoding (see src/common/speculative.py): a small model from
+    # MODEL_REGISTRY that rank 0 runs whole to propose "num_draft_tokens"
+    # tokens per pipeline pass. Empty disables it.
+    "draft_model": os.environ.get("DRAFT_MODEL", ""),
+    "num_draft_tokens": int(os.environ.get("NUM_DRAFT_TOKENS", "4")),
+    # "pipeline" gives every rank a range of layers; "tensor" gives every rank
+    # a slice of every layer (see src/common/tensor_parallel.py), which cuts
+    # single-request latency at the cost of two all-reduces per layer.
+    "parallelism": os.environ.get("PARALLELISM", "pipeline"),
+    # Weight-only quantization of each shard's decoder layers at load time
+    # (see src/common/quantization.py): "none", "int8", or "int4" with one
+    # scale per "quantization_group_size" weights. A node's NodeConfig can
+    # override it for its own stage.
+    "quantization": os.environ.get("QUANTIZATION", "none"),
+    "quantization_group_size": int(os.environ.get("QUANTIZATION_GROUP_SIZE", "64")),
+    # Where pipeline workers get their weights: "local" reads each node's own
+    # copy of the checkpoint; "stream" has rank 0 read it once and stream each
+    # worker exactly its shard over the process group, in chunks of
+    # "stream_chunk_mb", so workers need no model cache at all.
+    "weight_source": os.environ.get("WEIGHT_SOURCE", "local"),
+    "stream_chunk_mb": int(os.environ.get("STREAM_CHUNK_MB", "64")),
+}
+
+# How batches are scheduled through the pipeline stages. "gpipe" splits each
+# batch into micro-batches so all stages work concurrently; "sequential"
+# pushes the whole batch through one stage at a time.
+PIPELINE_CONFIG = {
+    "schedule": os.environ.get("PIPELINE_SCHEDULE", "gpipe"),
+    "num_micro_batches": int(os.environ.get("NUM_MICRO_BATCHES", "4")),
+}
+
+# The continuous-batching server on rank 0 (see src/common/serving.py).
+# Requests are spread over "num_groups" decode batches that are in flight
+# at the same time (0 means one per pipeline stage), each holding at most
+# "max_batch_size" sequences.
+SERVER_CONFIG = {
+    "host": os.environ.get("SERVER_HOST", "127.0.0.1"),
+    "port": int(os.environ.get("SERVER_PORT", "8000")),
+    "max_batch_size": int(os.environ.get("MAX_BATCH_SIZE", "8")),
+    "num_groups": int(os.environ.get("NUM_BATCH_GROUPS", "0")),
+    "default_max_new_tokens": int(os.environ.get("DEFAULT_MAX_NEW_TOKENS", "64")),
+    # Prompt-prefix KV cache (see src/common/prefix_cache.py): prompts are
+    # matched in blocks of "prefix_block_size" tokens, and each node keeps at
+    # most "prefix_cache_gb" of them unless its NodeConfig says otherwise.
+    # 0 disables it.
+    "prefix_cache_gb": float(os.environ.get("PREFIX_CACHE_GB", "1")),
+    "prefix_block_size": int(os.environ.get("PREFIX_BLOCK_SIZE", "16")),
+}
+
+# Long-running stage workers (see src/stage_daemon.py). Rank 0 takes jobs on
+# this address, and broadcasts a no-op after "heartbeat_seconds" without one
+# so idle workers never reach the process group's timeout.
+DAEMON_CONFIG = {
+    "host": os.environ.get("DAEMON_HOST", "127.0.0.1"),
+    "port": int(os.environ.get("DAEMON_PORT", "8100")),
+    "heartbeat_seconds": float(os.environ.get("DAEMON_HEARTBEAT_SECONDS", "60")),
+}
+
+# Span tracing (see src/common/tracing.py). Each rank keeps its last
+# "buffer_size" spans, and entry points gather them into one Chrome trace at
+# "output" on rank 0 when they finish. Must match on every node.
+TRACE_CONFIG = {
+    "enabled": os.environ.get("TRACE", "0") != "0",
+    "buffer_size": int(os.environ.get("TRACE_BUFFER_SIZE", "100000")),
+    "output": os.environ.get("TRACE_OUTPUT", "trace.json"),
+}
+
+# Live metrics (see src/common/metrics.py). Every "interval_seconds" rank 0
+# gathers each rank's counters over a separate process group and serves them
+# in Prometheus text format at http://host:port/metrics. Must match on every
+# node.
+METRICS_CONFIG = {
+    "enabled": os.environ.get("METRICS", "0") != "0",
+    "host": os.environ.get("METRICS_HOST", "127.0.0.1"),
+    "port": int(os.environ.get("METRICS_PORT", "9400")),
+    "interval_seconds": float(os.environ.get("METRICS_INTERVAL_SECONDS", "5")),
+}
+
+# Adaptive rebalancing of pipeline generation (see src/common/rebalancing.py).
+# Every "interval_steps" decode steps the ranks compare their stage compute
+# times, and when the slowest stage is more than "threshold" times the mean,
+# one of its boundary layers (weights and KV cache) moves to a neighbour.
+# Must match on every node.
+REBALANCE_CONFIG = {
+    "enabled": os.environ.get("REBALANCE", "0") != "0",
+    "interval_steps": int(os.environ.get("REBALANCE_INTERVAL_STEPS", "16")),
+    "threshold": float(os.environ.get("REBALANCE_THRESHOLD", "1.15")),
 }
 
 
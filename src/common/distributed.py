@@ -6,6 +6,8 @@ import torch
 import torch.distributed as dist
 from typing import Optional
 from .config import NodeConfig
+from .metrics import start_metrics, stop_metrics
+from .tracing import start_tracing
 
 def setup_distributed(node_config: NodeConfig) -> None:
     """
@@ -26,10 +28,13 @@ def setup_distributed(node_config: NodeConfig) -> None:
         world_size=node_config.world_size,
         rank=node_config.rank
     )
+    start_tracing(node_config)
+    start_metrics(node_config)
 
 def cleanup_distributed() -> None:
     """Clean up the distributed environment."""
     if dist.is_initialized():
+        stop_metrics()
         dist.destroy_process_group()
 
 def is_master() -> bool:
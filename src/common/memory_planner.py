@@ -0,0 +1,210 @@
+"""
+Predict each pipeline stage's memory footprint before anything is loaded.
+
+Every stage is built on the meta device from the model's AutoConfig, pruned
+and quantized exactly as `load_partial_model` would, so its weight bytes are
+those of the real shard. On top of the weights a stage holds
+
+    its KV cache: keys and values for each of its layers, per token of
+        every sequence in the batch
+    activation buffers: the hidden states it receives and sends, the
+        residual, and the largest intermediate of one layer (the MLP's
+        inner width, or a prefill's attention scores) for the whole batch;
+        the last stage also holds a row of logits per sequence, and a
+        quantized stage a dequantized copy of its largest weight
+
+Given each node's memory (its NodeConfig.memory_gb, else a default) less a
+fixed overhead for the interpreter and allocator, that is enough to tell
+how large a batch or how long a context every stage can take.
+"""
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+import torch
+from torch import nn
+from .config import MODEL_CONFIG, SERVER_CONFIG
+from .model_sharding import _build_empty_model, _prune_model, get_partition
+from .partitioner import get_stage_nodes
+from .quantization import QuantizedLinear, quantize_layers, stage_quantization
+from .utils import get_nested_attr, set_nested_attr
+
+@dataclass
+class StagePlan:
+    """One stage's predicted footprint, in bytes unless noted."""
+    rank: int
+    node: str
+    layers: Tuple[int, int]
+    quantization: str
+    weight_bytes: int
+    kv_bytes_per_token: int  # Per sequence
+    activation_bytes_per_sequence: int  # At the planned context length
+    activation_fixed_bytes: int  # Independent of the batch, e.g. dequantized weights
+    reserved_bytes: int  # Overhead and prefix cache
+    budget_bytes: Optional[int]  # None if the node's memory is unknown
+    batch_size: int
+    seq_len: int
+    max_batch_size: Optional[int] = None  # At seq_len
+    max_context: Optional[int] = None  # At batch_size
+
+    @property
+    def kv_bytes(self) -> int:
+        return self.kv_bytes_per_token * self.seq_len * self.batch_size
+
+    @property
+    def activation_bytes(self) -> int:
+        return self.activation_bytes_per_sequence * self.batch_size + self.activation_fixed_bytes
+
+    @property
+    def total_bytes(self) -> int:
+        return self.weight_bytes + self.kv_bytes + self.activation_bytes + self.reserved_bytes
+
+    @property
+    def fits(self) -> Optional[bool]:
+        return None if self.budget_bytes is None else self.total_bytes <= self.budget_bytes
+
+def _shard_bytes(model: nn.Module, dtype: torch.dtype) -> int:
+    itemsize = torch.empty(0, dtype=dtype).element_size()
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        # Meta parameters carry the config's dtype; the shard is loaded as `dtype`.
+        total += tensor.numel() * (itemsize if tensor.is_floating_point() else tensor.element_size())
+    return total
+
+def _layer_widths(layers: nn.Module) -> Tuple[int, int]:
+    """The widest output of any linear layer, and the largest weight's element count."""
+    widest, largest = 0, 0
+    for module in layers.modules():
+        if isinstance(module, QuantizedLinear):
+            out_features, numel = module.out_features, module.out_features * module.in_features
+        elif isinstance(module, nn.Linear):
+            out_features, numel = module.out_features, module.weight.numel()
+        elif hasattr(module, "nf"):  # GPT-2's Conv1D
+            out_features, numel = module.nf, module.weight.numel()
+        else:
+            continue
+        widest, largest = max(widest, out_features), max(largest, numel)
+    return widest, largest
+
+def _activation_bytes(config, arch_config: dict, itemsize: int, inner_width: int, seq_len: int,
+                      is_last: bool) -> int:
+    """Peak activation bytes of one sequence of `seq_len` tokens passing through a stage."""
+    hidden_size = get_nested_attr(config, arch_config["hidden_size_key"])
+    heads = config.num_attention_heads
+    # Received and sent hidden states, the residual, and the biggest intermediate.
+    per_token = 3 * hidden_size + max(inner_width, heads * seq_len)
+    nbytes = seq_len * per_token * itemsize
+    if is_last:
+        # Only the last position's logits are projected, and sampled in float32.
+        nbytes += config.vocab_size * 4
+    return nbytes
+
+def _max_context(batch_size: int, free: int, sequence_bytes, limit: int) -> int:
+    """The longest context, up to `limit`, at which `batch_size` sequences fit in `free` bytes."""
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if batch_size * sequence_bytes(middle) <= free:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def plan_memory(
+    config,
+    world_size: int,
+    batch_size: int = 1,
+    seq_len: int = 1024,
+    ranges: Optional[Sequence[Tuple[int, int]]] = None,
+    memory_gb: Optional[float] = None,
+    overhead_gb: float = 1.0,
+    serving: bool = False,
+) -> List[StagePlan]:
+    """
+    Plan every stage of MODEL_CONFIG's model for `world_size` pipeline
+    ranks, holding `batch_size` sequences of `seq_len` tokens (prompt plus
+    generated).
+
+    `ranges` proposes a partition (default: the one `load_partial_model`
+    would use). A node's memory is its NodeConfig.memory_gb, else
+    `memory_gb`; with neither its limits are not reported. `overhead_gb` is
+    set aside on every node, and with `serving` also its prefix cache budget.
+    """
+    arch_config = MODEL_CONFIG["model_arch_config"]
+    dtype = getattr(torch, MODEL_CONFIG["dtype"])
+    itemsize = torch.empty(0, dtype=dtype).element_size()
+    hidden_size = get_nested_attr(config, arch_config["hidden_size_key"])
+    max_positions = getattr(config, "max_position_embeddings", None) or seq_len
+    num_layers = get_nested_attr(config, arch_config["num_layers_key"])
+    ranges = list(ranges or get_partition(config, world_size))
+    if len(ranges) != world_size:
+        raise ValueError(f"The partition has {len(ranges)} stages, expected {world_size}")
+    bounds = [0] + [end for _, end in ranges]
+    if [start for start, _ in ranges] != bounds[:-1] or bounds[-1] != num_layers or \
+            any(start >= end for start, end in ranges):
+        raise ValueError(f"The partition {ranges} must split layers 0-{num_layers} into contiguous, non-empty ranges")
+
+    plans = []
+    for rank, (node, (start, end)) in enumerate(zip(get_stage_nodes(world_size), ranges)):
+        quantization = stage_quantization(node)
+        model = _build_empty_model(config)
+        _prune_model(model, arch_config, start, end, rank, world_size)
+        if getattr(config, "tie_word_embeddings", False) and world_size == 1:
+            # As in load_partial_model, a single stage shares the tied tensor.
+            set_nested_attr(model, f"{arch_config['lm_head_path']}.weight",
+                            get_nested_attr(model, f"{arch_config['embedding_path']}.weight"))
+        layers = get_nested_attr(model, arch_config["layers_path"])
+        quantize_layers(layers, quantization)
+        inner_width, largest_weight = _layer_widths(layers)
+        is_last = rank == world_size - 1
+        kv_bytes_per_token = 2 * (end - start) * hidden_size * itemsize
+
+        def sequence_bytes(tokens):
+            return kv_bytes_per_token * tokens + _activation_bytes(
+                config, arch_config, itemsize, inner_width, tokens, is_last)
+
+        node_memory = node.memory_gb if node and node.memory_gb else memory_gb
+        reserved = overhead_gb
+        if serving:
+            prefix_cache_gb = node.prefix_cache_gb if node else None
+            reserved += SERVER_CONFIG["prefix_cache_gb"] if prefix_cache_gb is None else prefix_cache_gb
+        plan = StagePlan(
+            rank=rank,
+            node=node.name if node else f"rank{rank}",
+            layers=(start, end),
+            quantization=quantization,
+            weight_bytes=_shard_bytes(model, dtype),
+            kv_bytes_per_token=kv_bytes_per_token,
+            activation_bytes_per_sequence=_activation_bytes(config, arch_config, itemsize, inner_width, seq_len,
+                                                            is_last),
+            activation_fixed_bytes=largest_weight * itemsize if quantization != "none" else 0,
+            reserved_bytes=int(reserved * 1024**3),
+            budget_bytes=int(node_memory * 1024**3) if node_memory else None,
+            batch_size=batch_size,
+            seq_len=seq_len,
+        )
+        if plan.budget_bytes is not None:
+            free = plan.budget_bytes - plan.weight_bytes - plan.reserved_bytes - plan.activation_fixed_bytes
+            plan.max_batch_size = max(free // sequence_bytes(seq_len), 0)
+            plan.max_context = _max_context(batch_size, free, sequence_bytes, max_positions)
+        plans.append(plan)
+    return plans
+
+def format_plan(plans: List[StagePlan]) -> str:
+    """A table of the plans, one row per stage, sizes in GB."""
+    def gb(nbytes):
+        return f"{nbytes / 1024**3:.2f}"
+
+    header = ["rank", "node", "layers", "quant", "weights", "kv cache", "activations", "reserved", "total",
+              "memory", "fits", "max batch", "max context"]
+    rows = [header]
+    for plan in plans:
+        rows.append([
+            str(plan.rank), plan.node, f"{plan.layers[0]}-{plan.layers[1]}", plan.quantization,
+            gb(plan.weight_bytes), gb(plan.kv_bytes), gb(plan.activation_bytes), gb(plan.reserved_bytes),
+            gb(plan.total_bytes),
+            "?" if plan.budget_bytes is None else gb(plan.budget_bytes),
+            "?" if plan.fits is None else ("yes" if plan.fits else "NO"),
+            "?" if plan.max_batch_size is None else str(plan.max_batch_size),
+            "?" if plan.max_context is None else str(plan.max_context),
+        ])
+    widths = [max(len(row[column]) for row in rows) for column in range(len(header))]
+    return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
@@ -0,0 +1,263 @@
+"""
+Live performance metrics, aggregated on rank 0 and served to Prometheus.
+
+With METRICS=1 every rank keeps counters, gauges and histograms:
+
+    pipeline_span_seconds{span}  histogram of every traced span (see
+        tracing.py): stage forward passes, sends, receives, sampling, ...
+    pipeline_busy_seconds_total  time in forward passes and sampling
+    pipeline_wait_seconds_total  time blocked on the transport, which is
+        idle time for this stage
+    pipeline_bytes_{sent,received}_total{peer}
+    pipeline_tokens_generated_total  (rank 0)
+    pipeline_queue_depth, pipeline_active_sequences  (rank 0's server)
+    pipeline_kv_cache_bytes, pipeline_prefix_cache_bytes  (servers)
+    pipeline_stage_layers  (with REBALANCE=1, see rebalancing.py)
+    process_resident_memory_bytes
+
+A background thread on each rank sends a snapshot to rank 0 every
+METRICS_CONFIG["interval_seconds"] over a process group of its own, so it
+never gets in the way of the pipeline's traffic. Rank 0 labels each series
+with its rank and node, adds per-interval rates (pipeline_utilization,
+pipeline_tokens_per_second and pipeline_{send,receive}_bytes_per_second,
+the link bandwidth actually used) and serves the lot at
+http://METRICS_CONFIG["host"]:METRICS_CONFIG["port"]/metrics.
+
+A stage whose utilization is high while its neighbours wait is the slow one.
+"""
+import datetime
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+import psutil
+import torch.distributed as dist
+from .config import METRICS_CONFIG, NodeConfig
+
+# Name: (Prometheus type, help text)
+METRICS = {
+    "pipeline_span_seconds": ("histogram", "Duration of traced spans"),
+    "pipeline_busy_seconds_total": ("counter", "Seconds spent in forward passes and sampling"),
+    "pipeline_wait_seconds_total": ("counter", "Seconds spent blocked on the transport"),
+    "pipeline_bytes_sent_total": ("counter", "Bytes put on the wire, by peer rank"),
+    "pipeline_bytes_received_total": ("counter", "Bytes taken off the wire, by peer rank"),
+    "pipeline_tokens_generated_total": ("counter", "Tokens generated"),
+    "pipeline_queue_depth": ("gauge", "Requests waiting to be scheduled"),
+    "pipeline_active_sequences": ("gauge", "Sequences being decoded"),
+    "pipeline_kv_cache_bytes": ("gauge", "Bytes held in decode batches' KV caches"),
+    "pipeline_prefix_cache_bytes": ("gauge", "Bytes held in the prompt-prefix cache"),
+    "pipeline_stage_layers": ("gauge", "Decoder layers this stage runs, after any rebalancing"),
+    "process_resident_memory_bytes": ("gauge", "Resident set size of the rank's process"),
+    "pipeline_utilization": ("gauge", "Fraction of the last interval spent busy"),
+    "pipeline_tokens_per_second": ("gauge", "Tokens generated per second over the last interval"),
+    "pipeline_send_bytes_per_second": ("gauge", "Bytes sent per second over the last interval, by peer rank"),
+    "pipeline_receive_bytes_per_second": ("gauge", "Bytes received per second over the last interval, by peer rank"),
+}
+# Gauges rank 0 derives from the change in a counter over each interval.
+RATES = {
+    "pipeline_busy_seconds_total": "pipeline_utilization",
+    "pipeline_tokens_generated_total": "pipeline_tokens_per_second",
+    "pipeline_bytes_sent_total": "pipeline_send_bytes_per_second",
+    "pipeline_bytes_received_total": "pipeline_receive_bytes_per_second",
+}
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+BUSY_CATEGORIES = ("compute", "sampling")
+WAIT_CATEGORIES = ("transport",)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+_gauges: Dict[Tuple[str, Labels], float] = {}
+# Per-bucket counts, then the sum of the observations.
+_histograms: Dict[Tuple[str, Labels], List[float]] = {}
+_local = threading.local()
+
+def metrics_enabled() -> bool:
+    return METRICS_CONFIG["enabled"]
+
+def _key(name: str, labels: dict) -> Tuple[str, Labels]:
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name: str, value: float = 1.0, **labels) -> None:
+    """Add `value` to a counter."""
+    if METRICS_CONFIG["enabled"]:
+        with _lock:
+            _counters[_key(name, labels)] += value
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    if METRICS_CONFIG["enabled"]:
+        with _lock:
+            _gauges[_key(name, labels)] = value
+
+def observe(name: str, value: float, **labels) -> None:
+    """Add an observation to a histogram."""
+    if not METRICS_CONFIG["enabled"]:
+        return
+    with _lock:
+        histogram = _histograms.setdefault(_key(name, labels), [0.0] * (len(BUCKETS) + 1))
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[index] += 1
+                break
+        histogram[-1] += value
+
+def waited_so_far() -> float:
+    """Seconds this thread has spent in transport spans; lets enclosing spans subtract them."""
+    return getattr(_local, "waited", 0.0)
+
+def record_span(name: str, category: str, seconds: float, waited_at_start: float) -> None:
+    """Account a finished span, given `waited_so_far()` from when it started."""
+    observe("pipeline_span_seconds", seconds, span=name)
+    if category in WAIT_CATEGORIES:
+        inc("pipeline_wait_seconds_total", seconds)
+        _local.waited = waited_so_far() + seconds
+    elif category in BUSY_CATEGORIES:
+        # A tensor parallel forward pass includes its all-reduces, which are waiting.
+        inc("pipeline_busy_seconds_total", seconds - (waited_so_far() - waited_at_start))
+
+def snapshot() -> dict:
+    """This rank's metrics, as plain data."""
+    set_gauge("process_resident_memory_bytes", psutil.Process().memory_info().rss)
+    with _lock:
+        return {
+            "time": time.monotonic(),
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "histograms": {key: list(values) for key, values in _histograms.items()},
+        }
+
+def reset_metrics() -> None:
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+def render(ranks: List[dict], previous: Optional[List[dict]] = None) -> str:
+    """
+    Prometheus text for every rank's {"rank", "node", "snapshot"}, with
+    rates over the interval since `previous` (the last call's `ranks`).
+    """
+    series: Dict[str, List[str]] = defaultdict(list)
+    for index, rank in enumerate(ranks):
+        snap = rank["snapshot"]
+        extra = (("node", rank["node"]), ("rank", str(rank["rank"])))
+        for (name, labels), value in snap["counters"].items():
+            series[name].append(f"{name}{_format_labels(labels + extra)} {value:.9g}")
+        for (name, labels), value in snap["gauges"].items():
+            series[name].append(f"{name}{_format_labels(labels + extra)} {value:.9g}")
+        for (name, labels), values in snap["histograms"].items():
+            cumulative = 0.0
+            for bound, count in zip(BUCKETS, values):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                series[name].append(f"{name}_bucket{_format_labels(labels + extra + (('le', le),))} {cumulative:.9g}")
+            series[name].append(f"{name}_sum{_format_labels(labels + extra)} {values[-1]:.9g}")
+            series[name].append(f"{name}_count{_format_labels(labels + extra)} {cumulative:.9g}")
+
+        if previous and index < len(previous):
+            before = previous[index]["snapshot"]
+            elapsed = snap["time"] - before["time"]
+            for (name, labels), value in snap["counters"].items():
+                if name in RATES and elapsed > 0:
+                    rate = (value - before["counters"].get((name, labels), 0.0)) / elapsed
+                    series[RATES[name]].append(f"{RATES[name]}{_format_labels(labels + extra)} {rate:.9g}")
+
+    lines = []
+    for name in sorted(series):
+        kind, description = METRICS.get(name, ("untyped", name))
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}", *series[name]]
+    return "\n".join(lines) + "\n"
+
+class _Aggregator:
+    """Each rank's background thread; rank 0's also keeps the latest text and serves it."""
+
+    def __init__(self, node_config: NodeConfig):
+        self.node_config = node_config
+        self.stopping = threading.Event()
+        self.text = "\n"
+        self.previous: Optional[List[dict]] = None
+        self.server: Optional[ThreadingHTTPServer] = None
+        interval = METRICS_CONFIG["interval_seconds"]
+        # A group of its own keeps these collectives apart from the pipeline's.
+        self.group = dist.new_group(backend="gloo", timeout=datetime.timedelta(seconds=max(60.0, 4 * interval))) \
+            if node_config.world_size > 1 else None
+        self.thread = threading.Thread(target=self._loop, name="metrics", daemon=True)
+
+    def _loop(self) -> None:
+        rank, world_size = self.node_config.rank, self.node_config.world_size
+        while True:
+            # Stopping wakes the thread for one last round; every rank then agrees to end.
+            stopping = self.stopping.wait(METRICS_CONFIG["interval_seconds"])
+            local = {"rank": rank, "node": self.node_config.name, "stopping": stopping, "snapshot": snapshot()}
+            try:
+                if self.group is not None:
+                    gathered = [None] * world_size if rank == 0 else None
+                    dist.gather_object(local, gathered, dst=0, group=self.group)
+                    decision = [any(entry["stopping"] for entry in gathered)] if rank == 0 else [None]
+                    dist.broadcast_object_list(decision, src=0, group=self.group)
+                else:
+                    gathered, decision = [local], [stopping]
+            except RuntimeError as e:
+                # A rank went away; the pipeline will notice on its own.
+                print(f"[metrics] Stopped aggregating on rank {rank}: {e}", flush=True)
+                return
+            if rank == 0:
+                self.text = render(gathered, self.previous)
+                self.previous = gathered
+            if decision[0]:
+                return
+
+    def serve(self) -> None:
+        aggregator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = aggregator.text.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((METRICS_CONFIG["host"], METRICS_CONFIG["port"]), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+
+_aggregator: Optional[_Aggregator] = None
+
+def start_metrics(node_config: NodeConfig) -> None:
+    """Start this rank's aggregation thread, and rank 0's endpoint; called by setup_distributed."""
+    global _aggregator
+    if not METRICS_CONFIG["enabled"] or _aggregator is not None:
+        return
+    _aggregator = _Aggregator(node_config)
+    if node_config.rank == 0:
+        _aggregator.serve()
+    _aggregator.thread.start()
+
+def stop_metrics() -> None:
+    """Finish the last round with the other ranks and close the endpoint; called by cleanup_distributed."""
+    global _aggregator
+    if _aggregator is None:
+        return
+    _aggregator.stopping.set()
+    # Another rank may be a whole interval away from its next round.
+    _aggregator.thread.join(timeout=2 * METRICS_CONFIG["interval_seconds"] + 10)
+    if _aggregator.server is not None:
+        _aggregator.server.shutdown()
+        _aggregator.server.server_close()
+    _aggregator = None
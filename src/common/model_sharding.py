@@ -3,14 +3,27 @@ Handles model sharding across multiple devices using pipeline parallelism.
 This implementation is model-agnostic and driven by configuration.
 """
 import torch
+import torch.distributed as dist
 from torch import nn
-from transformers import AutoModelForCausalLM, AutoConfig
-from typing import Optional, List, Tuple
+from transformers import AutoModelForCausalLM, AutoConfig, DynamicCache
+from typing import Callable, Iterator, Optional, List, Tuple
 import datetime
+import json
 import os
+import time
+from dataclasses import dataclass, field
 import psutil
-from .config import NodeConfig, MODEL_CONFIG
-from .utils import get_nested_attr, set_nested_attr
+from . import metrics
+from .config import NodeConfig, MODEL_CONFIG, REBALANCE_CONFIG
+from .partitioner import balanced_layer_ranges
+from .quantization import quantize_layers, stage_quantization
+from .rebalancing import Rebalancer
+from .sampling import make_generator, sample_tokens
+from .shard_cache import checkpoint_revision, shard_manifest, find_cached_shard, save_shard
+from .stage import PipelineStage
+from .tracing import span, traced
+from .transport import PipelineTransport, receive_tensors, stream_tensors
+from .utils import get_nested_attr, set_nested_attr, synchronize_device
 
 def _log(rank, message):
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
@@ -37,7 +50,7 @@ def check_cache(model_name: str) -> bool:
         return False
 
 def get_layer_ranges(total_layers: int, world_size: int) -> List[Tuple[int, int]]:
-    """Calculate layer ranges for each device."""
+    """Calculate even layer ranges for each device."""
     layers_per_device = total_layers // world_size
     ranges = []
     for i in range(world_size):
@@ -46,121 +59,481 @@ def get_layer_ranges(total_layers: int, world_size: int) -> List[Tuple[int, int]
         ranges.append((start, end))
     return ranges
 
-def load_partial_model(node_config: NodeConfig, device: Optional[str] = None) -> nn.Module:
+def get_partition(config, world_size: int) -> List[Tuple[int, int]]:
+    """Layer ranges for every rank, using the strategy in MODEL_CONFIG["partition"]."""
+    arch_config = MODEL_CONFIG["model_arch_config"]
+    strategy = MODEL_CONFIG.get("partition", "even")
+    if strategy == "balanced":
+        return balanced_layer_ranges(config, arch_config, getattr(torch, MODEL_CONFIG["dtype"]), world_size)
+    if strategy == "even":
+        return get_layer_ranges(get_nested_attr(config, arch_config["num_layers_key"]), world_size)
+    raise ValueError(f"Unknown partition strategy '{strategy}', expected 'balanced' or 'even'")
+
+def get_shard_module_paths(arch_config: dict, start: int, end: int, rank: int, world_size: int) -> List[str]:
     """
-    Load only the layers and modules assigned to this node based on the
-    model's architecture config.
+    List the module paths whose weights belong to a rank: its slice of the
+    transformer layers, plus the input modules on the first rank and the
+    output modules on the last rank.
     """
-    model_name = MODEL_CONFIG["model_name"]
-    arch_config = MODEL_CONFIG["model_arch_config"]
-    device = device or MODEL_CONFIG["device"]
-    dtype = getattr(torch, MODEL_CONFIG["dtype"])
+    paths = [f"{arch_config['layers_path']}.{i}" for i in range(start, end)]
+    if rank == 0:
+        paths.append(arch_config["embedding_path"])
+        if arch_config.get("positional_embedding_path"):
+            paths.append(arch_config["positional_embedding_path"])
+        if arch_config.get("project_in_path"):
+            paths.append(arch_config["project_in_path"])
+    if rank == world_size - 1:
+        paths += [arch_config["final_norm_path"], arch_config["lm_head_path"]]
+        if arch_config.get("project_out_path"):
+            paths.append(arch_config["project_out_path"])
+    return paths
+
+def get_shard_parameter_names(model: nn.Module, arch_config: dict, start: int, end: int, rank: int, world_size: int) -> List[str]:
+    """
+    Names (as in the unpruned model's state dict) of the parameters a rank
+    needs. Parameters outside every arch path are kept on all ranks.
+    """
+    owned = get_shard_module_paths(arch_config, start, end, rank, world_size)
+    all_paths = [
+        arch_config[key] for key in (
+            "layers_path", "embedding_path", "positional_embedding_path",
+            "final_norm_path", "lm_head_path", "project_in_path", "project_out_path",
+        ) if arch_config.get(key)
+    ]
 
-    config = AutoConfig.from_pretrained(model_name)
-    num_layers = get_nested_attr(config, arch_config["num_layers_key"])
+    def under(name, paths):
+        return any(name.startswith(path + ".") for path in paths)
 
-    ranges = get_layer_ranges(num_layers, node_config.world_size)
-    my_start, my_end = ranges[node_config.rank]
-    
-    _log(node_config.rank, f"Node {node_config.name} loading layers {my_start} to {my_end}")
+    return [
+        name for name, _ in model.named_parameters(remove_duplicate=False)
+        if under(name, owned) or not under(name, all_paths)
+    ]
 
-    is_cached = check_cache(model_name)
-    _log(node_config.rank, f"1a. Model '{model_name}' appears to be cached: {is_cached}")
+def _find_safetensors_files(model_name: str) -> Optional[List[str]]:
+    """
+    Locate the safetensors checkpoint files for a model, either in a local
+    directory or through the Hugging Face cache. Returns None if the model
+    has no safetensors weights.
+    """
+    from huggingface_hub import hf_hub_download
 
-    # Log memory before loading
-    mem_before = psutil.virtual_memory()
-    _log(node_config.rank, f"1b. Memory before loading: {mem_before.used / (1024**3):.2f} GB used / {mem_before.total / (1024**3):.2f} GB total")
+    def fetch(filename):
+        if os.path.isdir(model_name):
+            path = os.path.join(model_name, filename)
+            return path if os.path.exists(path) else None
+        try:
+            return hf_hub_download(model_name, filename)
+        except Exception:
+            return None
 
-    _log(node_config.rank, "1c. Loading full model with from_pretrained...")
-    full_model = AutoModelForCausalLM.from_pretrained(
-        model_name, torch_dtype=dtype, low_cpu_mem_usage=True
-    )
-    _log(node_config.rank, "1d. Model object created.")
+    index_file = fetch("model.safetensors.index.json")
+    if index_file:
+        with open(index_file) as f:
+            shard_files = sorted(set(json.load(f)["weight_map"].values()))
+        return [fetch(name) for name in shard_files]
+    single_file = fetch("model.safetensors")
+    return [single_file] if single_file else None
 
-    # Log memory after loading
-    mem_after = psutil.virtual_memory()
-    _log(node_config.rank, f"1e. Memory after loading: {mem_after.used / (1024**3):.2f} GB used / {mem_after.total / (1024**3):.2f} GB total")
-    _log(node_config.rank, f"   -> Memory consumed by model load: {(mem_after.used - mem_before.used) / (1024**3):.2f} GB")
+def _read_shard_tensors(model: nn.Module, files: List[str], names: List[str], dtype: torch.dtype,
+                        arch_config: dict, config,
+                        transform: Optional[Callable[[str, torch.Tensor], torch.Tensor]] = None
+                        ) -> Iterator[Tuple[str, torch.Tensor]]:
+    """
+    Memory-map the checkpoint files and yield (name, tensor) for each of
+    `names`, in order, as `dtype`. `transform(name, tensor)`, if given, cuts
+    each tensor down as soon as it is read.
+    """
+    from safetensors import safe_open
 
-    _log(node_config.rank, "2. Deep-copying model structure...")
-    import copy
-    model = copy.deepcopy(full_model)
-    _log(node_config.rank, "2. Deep-copy complete.")
+    handles = [safe_open(path, framework="pt") for path in files]
+    key_to_handle = {key: handle for handle in handles for key in handle.keys()}
 
-    _log(node_config.rank, "3. Pruning unused layers...")
-    all_layers = get_nested_attr(full_model, arch_config["layers_path"])
-    
-    layers_to_keep = all_layers[my_start:my_end]
-    set_nested_attr(model, arch_config["layers_path"], layers_to_keep)
+    # Hub checkpoints are often saved from the base model, without its prefix.
+    prefix = getattr(model, "base_model_prefix", "") + "."
+    tied_weights = {}
+    if getattr(config, "tie_word_embeddings", False):
+        tied_weights[f"{arch_config['lm_head_path']}.weight"] = f"{arch_config['embedding_path']}.weight"
+
+    def checkpoint_key(name):
+        candidates = [name, name[len(prefix):] if name.startswith(prefix) else None]
+        if name in tied_weights:
+            candidates += checkpoint_key(tied_weights[name])
+        return [key for key in candidates if key]
+
+    for name in names:
+        key = next((key for key in checkpoint_key(name) if key in key_to_handle), None)
+        if key is None:
+            raise KeyError(f"Parameter '{name}' not found in checkpoint files {files}")
+        tensor = key_to_handle[key].get_tensor(key)
+        if transform is not None:
+            tensor = transform(name, tensor)
+        # Quantized weights keep their integer types.
+        yield name, tensor.to(dtype) if tensor.is_floating_point() else tensor
+
+@traced("read_weights", "load")
+def _load_shard_weights(model: nn.Module, files: List[str], names: List[str], dtype: torch.dtype,
+                        arch_config: dict, config,
+                        transform: Optional[Callable[[str, torch.Tensor], torch.Tensor]] = None) -> None:
+    """
+    Copy only `names` from the checkpoint files into the (meta) model,
+    leaving every other parameter unmaterialized; see _read_shard_tensors.
+    """
+    state_dict = dict(_read_shard_tensors(model, files, names, dtype, arch_config, config, transform))
+    model.load_state_dict(state_dict, strict=False, assign=True)
+
+def _streamed_parameters(model: nn.Module, names: List[str], dtype: torch.dtype) -> List[Tuple[str, torch.Size, torch.dtype]]:
+    """The (name, shape, dtype) of every tensor streamed for `names`, which both ends work out alike."""
+    params = dict(model.named_parameters(remove_duplicate=False))
+    return [
+        (name, params[name].shape, dtype if params[name].is_floating_point() else params[name].dtype)
+        for name in names
+    ]
+
+@traced("stream_weights", "load")
+def _stream_shard_weights(model: nn.Module, files: List[str], names: List[str], dtype: torch.dtype,
+                          arch_config: dict, config, dst: int) -> int:
+    """
+    Rank 0's side of weight streaming: read `names` from the checkpoint and
+    stream them to rank `dst`, which receives them with
+    _receive_shard_weights. `model` is an unpruned meta skeleton. Returns
+    the bytes sent.
+    """
+    expected = _streamed_parameters(model, names, dtype)
+    total_bytes = sum(shape.numel() * torch.empty(0, dtype=tensor_dtype).element_size()
+                      for _, shape, tensor_dtype in expected)
+
+    def checked():
+        for (name, tensor), (_, shape, tensor_dtype) in zip(
+                _read_shard_tensors(model, files, names, dtype, arch_config, config), expected):
+            if tensor.shape != shape or tensor.dtype != tensor_dtype:
+                raise ValueError(f"Checkpoint tensor '{name}' is {tensor.dtype} {tuple(tensor.shape)}, "
+                                 f"the model expects {tensor_dtype} {tuple(shape)}")
+            yield tensor
+
+    stream_tensors(checked(), dst, total_bytes, MODEL_CONFIG["stream_chunk_mb"] * 1024**2)
+    return total_bytes
+
+@traced("receive_weights", "load")
+def _receive_shard_weights(model: nn.Module, names: List[str], dtype: torch.dtype) -> int:
+    """
+    A worker's side of weight streaming: allocate `names` and fill them
+    straight from rank 0's stream. Returns the bytes received.
+    """
+    state_dict = {
+        name: torch.empty(shape, dtype=tensor_dtype)
+        for name, shape, tensor_dtype in _streamed_parameters(model, names, dtype)
+    }
+    receive_tensors(list(state_dict.values()), 0, MODEL_CONFIG["stream_chunk_mb"] * 1024**2)
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    return sum(tensor.numel() * tensor.element_size() for tensor in state_dict.values())
+
+@traced("prune", "load")
+def _prune_model(model: nn.Module, arch_config: dict, start: int, end: int, rank: int, world_size: int) -> None:
+    """Replace everything this rank does not own with identities, in place."""
+    all_layers = get_nested_attr(model, arch_config["layers_path"])
+    set_nested_attr(model, arch_config["layers_path"], all_layers[start:end])
 
     identity = nn.Identity()
 
-    if node_config.rank != 0:
+    if rank != 0:
         set_nested_attr(model, arch_config["embedding_path"], identity)
-        set_nested_attr(model, arch_config["positional_embedding_path"], identity)
+        if arch_config.get("positional_embedding_path"):
+            set_nested_attr(model, arch_config["positional_embedding_path"], identity)
         if arch_config.get("project_in_path"):
             set_nested_attr(model, arch_config["project_in_path"], identity)
 
-    if node_config.rank != node_config.world_size - 1:
+    if rank != world_size - 1:
         set_nested_attr(model, arch_config["final_norm_path"], identity)
         set_nested_attr(model, arch_config["lm_head_path"], identity)
         if arch_config.get("project_out_path"):
             set_nested_attr(model, arch_config["project_out_path"], identity)
 
-    _log(node_config.rank, "3. Pruning complete.")
+def _build_empty_model(config) -> nn.Module:
+    """Instantiate the model with parameters on the meta device (no memory)."""
+    from accelerate import init_empty_weights
 
-    _log(node_config.rank, "4. Deleting full model to free memory...")
-    del full_model, all_layers, layers_to_keep
-    _log(node_config.rank, "4. Deletion complete.")
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config)
+    # Unlike from_pretrained, from_config leaves the model in training mode.
+    return model.eval()
 
-    _log(node_config.rank, f"5. Moving sharded model to device '{device}'...")
-    model = model.to(device)
-    _log(node_config.rank, "5. Move to device complete.")
+def _stream_to_workers(config, ranges: List[Tuple[int, int]], rank: int, world_size: int, dtype: torch.dtype,
+                       needed: bool) -> None:
+    """
+    Have rank 0 read its checkpoint once and stream every worker that
+    `needed` it (no pre-sharded checkpoint of its own) the tensors of its
+    shard. Every rank must call this.
+    """
+    model_name = MODEL_CONFIG["model_name"]
+    arch_config = MODEL_CONFIG["model_arch_config"]
+    needs = [None] * world_size if rank == 0 else None
+    dist.gather_object(needed, needs, dst=0)
+    files = None
+    if rank == 0 and any(needs):
+        files = _find_safetensors_files(model_name)
+    # Every rank learns if rank 0 cannot stream, rather than waiting on it forever.
+    box = [None if rank != 0 or files or not any(needs) else
+           f"Streaming weights needs a safetensors checkpoint of '{model_name}' on rank 0"]
+    dist.broadcast_object_list(box, src=0)
+    if box[0]:
+        raise ValueError(box[0])
+    if rank != 0 or not files:
+        return
 
-    return model
+    skeleton = _build_empty_model(config)
+    for dst, (start, end) in enumerate(ranges):
+        if not needs[dst]:
+            continue
+        names = get_shard_parameter_names(skeleton, arch_config, start, end, dst, world_size)
+        _log(rank, f"0. Streaming {len(names)} tensors (layers {start} to {end}) to rank {dst}...")
+        begin = time.perf_counter()
+        nbytes = _stream_shard_weights(skeleton, files, names, dtype, arch_config, config, dst)
+        elapsed = time.perf_counter() - begin
+        _log(rank, f"0. Streamed {nbytes / 1024**2:.1f} MB to rank {dst} in {elapsed:.2f}s "
+                   f"({nbytes / 1024**2 / max(elapsed, 1e-9):.1f} MB/s)")
 
-def forward_sequence(model: nn.Module, inputs: torch.Tensor, node_config: NodeConfig) -> torch.Tensor:
+@traced("load_partial_model", "load")
+def load_partial_model(node_config: NodeConfig, device: Optional[str] = None) -> PipelineStage:
     """
-    Generic forward pass that handles the pipeline between nodes based on model config.
+    Load only the layers and modules assigned to this node based on the
+    model's architecture config.
+
+    The model skeleton is built on the meta device and only this rank's
+    tensors are read (memory-mapped) from the safetensors checkpoint, so
+    peak memory scales with the shard rather than the whole model.
+    Checkpoints without safetensors weights fall back to a full load.
+
+    With MODEL_CONFIG["weight_source"] set to "stream", only rank 0 reads
+    the checkpoint (and config): it streams every worker its shard, which
+    the worker writes straight into its skeleton, so workers need no copy
+    of the model.
+
+    If the stage is quantized (see stage_quantization), its decoder layers'
+    linear weights are converted once the shard is in memory.
+
+    If MODEL_CONFIG["shard_cache_dir"] is set, a pre-sharded checkpoint
+    matching this model's checkpoint revision, partition, dtype, quantization
+    and rank is loaded from there instead, and on a miss the freshly pruned (and quantized)
+    shard is written to it.
     """
+    model_name = MODEL_CONFIG["model_name"]
     arch_config = MODEL_CONFIG["model_arch_config"]
-    hidden_states = inputs
-
-    if node_config.rank == 0:
-        token_embedder = get_nested_attr(model, arch_config["embedding_path"])
-        pos_embedder = get_nested_attr(model, arch_config["positional_embedding_path"])
-        
-        token_embeddings = token_embedder(inputs)
-        
-        seq_length = inputs.size(1)
-        pos_ids = torch.arange(seq_length, device=inputs.device).unsqueeze(0)
-        
-        offset = arch_config.get("positional_embedding_offset", 0)
-        pos_embeddings = pos_embedder(pos_ids + offset)
-        
-        hidden_states = token_embeddings + pos_embeddings
-
-        if arch_config.get("project_in_path"):
-            project_in = get_nested_attr(model, arch_config["project_in_path"])
-            if project_in and not isinstance(project_in, nn.Identity):
-                hidden_states = project_in(hidden_states)
+    device = device or MODEL_CONFIG["device"]
+    dtype = getattr(torch, MODEL_CONFIG["dtype"])
+    rank, world_size = node_config.rank, node_config.world_size
 
-    layers = get_nested_attr(model, arch_config["layers_path"])
-    for layer in layers:
-        layer_outputs = layer(hidden_states, use_cache=False)
-        hidden_states = layer_outputs[0]
+    weight_source = MODEL_CONFIG["weight_source"]
+    if weight_source not in ("local", "stream"):
+        raise ValueError(f"Unknown weight source '{weight_source}', expected 'local' or 'stream'")
+    streaming = weight_source == "stream" and world_size > 1
+    cache_dir = MODEL_CONFIG.get("shard_cache_dir")
+    if streaming:
+        # Workers may have no copy of the model at all, not even its config,
+        # so rank 0 also vouches for the checkpoint their cached shards match.
+        box = [(AutoConfig.from_pretrained(model_name), checkpoint_revision(model_name) if cache_dir else None)
+               if rank == 0 else None]
+        dist.broadcast_object_list(box, src=0)
+        config, revision = box[0]
+    else:
+        config = AutoConfig.from_pretrained(model_name)
+        revision = checkpoint_revision(model_name) if cache_dir else None
 
-    if node_config.rank == node_config.world_size - 1:
-        if arch_config.get("project_out_path"):
-            project_out = get_nested_attr(model, arch_config["project_out_path"])
-            if project_out and not isinstance(project_out, nn.Identity):
-                hidden_states = project_out(hidden_states)
-
-        final_norm = get_nested_attr(model, arch_config["final_norm_path"])
-        lm_head = get_nested_attr(model, arch_config["lm_head_path"])
-        
-        hidden_states = final_norm(hidden_states)
-        logits = lm_head(hidden_states)
-        return logits
+    ranges = get_partition(config, world_size)
+    my_start, my_end = ranges[rank]
     
-    return hidden_states 
\ No newline at end of file
+    _log(rank, f"Node {node_config.name} loading layers {my_start} to {my_end}")
+
+    quantization = stage_quantization(node_config)
+    group_size = MODEL_CONFIG["quantization_group_size"]
+    quantization_manifest = None
+    if quantization != "none":
+        quantization_manifest = {"mode": quantization, **({"group_size": group_size} if quantization == "int4" else {})}
+
+    if cache_dir and revision is None:
+        _log(rank, f"Cannot identify the local checkpoint of '{model_name}', not using the shard cache")
+        cache_dir = None
+    manifest = shard_manifest(model_name, revision, arch_config, MODEL_CONFIG["dtype"], ranges, rank, quantization_manifest)
+    cached_shard = find_cached_shard(cache_dir, manifest) if cache_dir else None
+    if streaming:
+        _stream_to_workers(config, ranges, rank, world_size, dtype, needed=rank != 0 and not cached_shard)
+
+    # Log memory before loading
+    process = psutil.Process()
+    mem_before = psutil.virtual_memory()
+    _log(rank, f"1a. Memory before loading: {mem_before.used / (1024**3):.2f} GB used / {mem_before.total / (1024**3):.2f} GB total")
+
+    if cached_shard:
+        _log(rank, f"1b. Found pre-sharded checkpoint: {cached_shard}")
+        model = _build_empty_model(config)
+        _prune_model(model, arch_config, my_start, my_end, rank, world_size)
+        quantize_layers(get_nested_attr(model, arch_config["layers_path"]), quantization, group_size)
+        names = [name for name, _ in model.named_parameters(remove_duplicate=False)]
+        _log(rank, f"1c. Loading {len(names)} tensors from the shard...")
+        _load_shard_weights(model, [cached_shard], names, dtype, arch_config, config)
+        _log(rank, "1d. Model weights loaded.")
+    else:
+        if streaming and rank != 0:
+            _log(rank, "1b. Receiving this rank's weights from rank 0...")
+            model = _build_empty_model(config)
+            names = get_shard_parameter_names(model, arch_config, my_start, my_end, rank, world_size)
+            nbytes = _receive_shard_weights(model, names, dtype)
+            _log(rank, f"1c. Received {len(names)} tensors ({nbytes / 1024**2:.1f} MB) from rank 0.")
+        else:
+            is_cached = check_cache(model_name)
+            _log(rank, f"1b. Model '{model_name}' appears to be cached: {is_cached}")
+
+            files = _find_safetensors_files(model_name)
+            if files:
+                _log(rank, "1c. Building empty model skeleton on the meta device...")
+                model = _build_empty_model(config)
+                names = get_shard_parameter_names(model, arch_config, my_start, my_end, rank, world_size)
+                _log(rank, f"1c. Loading {len(names)} tensors from {len(files)} safetensors file(s)...")
+                _load_shard_weights(model, files, names, dtype, arch_config, config)
+            else:
+                _log(rank, "1c. No safetensors weights found, loading full model with from_pretrained...")
+                model = AutoModelForCausalLM.from_pretrained(
+                    model_name, torch_dtype=dtype, low_cpu_mem_usage=True
+                )
+        _log(rank, "1d. Model weights loaded.")
+
+        _log(rank, "2. Pruning unused layers...")
+        _prune_model(model, arch_config, my_start, my_end, rank, world_size)
+        _log(rank, "2. Pruning complete.")
+        if quantization != "none":
+            with span("quantize", "load"):
+                replaced = quantize_layers(get_nested_attr(model, arch_config["layers_path"]), quantization, group_size)
+            _log(rank, f"2b. Quantized {replaced} linear layers to {quantization}.")
+
+    lm_head_weight = f"{arch_config['lm_head_path']}.weight"
+    embedding_weight = f"{arch_config['embedding_path']}.weight"
+    if getattr(config, "tie_word_embeddings", False) and rank == 0 and rank == world_size - 1:
+        # A single stage owns both ends of a tied model; share the tensor again.
+        set_nested_attr(model, lm_head_weight, get_nested_attr(model, embedding_weight))
+
+    unloaded = [name for name, param in model.named_parameters() if param.is_meta]
+    if unloaded:
+        raise RuntimeError(f"Shard is missing weights for: {unloaded}")
+
+    if cache_dir and not cached_shard:
+        _log(rank, "2a. Writing shard to the pre-sharded checkpoint cache...")
+        with span("write_shard", "load"):
+            path = save_shard(model, cache_dir, manifest)
+        _log(rank, f"2a. Shard written to {path}")
+
+    mem_after = psutil.virtual_memory()
+    _log(rank, f"3. Memory after loading: {mem_after.used / (1024**3):.2f} GB used / {mem_after.total / (1024**3):.2f} GB total")
+    _log(rank, f"   -> Memory consumed by shard load: {(mem_after.used - mem_before.used) / (1024**3):.2f} GB (process RSS {process.memory_info().rss / (1024**3):.2f} GB)")
+
+    _log(rank, f"4. Moving sharded model to device '{device}'...")
+    with span("to_device", "load", device=str(device)):
+        stage = PipelineStage(model, arch_config, node_config).to(device)
+    _log(rank, "4. Move to device complete.")
+
+    return stage
+
+def forward_sequence(
+    model: PipelineStage,
+    inputs: torch.Tensor,
+    node_config: NodeConfig,
+    past_key_values: Optional[DynamicCache] = None,
+    attention_mask: Optional[torch.Tensor] = None,
+    position_ids: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Run this rank's stage on `inputs`; see PipelineStage.forward. The node
+    config is already baked into the stage and only kept for older callers.
+    """
+    return model(inputs, past_key_values, attention_mask=attention_mask, position_ids=position_ids)
+
+@dataclass
+class GenerationStats:
+    """Timing of one generate() call as seen by this rank."""
+    prefill_time: float = 0.0  # Seconds for the prompt step, up to its token being known here
+    decode_times: List[float] = field(default_factory=list)  # Seconds for each later step
+    bytes_sent: int = 0
+    bytes_received: int = 0
+
+@torch.no_grad()
+def generate(
+    model: PipelineStage,
+    input_ids: torch.Tensor,
+    node_config: NodeConfig,
+    max_new_tokens: int = 20,
+    temperature: float = 0.0,
+    return_stats: bool = False,
+    top_k: int = 0,
+    top_p: float = 1.0,
+    seed: Optional[int] = None,
+    rebalance: Optional[bool] = None,
+):
+    """
+    Autoregressively generate `max_new_tokens` tokens across the pipeline.
+
+    Every rank calls this, but only rank 0's `input_ids` are read; other
+    ranks learn activation shapes from the transport. Each rank keeps a KV cache
+    for its own slice of layers, so after the prompt has been prefilled only
+    the newest position's hidden state travels between stages. The last rank
+    samples each token and sends it back to rank 0, which feeds it in for the
+    next step. Only the last position is ever projected to the vocabulary.
+
+    Sampling uses `temperature` (0 is greedy), `top_k` and `top_p`; a `seed`
+    makes it reproducible.
+
+    With `rebalance` (default REBALANCE_CONFIG["enabled"], and the same on
+    every rank), boundary layers move from a slow stage to its neighbours
+    while generating; see rebalancing.py.
+
+    Returns:
+        The prompt plus generated tokens on rank 0, None on every other rank.
+        With `return_stats`, a (tokens, GenerationStats) tuple instead.
+    """
+    stats = GenerationStats()
+    with PipelineTransport(node_config, input_ids.device) as transport:
+        past_key_values = DynamicCache()
+        generated = input_ids
+        step_inputs = input_ids
+        generator = make_generator(seed, input_ids.device) if transport.is_last else None
+        if rebalance is None:
+            rebalance = REBALANCE_CONFIG["enabled"]
+        rebalancer = Rebalancer(model, node_config, past_key_values) if rebalance else None
+
+        for step in range(max_new_tokens):
+            step_start = time.perf_counter()
+            if not transport.is_first:
+                step_inputs = transport.recv_forward()
+
+            if rebalancer is not None:
+                outputs = rebalancer.timed_forward(step_inputs, past_key_values, logits_to_keep=1)
+            else:
+                outputs = model(step_inputs, past_key_values, logits_to_keep=1)
+
+            if not transport.is_last:
+                transport.send_forward(outputs)
+            else:
+                next_token = sample_tokens(outputs[:, -1, :], temperature, top_k, top_p, generator)
+                if not transport.is_first:
+                    transport.send_to_first(next_token)
+
+            if transport.is_first:
+                if not transport.is_last:
+                    next_token = transport.recv_from_last()
+                step_inputs = next_token.to(input_ids.device).unsqueeze(-1)
+                generated = torch.cat([generated, step_inputs], dim=-1)
+                metrics.inc("pipeline_tokens_generated_total", step_inputs.size(0))
+
+            if return_stats:
+                synchronize_device(input_ids.device)
+                step_time = time.perf_counter() - step_start
+                if step == 0:
+                    stats.prefill_time = step_time
+                else:
+                    stats.decode_times.append(step_time)
+            if rebalancer is not None:
+                rebalancer.step()
+
+    result = generated if transport.is_first else None
+    if not return_stats:
+        return result
+    stats.bytes_sent = transport.bytes_sent
+    stats.bytes_received = transport.bytes_received
+    return result, stats
@@ -0,0 +1,155 @@
+"""
+Cost-model-driven assignment of transformer layers to pipeline stages.
+
+Pipeline throughput is bounded by the slowest stage, and the stages are not
+symmetric: rank 0 also holds the embeddings and the last rank runs the final
+norm and a vocab-sized lm_head matmul. This module estimates the compute and
+memory of every piece of the model from its parameter counts, then picks the
+contiguous layer ranges that minimize the slowest stage's time (scaled by
+each node's compute weight) while keeping every stage within its memory limit.
+"""
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+import torch
+from transformers import AutoModelForCausalLM
+from .config import NODES, MODEL_CONFIG, NodeConfig
+from .quantization import stage_quantization, weight_bytes_ratio
+from .utils import get_nested_attr
+
+@dataclass
+class ModelCosts:
+    """Per-token compute (FLOPs) and weight memory (bytes) of a model's parts."""
+    layer_flops: List[float]
+    layer_bytes: List[int]
+    first_flops: float  # Embeddings / project_in, only on rank 0
+    first_bytes: int
+    last_flops: float  # Final norm / project_out / lm_head, only on the last rank
+    last_bytes: int
+
+def _numel(model, path: Optional[str]) -> int:
+    module = get_nested_attr(model, path) if path else None
+    if module is None:
+        return 0
+    return sum(p.numel() for p in module.parameters())
+
+def estimate_model_costs(config, arch_config: dict, dtype: torch.dtype, seq_len: int = 256) -> ModelCosts:
+    """
+    Estimate costs from a meta-device instance of the model, so no weights
+    are loaded. Matmuls cost 2 FLOPs per parameter per token, attention adds
+    about 4 * seq_len * hidden per layer, and embedding lookups are free.
+    """
+    from accelerate import init_empty_weights
+
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config)
+
+    bytes_per_param = torch.finfo(dtype).bits // 8 if dtype.is_floating_point else torch.iinfo(dtype).bits // 8
+    hidden_size = get_nested_attr(config, arch_config["hidden_size_key"])
+    attention_flops = 4 * seq_len * hidden_size
+
+    layers = get_nested_attr(model, arch_config["layers_path"])
+    layer_params = [sum(p.numel() for p in layer.parameters()) for layer in layers]
+
+    first_params = sum(_numel(model, arch_config.get(key)) for key in (
+        "embedding_path", "positional_embedding_path", "project_in_path"))
+    project_in = _numel(model, arch_config.get("project_in_path"))
+    last_params = sum(_numel(model, arch_config.get(key)) for key in (
+        "final_norm_path", "lm_head_path", "project_out_path"))
+
+    return ModelCosts(
+        layer_flops=[2.0 * n + attention_flops for n in layer_params],
+        layer_bytes=[n * bytes_per_param for n in layer_params],
+        first_flops=2.0 * project_in,
+        first_bytes=first_params * bytes_per_param,
+        last_flops=2.0 * last_params,
+        last_bytes=last_params * bytes_per_param,
+    )
+
+def partition_layers(
+    costs: ModelCosts,
+    compute_weights: Sequence[float],
+    memory_limits: Optional[Sequence[Optional[float]]] = None,
+    layer_byte_scales: Optional[Sequence[float]] = None,
+) -> List[Tuple[int, int]]:
+    """
+    Split the layers into len(compute_weights) contiguous, non-empty ranges
+    minimizing max(stage FLOPs / compute weight), subject to each stage's
+    weight bytes fitting in its memory limit (None means unlimited). A
+    stage's layer bytes are multiplied by its `layer_byte_scales` entry, e.g.
+    for a quantized stage.
+    """
+    num_layers = len(costs.layer_flops)
+    world_size = len(compute_weights)
+    memory_limits = memory_limits or [None] * world_size
+    layer_byte_scales = layer_byte_scales or [1.0] * world_size
+    if world_size > num_layers:
+        raise ValueError(f"Cannot split {num_layers} layers over {world_size} stages")
+
+    flops_prefix = [0.0]
+    bytes_prefix = [0]
+    for flops, nbytes in zip(costs.layer_flops, costs.layer_bytes):
+        flops_prefix.append(flops_prefix[-1] + flops)
+        bytes_prefix.append(bytes_prefix[-1] + nbytes)
+
+    def stage_time(rank, start, end):
+        flops = flops_prefix[end] - flops_prefix[start]
+        nbytes = (bytes_prefix[end] - bytes_prefix[start]) * layer_byte_scales[rank]
+        if rank == 0:
+            flops, nbytes = flops + costs.first_flops, nbytes + costs.first_bytes
+        if rank == world_size - 1:
+            flops, nbytes = flops + costs.last_flops, nbytes + costs.last_bytes
+        limit = memory_limits[rank]
+        if limit is not None and nbytes > limit:
+            return float("inf")
+        return flops / compute_weights[rank]
+
+    # best[r][j]: slowest stage time when ranks 0..r cover layers [0, j).
+    inf = float("inf")
+    best = [[inf] * (num_layers + 1) for _ in range(world_size)]
+    split = [[0] * (num_layers + 1) for _ in range(world_size)]
+    for end in range(1, num_layers + 1):
+        best[0][end] = stage_time(0, 0, end)
+    for rank in range(1, world_size):
+        for end in range(rank + 1, num_layers + 1):
+            for start in range(rank, end):
+                candidate = max(best[rank - 1][start], stage_time(rank, start, end))
+                if candidate < best[rank][end]:
+                    best[rank][end], split[rank][end] = candidate, start
+
+    if best[world_size - 1][num_layers] == inf:
+        raise ValueError("No layer partition fits within the configured node memory limits")
+
+    ranges = []
+    end = num_layers
+    for rank in range(world_size - 1, 0, -1):
+        start = split[rank][end]
+        ranges.append((start, end))
+        end = start
+    ranges.append((0, end))
+    return ranges[::-1]
+
+def get_stage_nodes(world_size: int) -> List[Optional[NodeConfig]]:
+    """
+    The configured nodes in rank order, or placeholders if the run uses a
+    different world size than NODES describes.
+    """
+    nodes = sorted(NODES.values(), key=lambda node: node.rank)
+    if len(nodes) == world_size:
+        return nodes
+    return [None] * world_size
+
+def balanced_layer_ranges(config, arch_config: dict, dtype: torch.dtype, world_size: int) -> List[Tuple[int, int]]:
+    """Layer ranges for each rank, balanced using the nodes' weights and limits."""
+    nodes = get_stage_nodes(world_size)
+    weights = [node.compute_weight if node else 1.0 for node in nodes]
+    limits = [
+        node.memory_limit_gb * 1024**3 if node and node.memory_limit_gb else None
+        for node in nodes
+    ]
+    # Quantization shrinks the layers' weights, which nearly all of their bytes are.
+    scales = [
+        weight_bytes_ratio(stage_quantization(node), MODEL_CONFIG["quantization_group_size"], dtype)
+        for node in nodes
+    ]
+    costs = estimate_model_costs(config, arch_config, dtype)
+    return partition_layers(costs, weights, limits, scales)
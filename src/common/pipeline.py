@@ -0,0 +1,119 @@
+"""
+Pipeline schedules for pushing batches through the sharded model.
+
+The "gpipe" schedule splits a batch into micro-batches and streams them
+through the stages, so while stage k works on micro-batch i, stage k - 1 is
+already computing micro-batch i + 1. The "sequential" schedule sends the
+whole batch at once and is kept as a baseline.
+"""
+import time
+from dataclasses import dataclass
+from typing import Optional, List, Tuple
+import torch
+import torch.distributed as dist
+from .config import NodeConfig, PIPELINE_CONFIG
+from .stage import PipelineStage
+from .transport import PipelineTransport
+from .utils import synchronize_device
+
+SCHEDULES = ("sequential", "gpipe")
+
+@dataclass
+class PipelineStats:
+    """Timing of one pipeline run as seen by this rank."""
+    schedule: str
+    num_micro_batches: int
+    wall_time: float  # Seconds from the common start barrier to this rank finishing
+    busy_time: float  # Seconds this rank spent computing its layers
+    bubble_fraction: float  # Share of wall time this rank was idle or waiting
+    cluster_bubble_fraction: float  # Idle share summed over all ranks
+    bytes_sent: int  # Bytes this rank put on the wire
+    raw_bytes_sent: int  # The same traffic without a wire codec
+
+def _cluster_bubble_fraction(busy_time: float, wall_time: float) -> float:
+    totals = torch.tensor([busy_time, wall_time], dtype=torch.float64)
+    if dist.is_initialized():
+        dist.all_reduce(totals)
+    busy, wall = totals.tolist()
+    return 1.0 - busy / wall if wall > 0 else 0.0
+
+@torch.no_grad()
+def run_pipeline(
+    model: PipelineStage,
+    input_ids: torch.Tensor,
+    node_config: NodeConfig,
+    schedule: Optional[str] = None,
+    num_micro_batches: Optional[int] = None,
+    codec: Optional[str] = None,
+) -> Tuple[Optional[torch.Tensor], PipelineStats]:
+    """
+    Run a forward pass over a batch using the given schedule.
+
+    Every rank calls this with the same `schedule` and `num_micro_batches`
+    (defaults come from PIPELINE_CONFIG); only rank 0's `input_ids` are
+    read, and the micro-batch count must not exceed its batch size.
+    `codec` overrides MODEL_CONFIG["wire_codec"] for the activations.
+
+    Returns:
+        The last stage's output for the whole batch on the last rank (None
+        elsewhere), and this rank's timing stats.
+    """
+    schedule = schedule or PIPELINE_CONFIG["schedule"]
+    if schedule not in SCHEDULES:
+        raise ValueError(f"Unknown pipeline schedule '{schedule}', expected one of {SCHEDULES}")
+    if schedule == "sequential":
+        num_micro_batches = 1
+    else:
+        num_micro_batches = num_micro_batches or PIPELINE_CONFIG["num_micro_batches"]
+
+    # Only rank 0's batch is read, so its size is shared first: every rank
+    # then rejects a bad split instead of waiting on a rank 0 that gave up.
+    batch_size = torch.tensor([input_ids.size(0)])
+    if dist.is_initialized():
+        dist.broadcast(batch_size, src=0)
+    if num_micro_batches > batch_size.item():
+        raise ValueError(f"Cannot split a batch of {batch_size.item()} into {num_micro_batches} micro-batches")
+
+    device = input_ids.device
+    outputs: List[torch.Tensor] = []
+    busy_time = 0.0
+
+    with PipelineTransport(node_config, device, codec) as transport:
+        if transport.is_first:
+            micro_batches = list(torch.tensor_split(input_ids, num_micro_batches))
+        else:
+            micro_batches = [None] * num_micro_batches
+
+        # Line everyone up so wall times are comparable across ranks.
+        if dist.is_initialized():
+            dist.barrier()
+        start = time.perf_counter()
+
+        for micro_batch in micro_batches:
+            # The receive for the next micro-batch is already posted, and sends
+            # return immediately, so transfers overlap with this compute.
+            if not transport.is_first:
+                micro_batch = transport.recv_forward()
+
+            compute_start = time.perf_counter()
+            output = model(micro_batch)
+            synchronize_device(device)
+            busy_time += time.perf_counter() - compute_start
+
+            if transport.is_last:
+                outputs.append(output)
+            else:
+                transport.send_forward(output)
+
+    wall_time = time.perf_counter() - start
+    stats = PipelineStats(
+        schedule=schedule,
+        num_micro_batches=num_micro_batches,
+        wall_time=wall_time,
+        busy_time=busy_time,
+        bubble_fraction=1.0 - busy_time / wall_time if wall_time > 0 else 0.0,
+        cluster_bubble_fraction=_cluster_bubble_fraction(busy_time, wall_time),
+        bytes_sent=transport.bytes_sent,
+        raw_bytes_sent=transport.raw_bytes_sent,
+    )
+    return (torch.cat(outputs) if transport.is_last else None), stats
@@ -0,0 +1,200 @@
+"""
+Prompt-prefix KV cache shared across the server's requests.
+
+Prompts are cut into blocks of SERVER_CONFIG["prefix_block_size"] tokens. A
+block is keyed by its tokens and the id of the block before it, so a chain
+of blocks stands for a whole prefix, and a new prompt skips the prefill of
+the longest chain of cached blocks it starts with.
+
+Every rank keeps the keys and values its own layers computed for each
+block in a `PrefixStore`. Rank 0 alone keeps the `PrefixIndex` and decides,
+in each step's plan, which blocks the new rows read, which blocks their
+prefill stores and which are evicted, so every stage holds the same blocks.
+Eviction is least recently used, with room for as many blocks as the node
+with the tightest budget (its `prefix_cache_gb`, or
+SERVER_CONFIG["prefix_cache_gb"]) can hold for its own layers.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import torch
+from transformers import DynamicCache
+from .config import NODES, MODEL_CONFIG, SERVER_CONFIG
+from .model_sharding import get_partition
+from .utils import get_nested_attr
+
+NO_BLOCK = -1
+
+@dataclass
+class PrefixCacheStats:
+    """Rank 0's running counts, reported by the server's /health."""
+    lookups: int = 0  # Prompts looked up
+    hits: int = 0  # Prompts that reused at least one block
+    prompt_tokens: int = 0
+    hit_tokens: int = 0  # Prompt tokens whose prefill was skipped
+    stored_blocks: int = 0
+    evicted_blocks: int = 0
+
+@dataclass
+class PrefixPlan:
+    """What the prefill of one step's new rows does with the cache, one entry per row."""
+    reads: List[List[int]]  # Cached blocks each row starts with
+    store_from: List[int]  # Index of the row's first block to store
+    stores: List[List[int]]  # Ids for the row's blocks from there on
+    evicted: List[int]
+
+def prefix_cache_capacity(config, world_size: int, block_size: int) -> int:
+    """
+    How many blocks fit in every node's budget, given the layers the
+    partition gives each rank.
+    """
+    arch_config = MODEL_CONFIG["model_arch_config"]
+    width = get_nested_attr(config, arch_config["hidden_size_key"])
+    itemsize = torch.empty(0, dtype=getattr(torch, MODEL_CONFIG["dtype"])).element_size()
+    budgets = {node.rank: node.prefix_cache_gb for node in NODES.values()}
+    capacity = None
+    for rank, (start, end) in enumerate(get_partition(config, world_size)):
+        budget = budgets.get(rank)
+        budget = SERVER_CONFIG["prefix_cache_gb"] if budget is None else budget
+        block_bytes = 2 * (end - start) * block_size * width * itemsize
+        blocks = int(budget * 1024**3 // block_bytes) if block_bytes else 0
+        capacity = blocks if capacity is None else min(capacity, blocks)
+    return capacity or 0
+
+class PrefixIndex:
+    """Rank 0's map from token-id prefixes to block ids, least recently used first."""
+
+    def __init__(self, block_size: int, capacity: int):
+        self.block_size = block_size
+        self.capacity = capacity
+        self.stats = PrefixCacheStats()
+        self._blocks: "OrderedDict[Tuple[int, Tuple[int, ...]], int]" = OrderedDict()
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._blocks)
+
+    def _key(self, parent: int, input_ids: List[int], block: int) -> Tuple[int, Tuple[int, ...]]:
+        start = block * self.block_size
+        return parent, tuple(input_ids[start:start + self.block_size])
+
+    def match(self, input_ids: List[int]) -> List[int]:
+        """Ids of the cached blocks the prompt starts with, leaving at least its last token to compute."""
+        ids = []
+        for block in range((len(input_ids) - 1) // self.block_size):
+            block_id = self._blocks.get(self._key(ids[-1] if ids else NO_BLOCK, input_ids, block))
+            if block_id is None:
+                break
+            ids.append(block_id)
+        return ids
+
+    def _touch(self, keys) -> None:
+        # Later blocks are only reachable through earlier ones, so the
+        # chain's head is marked most recently used and its tail goes first.
+        for key in reversed(keys):
+            self._blocks.move_to_end(key)
+
+    def _make_room(self, pinned: set) -> Optional[int]:
+        """Evict the least recently used block not in use by this step, if the index is full."""
+        if len(self._blocks) < self.capacity:
+            return NO_BLOCK
+        for key, block_id in self._blocks.items():
+            if block_id not in pinned:
+                del self._blocks[key]
+                self.stats.evicted_blocks += 1
+                return block_id
+        return None
+
+    def plan(self, prompts: List[List[int]]) -> PrefixPlan:
+        """Look up a step's new prompts and make room for the blocks their prefill will compute."""
+        reads = [self.match(input_ids) for input_ids in prompts]
+        pinned = {block_id for ids in reads for block_id in ids}
+        store_from, stores, evicted = [], [], []
+        for input_ids, ids in zip(prompts, reads):
+            self.stats.lookups += 1
+            self.stats.prompt_tokens += len(input_ids)
+            self.stats.hits += bool(ids)
+            self.stats.hit_tokens += len(ids) * self.block_size
+
+            keys, parent, block = [], ids[-1] if ids else NO_BLOCK, len(ids)
+            # The blocks after the match may be cached already, e.g. by an
+            # identical prompt, and only the rest are new.
+            while block < len(input_ids) // self.block_size:
+                key = self._key(parent, input_ids, block)
+                if key not in self._blocks:
+                    break
+                keys.append(key)
+                parent = self._blocks[key]
+                pinned.add(parent)
+                block += 1
+            store_from.append(block)
+            new_ids = []
+            for block in range(block, len(input_ids) // self.block_size):
+                freed = self._make_room(pinned)
+                if freed is None:
+                    break
+                if freed != NO_BLOCK:
+                    evicted.append(freed)
+                key = self._key(parent, input_ids, block)
+                parent = self._blocks[key] = self._next_id
+                self._next_id += 1
+                keys.append(key)
+                pinned.add(parent)
+                new_ids.append(parent)
+            stores.append(new_ids)
+            self.stats.stored_blocks += len(new_ids)
+            self._touch([self._key(ids[index - 1] if index else NO_BLOCK, input_ids, index)
+                         for index in range(len(ids))] + keys)
+        return PrefixPlan(reads, store_from, stores, evicted)
+
+class PrefixStore:
+    """One rank's keys and values for every cached block, for the layers it owns."""
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        # Block id -> [(layer index, keys, values)], each [heads, block size, head dim].
+        self._blocks: Dict[int, List[Tuple[int, torch.Tensor, torch.Tensor]]] = {}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            keys.numel() * keys.element_size() + values.numel() * values.element_size()
+            for layers in self._blocks.values() for _, keys, values in layers
+        )
+
+    def read(self, reads: List[List[int]]) -> Tuple[DynamicCache, torch.Tensor]:
+        """
+        A cache holding each row's cached prefix, left-padded to the longest,
+        and its [rows, positions] mask with 1 for real positions.
+        """
+        length = max(len(ids) for ids in reads) * self.block_size
+        cache = DynamicCache()
+        template = self._blocks[next(ids[0] for ids in reads if ids)]
+        mask = torch.zeros(len(reads), length, dtype=torch.long, device=template[0][1].device)
+        for row, ids in enumerate(reads):
+            if ids:
+                mask[row, length - len(ids) * self.block_size:] = 1
+        for layer, (layer_idx, keys, values) in enumerate(template):
+            shape = (len(reads), keys.size(0), length, keys.size(-1))
+            layer_keys, layer_values = keys.new_zeros(shape), values.new_zeros(shape)
+            for row, ids in enumerate(reads):
+                if ids:
+                    start = length - len(ids) * self.block_size
+                    layer_keys[row, :, start:] = torch.cat([self._blocks[i][layer][1] for i in ids], dim=-2)
+                    layer_values[row, :, start:] = torch.cat([self._blocks[i][layer][2] for i in ids], dim=-2)
+            cache.update(layer_keys, layer_values, layer_idx)
+        return cache, mask
+
+    def save(self, cache: DynamicCache, row: int, first_column: int, block_ids: List[int]) -> None:
+        """Copy a row's blocks out of a prefill cache, the first of them starting at `first_column`."""
+        for index, block_id in enumerate(block_ids):
+            start = first_column + index * self.block_size
+            end = start + self.block_size
+            self._blocks[block_id] = [
+                (layer_idx, layer.keys[row, :, start:end].clone(), layer.values[row, :, start:end].clone())
+                for layer_idx, layer in enumerate(cache.layers) if layer.get_seq_length() > 0
+            ]
+
+    def evict(self, block_ids: List[int]) -> None:
+        for block_id in block_ids:
+            self._blocks.pop(block_id, None)
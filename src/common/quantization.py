@@ -0,0 +1,133 @@
+"""
+Weight-only quantization of a shard's decoder layers at load time.
+
+Decoding one token reads every weight once, so a stage's step time is
+mostly memory traffic. Storing the layers' linear weights as int8 (one
+scale per output feature) or grouped 4-bit integers (one scale per
+`group_size` inputs of each output feature, two weights to a byte) halves
+or quarters that traffic and the shard's footprint. Activations stay in the
+shard's dtype: each matmul dequantizes its weight on the fly, or for int8
+uses PyTorch's fused int8 weight kernel where the device has one.
+
+Embeddings and the lm_head (often tied to them) keep the shard's dtype.
+"""
+from typing import Optional
+import torch
+import torch.nn.functional as F
+from torch import nn
+from transformers.pytorch_utils import Conv1D
+from .config import NodeConfig, MODEL_CONFIG
+
+MODES = ("none", "int8", "int4")
+
+def stage_quantization(node_config: Optional[NodeConfig]) -> str:
+    """The quantization mode for a stage: its node's own setting, else MODEL_CONFIG's."""
+    mode = (node_config and node_config.quantization) or MODEL_CONFIG["quantization"]
+    if mode not in MODES:
+        raise ValueError(f"Unknown quantization '{mode}', expected one of {MODES}")
+    return mode
+
+def weight_bytes_ratio(mode: str, group_size: int, dtype: torch.dtype) -> float:
+    """Bytes per quantized weight relative to the unquantized dtype, scales included."""
+    itemsize = torch.finfo(dtype).bits // 8
+    if mode == "int8":
+        return 1 / itemsize
+    if mode == "int4":
+        return (0.5 + itemsize / group_size) / itemsize
+    return 1.0
+
+class QuantizedLinear(nn.Module):
+    """
+    y = x W^T + b with W stored as int8 rows or packed 4-bit groups.
+
+    `qweight` is [out, in] int8, or [out, in / 2] uint8 holding two 4-bit
+    values (offset by 8) per byte; `scales` is [out] or [out, in / group_size].
+    """
+
+    def __init__(self, in_features: int, out_features: int, mode: str, group_size: int, bias: bool,
+                 dtype: torch.dtype, device=None):
+        super().__init__()
+        if mode not in ("int8", "int4"):
+            raise ValueError(f"Cannot build a quantized layer for mode '{mode}'")
+        self.in_features, self.out_features = in_features, out_features
+        self.mode = mode
+        # 4-bit layers whose inputs don't split into groups use one group per row.
+        self.group_size = group_size if in_features % group_size == 0 else in_features
+        if mode == "int8":
+            qweight = torch.empty(out_features, in_features, dtype=torch.int8, device=device)
+            scales = torch.empty(out_features, dtype=dtype, device=device)
+        else:
+            if in_features % 2:
+                raise ValueError(f"4-bit weights need an even number of inputs, not {in_features}")
+            qweight = torch.empty(out_features, in_features // 2, dtype=torch.uint8, device=device)
+            scales = torch.empty(out_features, in_features // self.group_size, dtype=dtype, device=device)
+        self.qweight = nn.Parameter(qweight, requires_grad=False)
+        self.scales = nn.Parameter(scales, requires_grad=False)
+        self.bias = nn.Parameter(torch.empty(out_features, dtype=dtype, device=device), requires_grad=False) \
+            if bias else None
+        # Whether the fused int8 kernel works here; unknown until first tried.
+        self._fused = None if mode == "int8" and hasattr(torch, "_weight_int8pack_mm") else False
+
+    @classmethod
+    def from_module(cls, module: nn.Module, mode: str, group_size: int) -> "QuantizedLinear":
+        """Quantize an nn.Linear or a GPT-2 Conv1D (which stores its weight as [in, out])."""
+        weight = module.weight if isinstance(module, nn.Linear) else module.weight.t()
+        out_features, in_features = weight.shape
+        layer = cls(in_features, out_features, mode, group_size, module.bias is not None,
+                    module.weight.dtype, module.weight.device)
+        if weight.is_meta:
+            # Skeletons get filled from a quantized shard later.
+            return layer
+
+        weight = weight.detach().float()
+        if mode == "int8":
+            scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+            qweight = (weight / scales[:, None]).round().clamp(-127, 127).to(torch.int8)
+        else:
+            groups = weight.reshape(out_features, -1, layer.group_size)
+            scales = groups.abs().amax(dim=-1).clamp(min=1e-8) / 7
+            values = (groups / scales[..., None]).round().clamp(-8, 7).to(torch.int16) + 8
+            values = values.reshape(out_features, in_features).to(torch.uint8)
+            qweight = values[:, 0::2] | (values[:, 1::2] << 4)
+        layer.qweight.data = qweight
+        layer.scales.data = scales.to(layer.scales.dtype)
+        if module.bias is not None:
+            layer.bias.data = module.bias.detach().clone()
+        return layer
+
+    def dequantize(self, dtype: torch.dtype) -> torch.Tensor:
+        if self.mode == "int8":
+            return self.qweight.to(dtype) * self.scales.to(dtype)[:, None]
+        values = torch.stack([self.qweight & 0x0F, self.qweight >> 4], dim=-1)
+        values = values.reshape(self.out_features, -1, self.group_size).to(dtype) - 8
+        return (values * self.scales.to(dtype)[..., None]).reshape(self.out_features, self.in_features)
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        if self._fused is not False:
+            flat = hidden_states.reshape(-1, self.in_features)
+            try:
+                output = torch._weight_int8pack_mm(flat, self.qweight, self.scales.to(flat.dtype))
+                self._fused = True
+            except (RuntimeError, NotImplementedError):
+                # Not every device and dtype has the fused kernel.
+                self._fused = False
+            else:
+                output = output.reshape(*hidden_states.shape[:-1], self.out_features)
+                return output + self.bias if self.bias is not None else output
+        return F.linear(hidden_states, self.dequantize(hidden_states.dtype), self.bias)
+
+def quantize_layers(layers: nn.Module, mode: str, group_size: Optional[int] = None) -> int:
+    """
+    Replace every nn.Linear and Conv1D under `layers` with a QuantizedLinear,
+    in place. Returns how many were replaced.
+    """
+    if mode == "none":
+        return 0
+    group_size = group_size or MODEL_CONFIG["quantization_group_size"]
+    replaced = 0
+    for parent in list(layers.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, (nn.Linear, Conv1D)):
+                setattr(parent, name, QuantizedLinear.from_module(child, mode, group_size))
+                replaced += 1
+    return replaced
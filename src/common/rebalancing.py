@@ -0,0 +1,197 @@
+"""
+Move decoder layers between neighbouring stages while generating.
+
+The static split from `get_partition` assumes every node keeps its speed,
+but a thermally throttled mini or one busy with other work slows its stage,
+and with it the whole pipeline. With REBALANCE=1, `generate` times each
+rank's forward passes, and every REBALANCE_CONFIG["interval_steps"] steps
+the ranks all-gather their mean step time and layer count. Every rank then
+makes the same decision from the same numbers: if the slowest stage takes
+more than REBALANCE_CONFIG["threshold"] times the mean, and handing one of
+its boundary layers to a neighbour would shorten the slowest stage by that
+factor too, that layer moves, weights and KV cache together, over the
+process group. A move is never undone at the next check. The embeddings and
+lm_head on the end stages are costed with the partitioner's estimates and
+left out of the per-layer time.
+
+Only tensors cross the wire: the receiver rebuilds the layer from the
+model's meta-device skeleton and loads the sent state dict into it. A layer
+keeps the quantization of the stage it was loaded on, and its attention
+keeps its global layer index, so its KV cache entry keeps its place. The
+first step's prefill is left out of the timing, as it dwarfs the decode
+steps that follow. Moves last for the life of the loaded stage; a reload
+starts from the static split again.
+"""
+import io
+import time
+from typing import List, Optional, Sequence, Tuple
+import torch
+import torch.distributed as dist
+from transformers import DynamicCache
+from transformers.cache_utils import DynamicLayer
+from . import metrics
+from .config import NodeConfig, MODEL_CONFIG, REBALANCE_CONFIG
+from .partitioner import estimate_model_costs
+from .quantization import QuantizedLinear, quantize_layers
+from .stage import PipelineStage
+from .tracing import span
+from .transport import recv_tensor, send_tensor
+from .utils import get_nested_attr, synchronize_device
+
+def plan_move(seconds: Sequence[float], layers: Sequence[int], threshold: float,
+              fixed: Optional[Sequence[float]] = None,
+              previous: Optional[Tuple[int, int]] = None) -> Optional[Tuple[int, int]]:
+    """
+    Given every stage's mean step time and layer count, the (source,
+    destination) ranks of the layer to move, or None if the pipeline is
+    balanced enough. A stage's time past its `fixed` share (the embeddings
+    or lm_head of the end stages) is assumed to scale with its layers.
+
+    A move must shorten the slowest stage by `threshold` times, and the
+    `previous` check's move is never undone, so noisy timings cannot send a
+    layer back and forth.
+    """
+    if len(seconds) < 2:
+        return None
+    fixed = fixed or [0.0] * len(seconds)
+    mean = sum(seconds) / len(seconds)
+    slowest = max(range(len(seconds)), key=lambda rank: seconds[rank])
+    if layers[slowest] < 2 or seconds[slowest] <= threshold * mean:
+        return None
+
+    def per_layer(rank):
+        return max(seconds[rank] - fixed[rank], 0.0) / layers[rank]
+
+    best, best_time = None, seconds[slowest] / threshold
+    for neighbour in (slowest - 1, slowest + 1):
+        if not 0 <= neighbour < len(seconds) or previous == (neighbour, slowest):
+            continue
+        # The layer would cost the neighbour what one of its own layers does.
+        after = max(seconds[slowest] - per_layer(slowest), seconds[neighbour] + per_layer(neighbour))
+        if after < best_time:
+            best, best_time = neighbour, after
+    return None if best is None else (slowest, best)
+
+def _format_ranges(layers: Sequence[int]) -> str:
+    bounds = [0]
+    for count in layers:
+        bounds.append(bounds[-1] + count)
+    return ",".join(f"{start}-{end}" for start, end in zip(bounds, bounds[1:]))
+
+class Rebalancer:
+    """
+    One rank's side of rebalancing a `generate` call. Every rank must make
+    one and call `step()` after each step, so the exchanges line up.
+    """
+
+    def __init__(self, stage: PipelineStage, node_config: NodeConfig, cache: DynamicCache,
+                 interval_steps: Optional[int] = None, threshold: Optional[float] = None):
+        self.stage = stage
+        self.cache = cache
+        self.rank, self.world_size = node_config.rank, node_config.world_size
+        self.interval_steps = interval_steps or REBALANCE_CONFIG["interval_steps"]
+        self.threshold = threshold or REBALANCE_CONFIG["threshold"]
+        self.device = next(stage.parameters()).device
+        self.steps = 0
+        self.seconds = 0.0
+        self.moves: List[Tuple[int, int, int]] = []  # (layer, source, destination)
+        self.previous: Optional[Tuple[int, int]] = None  # The last check's (source, destination)
+        costs = estimate_model_costs(stage.config, MODEL_CONFIG["model_arch_config"],
+                                     getattr(torch, MODEL_CONFIG["dtype"]))
+        self.layer_flops = sum(costs.layer_flops) / len(costs.layer_flops)
+        self.fixed_flops = (costs.first_flops if stage.is_first else 0.0) + (costs.last_flops if stage.is_last else 0.0)
+
+    def timed_forward(self, *args, **kwargs) -> torch.Tensor:
+        """Run the stage and record how long it took, unless it is the prefill."""
+        if self.steps == 0:
+            return self.stage(*args, **kwargs)
+        start = time.perf_counter()
+        outputs = self.stage(*args, **kwargs)
+        synchronize_device(self.device)
+        self.seconds += time.perf_counter() - start
+        return outputs
+
+    def step(self) -> Optional[Tuple[int, int, int]]:
+        """
+        Count a finished step; every `interval_steps` decode steps, compare
+        the stages and maybe move a layer. Returns the move, if one was made.
+        """
+        self.steps += 1
+        decode_steps = self.steps - 1
+        if self.world_size < 2 or decode_steps == 0 or decode_steps % self.interval_steps:
+            return None
+        mean_seconds = self.seconds / self.interval_steps
+        # The share of the step spent outside the layers, per the cost model.
+        fixed_share = self.fixed_flops / (self.fixed_flops + self.layer_flops * len(self.stage.layers))
+        stats = torch.tensor([mean_seconds, len(self.stage.layers), mean_seconds * fixed_share], dtype=torch.float64)
+        gathered = [torch.empty_like(stats) for _ in range(self.world_size)]
+        dist.all_gather(gathered, stats)
+        self.seconds = 0.0
+        seconds = [float(entry[0]) for entry in gathered]
+        layers = [int(entry[1]) for entry in gathered]
+        fixed = [float(entry[2]) for entry in gathered]
+        metrics.set_gauge("pipeline_stage_layers", len(self.stage.layers))
+
+        move = plan_move(seconds, layers, self.threshold, fixed, self.previous)
+        self.previous = move
+        if move is None:
+            return None
+        source, destination = move
+        # The source's first layer goes down the chain, its last layer up it.
+        start = sum(layers[:source])
+        index = start if destination < source else start + layers[source] - 1
+        with span("rebalance", "rebalance", layer=index, source=source, destination=destination):
+            if self.rank == source:
+                self._send_layer(index, destination, first=destination < source)
+            elif self.rank == destination:
+                self._recv_layer(index, source, first=destination > source)
+        layers[source] -= 1
+        layers[destination] += 1
+        metrics.set_gauge("pipeline_stage_layers", len(self.stage.layers))
+        if self.rank == 0:
+            print(f"[rebalance] Stage times {', '.join(f'{s * 1000:.1f}' for s in seconds)} ms: "
+                  f"moved layer {index} from rank {source} to rank {destination}, "
+                  f"layers now {_format_ranges(layers)}", flush=True)
+        self.moves.append((index, source, destination))
+        return index, source, destination
+
+    def _send_layer(self, index: int, destination: int, first: bool) -> None:
+        layer = self.stage.layers[0 if first else -1]
+        del self.stage.layers[0 if first else -1]
+        kv = None
+        if index < len(self.cache.layers) and self.cache.layers[index].is_initialized:
+            entry = self.cache.layers[index]
+            kv = (entry.keys.cpu(), entry.values.cpu())
+            self.cache.layers[index] = DynamicLayer()
+        quantized = next((module for module in layer.modules() if isinstance(module, QuantizedLinear)), None)
+        payload = {
+            "index": index,
+            "quantization": quantized.mode if quantized else "none",
+            "state": {name: tensor.cpu() for name, tensor in layer.state_dict().items()},
+            "kv": kv,
+        }
+        buffer = io.BytesIO()
+        torch.save(payload, buffer)
+        send_tensor(torch.frombuffer(bytearray(buffer.getbuffer()), dtype=torch.uint8), destination)
+
+    def _recv_layer(self, index: int, source: int, first: bool) -> None:
+        # Imported here as model_sharding imports this module.
+        from .model_sharding import _build_empty_model
+
+        payload = recv_tensor(source)
+        received = torch.load(io.BytesIO(payload.numpy().tobytes()), weights_only=True)
+        if received["index"] != index:
+            raise RuntimeError(f"Expected layer {index} from rank {source}, received layer {received['index']}")
+        skeleton = _build_empty_model(self.stage.config)
+        layer = get_nested_attr(skeleton, MODEL_CONFIG["model_arch_config"]["layers_path"])[index]
+        quantize_layers(layer, received["quantization"])
+        layer.load_state_dict(received["state"], assign=True)
+        layer = layer.to(self.device)
+        if first:
+            self.stage.layers.insert(0, layer)
+        else:
+            self.stage.layers.append(layer)
+        if received["kv"] is not None:
+            keys, values = received["kv"]
+            # update() creates the entry (and any before it) for an empty slot.
+            self.cache.update(keys.to(self.device), values.to(self.device), index)
@@ -0,0 +1,95 @@
+"""
+Token sampling on the last pipeline stage.
+
+The last rank only projects the positions it samples from, picks the next
+token for every sequence itself, and sends back token ids (plus top
+log-probabilities when asked for), so full [batch, seq, vocab] logits never
+leave the node.
+"""
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple, Union
+import torch
+from .tracing import traced
+
+GeneratorArg = Union[None, torch.Generator, Sequence[Optional[torch.Generator]]]
+
+@dataclass
+class SamplingParams:
+    """How one sequence's tokens are picked."""
+    temperature: float = 0.0  # 0 means greedy
+    top_k: int = 0  # Only sample from the k most likely tokens; 0 means no limit
+    top_p: float = 1.0  # Only sample from the smallest set of tokens with this much probability
+    seed: Optional[int] = None  # Makes sampling reproducible per sequence
+    logprobs: int = 0  # Number of top log-probabilities to return with each token
+
+    def validate(self, max_logprobs: int = 20) -> None:
+        if self.temperature < 0 or self.top_k < 0 or not 0 < self.top_p <= 1:
+            raise ValueError("temperature and top_k must be non-negative and top_p in (0, 1]")
+        if not 0 <= self.logprobs <= max_logprobs:
+            raise ValueError(f"logprobs must be between 0 and {max_logprobs}")
+        if self.seed is not None and self.seed < 0:
+            raise ValueError("seed must be non-negative")
+
+def make_generator(seed: Optional[int], device) -> Optional[torch.Generator]:
+    """A generator seeded with `seed` on `device`, or None to use the global one."""
+    if seed is None:
+        return None
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
+
+def _per_row(value, batch_size: int, dtype: torch.dtype, device) -> torch.Tensor:
+    if isinstance(value, torch.Tensor):
+        return value.to(device, dtype)
+    return torch.full((batch_size,), value, dtype=dtype, device=device)
+
+@traced("sample", "sampling")
+def sample_tokens(
+    logits: torch.Tensor,
+    temperature=0.0,
+    top_k=0,
+    top_p=1.0,
+    generators: GeneratorArg = None,
+) -> torch.Tensor:
+    """
+    Pick the next token for every row of [batch, vocab] last-position logits.
+
+    `temperature`, `top_k` and `top_p` are scalars or [batch] tensors;
+    rows with a temperature of 0 are decoded greedily. `generators` is one
+    generator for the whole batch or one (or None) per row.
+    """
+    batch_size = logits.size(0)
+    device = logits.device
+    greedy = torch.argmax(logits, dim=-1)
+    temperature = _per_row(temperature, batch_size, torch.float32, device)
+    sampled_rows = temperature > 0
+    if not bool(sampled_rows.any()):
+        return greedy
+
+    scores = logits.float() / temperature.clamp(min=1e-5).unsqueeze(-1)
+    top_k = _per_row(top_k, batch_size, torch.long, device)
+    if bool((top_k > 0).any()):
+        limits = torch.where(top_k > 0, top_k, scores.size(-1)).clamp(max=scores.size(-1))
+        kth_scores = scores.topk(int(limits.max()), dim=-1).values.gather(-1, (limits - 1).unsqueeze(-1))
+        scores = scores.masked_fill(scores < kth_scores, float("-inf"))
+    top_p = _per_row(top_p, batch_size, torch.float32, device)
+    if bool((top_p < 1).any()):
+        sorted_scores, order = scores.sort(dim=-1, descending=True)
+        sorted_probs = sorted_scores.softmax(dim=-1)
+        # Drop a token once the tokens ranked above it already cover top_p.
+        outside = (sorted_probs.cumsum(dim=-1) - sorted_probs) >= top_p.unsqueeze(-1)
+        scores = scores.scatter(-1, order, sorted_scores.masked_fill(outside, float("-inf")))
+    probs = scores.softmax(dim=-1)
+
+    if generators is None or isinstance(generators, torch.Generator):
+        sampled = torch.multinomial(probs, num_samples=1, generator=generators).squeeze(-1)
+        return torch.where(sampled_rows, sampled, greedy)
+    tokens = greedy.clone()
+    for row in sampled_rows.nonzero().flatten().tolist():
+        tokens[row] = torch.multinomial(probs[row], num_samples=1, generator=generators[row])[0]
+    return tokens
+
+def top_logprobs(logits: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """The k highest log-probabilities of each row and their token ids, as [batch, k] tensors."""
+    values, indices = torch.log_softmax(logits.float(), dim=-1).topk(k, dim=-1)
+    return values, indices
@@ -0,0 +1,569 @@
+"""
+Continuous batching server for the sharded model.
+
+Rank 0 queues incoming requests and spreads them over a few independent
+decode batches ("groups"). Whenever a group's tokens come back from the last
+stage, its finished sequences are retired, waiting requests are admitted into
+the freed rows and the group's next step goes straight back into the
+pipeline. With one group in flight per stage, every node always has a step
+to work on.
+
+Every rank keeps each group's KV cache, padding mask and sampling
+parameters. Rank 0 describes a step with a small int64 plan that travels
+down the pipeline ahead of the activations, and every rank applies it the
+same way:
+
+    [group, kept rows, new rows, new prompt length, evicted blocks,
+     kept row indices...,
+     per new row: temperature, top_p (as float64 bits), top_k, seed, logprobs,
+                  cached blocks read, first block stored, blocks stored,
+     per new row: ids of the blocks read, then of the blocks stored,
+     ids of the evicted blocks]
+
+Kept rows decode one token each. New rows are prefilled, left-padded to a
+shared prompt length, and appended to the group. A new row whose prompt
+starts with blocks in the prefix cache (see prefix_cache.py) only prefills
+the rest of it, on top of the cached keys and values. The last stage samples a
+token for every row and sends the ids back to rank 0, kept rows first,
+followed by the rows' top log-probabilities if any row asked for them.
+"""
+import json
+import math
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+from . import metrics
+from .config import NodeConfig, SERVER_CONFIG
+from .prefix_cache import PrefixIndex, PrefixPlan, PrefixStore, prefix_cache_capacity
+from .sampling import SamplingParams, make_generator, sample_tokens, top_logprobs
+from .stage import PipelineStage
+from .transport import PipelineTransport
+
+STOP_GROUP = -1
+PLAN_FIELDS = 5
+ROW_FIELDS = 8
+NO_SEED = -1
+
+def prompt_bucket(length: int) -> int:
+    """
+    Padded length for a prefill: a multiple of 16, or of an eighth of the
+    length's power of two for longer prompts, so padding stays under a
+    quarter. Keeping the set of activation shapes small bounds the
+    transport's per-shape buffers.
+    """
+    step = max(16, 1 << max(length.bit_length() - 3, 0))
+    return -(-length // step) * step
+
+def parse_sampling(body: dict, temperature: float = 0.0) -> SamplingParams:
+    """Sampling parameters from a JSON request, with `temperature` as the default temperature."""
+    seed = body.get("seed")
+    return SamplingParams(
+        float(body.get("temperature", temperature)),
+        int(body.get("top_k", 0)),
+        float(body.get("top_p", 1.0)),
+        None if seed is None else int(seed),
+        int(body.get("logprobs", 0)),
+    )
+
+@dataclass
+class _Plan:
+    group: int
+    kept: List[int]
+    new_length: int = 0
+    sampling: List[SamplingParams] = field(default_factory=list)  # One per new row
+    prefix: Optional[PrefixPlan] = None
+
+    def encode(self, device=None) -> torch.Tensor:
+        prefix = self.prefix or PrefixPlan([[]] * len(self.sampling), [0] * len(self.sampling),
+                                           [[]] * len(self.sampling), [])
+        values = [self.group, len(self.kept), len(self.sampling), self.new_length, len(prefix.evicted)] + self.kept
+        for params, reads, store_from, stores in zip(self.sampling, prefix.reads, prefix.store_from, prefix.stores):
+            floats = torch.tensor([params.temperature, params.top_p], dtype=torch.float64).view(torch.int64)
+            seed = NO_SEED if params.seed is None else params.seed
+            values += floats.tolist() + [params.top_k, seed, params.logprobs, len(reads), store_from, len(stores)]
+        for reads, stores in zip(prefix.reads, prefix.stores):
+            values += reads + stores
+        values += prefix.evicted
+        return torch.tensor(values, dtype=torch.int64, device=device)
+
+    @classmethod
+    def decode(cls, tensor: torch.Tensor) -> "_Plan":
+        values = tensor.cpu()
+        group, num_kept, num_new, new_length, num_evicted = values[:PLAN_FIELDS].tolist()
+        kept = values[PLAN_FIELDS:PLAN_FIELDS + num_kept].tolist()
+        rows_end = PLAN_FIELDS + num_kept + num_new * ROW_FIELDS
+        rows = values[PLAN_FIELDS + num_kept:rows_end].reshape(num_new, ROW_FIELDS)
+        floats = rows[:, :2].contiguous().view(torch.float64).tolist()
+        sampling = [
+            SamplingParams(temperature, top_k, top_p, None if seed == NO_SEED else seed, logprobs)
+            for (temperature, top_p), (top_k, seed, logprobs) in zip(floats, rows[:, 2:5].tolist())
+        ]
+        ids = values[rows_end:].tolist()
+        reads, store_from, stores = [], [], []
+        for num_reads, first_stored, num_stores in rows[:, 5:].tolist():
+            reads.append(ids[:num_reads])
+            stores.append(ids[num_reads:num_reads + num_stores])
+            store_from.append(first_stored)
+            ids = ids[num_reads + num_stores:]
+        return cls(group, kept, new_length, sampling, PrefixPlan(reads, store_from, stores, ids[:num_evicted]))
+
+def _left_pad(tensor: torch.Tensor, length: int) -> torch.Tensor:
+    """Pad a [batch, heads, seq, dim] cache tensor on the left to `length` positions."""
+    return F.pad(tensor, (0, 0, length - tensor.size(-2), 0))
+
+class _GroupState:
+    """One decode batch's KV cache, padding mask and sampling state on this rank."""
+
+    def __init__(self):
+        self.cache: Optional[DynamicCache] = None
+        self.mask: Optional[torch.Tensor] = None  # [rows, cached positions], 1 for real tokens
+        self.sampling: List[SamplingParams] = []
+        self.generators: List[Optional[torch.Generator]] = []
+
+    @property
+    def num_logprobs(self) -> int:
+        """How many top log-probabilities the last stage returns per row."""
+        return max((params.logprobs for params in self.sampling), default=0)
+
+    @property
+    def cache_bytes(self) -> int:
+        if self.cache is None:
+            return 0
+        return sum(tensor.numel() * tensor.element_size()
+                   for layer in self.cache.layers if layer.get_seq_length() > 0
+                   for tensor in (layer.keys, layer.values))
+
+    def _map_cache(self, fn) -> None:
+        for layer in self.cache.layers:
+            # Layers owned by other ranks are never filled in this rank's cache.
+            if layer.get_seq_length() > 0:
+                layer.keys, layer.values = fn(layer.keys), fn(layer.values)
+
+    def retire(self, kept: List[int]) -> None:
+        """Keep only the `kept` rows, then drop positions that are padding in all of them."""
+        if not kept:
+            self.cache = self.mask = None
+            self.sampling, self.generators = [], []
+            return
+        if kept != list(range(self.mask.size(0))):
+            index = torch.tensor(kept, device=self.mask.device)
+            self._map_cache(lambda t: t[index])
+            self.mask = self.mask[index]
+            self.sampling = [self.sampling[row] for row in kept]
+            self.generators = [self.generators[row] for row in kept]
+        start = int(self.mask.any(dim=0).int().argmax())
+        if start > 0:
+            self._map_cache(lambda t: t[..., start:, :])
+            self.mask = self.mask[:, start:]
+
+    def decode(self, stage: PipelineStage, inputs: torch.Tensor) -> torch.Tensor:
+        positions = self.mask.sum(dim=-1, keepdim=True)
+        self.mask = F.pad(self.mask, (0, 1), value=1)
+        return stage(inputs, self.cache, attention_mask=self.mask, position_ids=positions, logits_to_keep=1)
+
+    def prefill(self, stage: PipelineStage, inputs: torch.Tensor, mask: torch.Tensor,
+                sampling: List[SamplingParams], prefix: Optional[PrefixPlan] = None,
+                store: Optional[PrefixStore] = None) -> torch.Tensor:
+        cache = DynamicCache()
+        positions = (mask.cumsum(dim=-1) - 1).clamp(min=0)
+        if prefix is not None and any(prefix.reads):
+            # Rows continue from their cached prefixes, left-padded to the longest.
+            cache, prefix_mask = store.read(prefix.reads)
+            positions = positions + prefix_mask.sum(dim=-1, keepdim=True)
+            mask = torch.cat([prefix_mask, mask], dim=-1)
+        outputs = stage(inputs, cache, attention_mask=mask, position_ids=positions, logits_to_keep=1)
+        if prefix is not None:
+            # A row's prompt position p sits in column (columns - prompt length + p).
+            prompt_lengths = mask.sum(dim=-1).tolist()
+            for row, (first, block_ids) in enumerate(zip(prefix.store_from, prefix.stores)):
+                if block_ids:
+                    store.save(cache, row, mask.size(1) - prompt_lengths[row] + first * store.block_size, block_ids)
+            store.evict(prefix.evicted)
+        self.sampling = self.sampling + sampling
+        self.generators = self.generators + [make_generator(params.seed, mask.device) for params in sampling]
+        if self.cache is None:
+            self.cache, self.mask = cache, mask
+            return outputs
+
+        # Left-pad whichever side is shorter so the newest positions line up.
+        length = max(self.mask.size(1), mask.size(1))
+        for layer, new_layer in zip(self.cache.layers, cache.layers):
+            if new_layer.get_seq_length() > 0:
+                layer.keys = torch.cat([_left_pad(layer.keys, length), _left_pad(new_layer.keys, length)])
+                layer.values = torch.cat([_left_pad(layer.values, length), _left_pad(new_layer.values, length)])
+        self.mask = torch.cat([
+            F.pad(self.mask, (length - self.mask.size(1), 0)),
+            F.pad(mask, (length - mask.size(1), 0)),
+        ])
+        return outputs
+
+    def sample(self, decode_outputs: Optional[torch.Tensor],
+               prefill_outputs: Optional[torch.Tensor]) -> List[torch.Tensor]:
+        """Each row's next token, then the top log-probabilities and their token ids if any row wants them."""
+        logits = torch.cat([outputs[:, -1, :] for outputs in (decode_outputs, prefill_outputs) if outputs is not None])
+        device = logits.device
+        tokens = sample_tokens(
+            logits,
+            torch.tensor([params.temperature for params in self.sampling], device=device),
+            torch.tensor([params.top_k for params in self.sampling], device=device),
+            torch.tensor([params.top_p for params in self.sampling], device=device),
+            self.generators,
+        )
+        if not self.num_logprobs:
+            return [tokens]
+        return [tokens, *top_logprobs(logits, self.num_logprobs)]
+
+def _stage_device(stage: PipelineStage) -> torch.device:
+    return next(stage.parameters()).device
+
+@torch.no_grad()
+def serve_stage(stage: PipelineStage, node_config: NodeConfig) -> None:
+    """Run this rank's part of every step rank 0 schedules, until rank 0 stops."""
+    groups: Dict[int, _GroupState] = defaultdict(_GroupState)
+    store = PrefixStore(SERVER_CONFIG["prefix_block_size"])
+    with PipelineTransport(node_config, _stage_device(stage)) as transport:
+        while True:
+            plan_tensor = transport.recv_forward()
+            if not transport.is_last:
+                transport.send_forward(plan_tensor)
+            plan = _Plan.decode(plan_tensor)
+            if plan.group == STOP_GROUP:
+                break
+
+            # Each received tensor is a view of a reused buffer, so it is used
+            # before the next receive. Decoded rows go on right away and the
+            # next stage works on them while this one prefills.
+            state = groups[plan.group]
+            state.retire(plan.kept)
+            decode_outputs = prefill_outputs = None
+            if plan.kept:
+                decode_outputs = state.decode(stage, transport.recv_forward())
+                if not transport.is_last:
+                    transport.send_forward(decode_outputs)
+            if plan.sampling:
+                prefill_mask = transport.recv_forward().clone()
+                prefill_outputs = state.prefill(stage, transport.recv_forward(), prefill_mask, plan.sampling,
+                                                plan.prefix, store)
+                if not transport.is_last:
+                    transport.send_forward(prefill_mask)
+                    transport.send_forward(prefill_outputs)
+            if transport.is_last:
+                for result in state.sample(decode_outputs, prefill_outputs):
+                    transport.send_to_first(result)
+            if metrics.metrics_enabled():
+                metrics.set_gauge("pipeline_kv_cache_bytes", sum(group.cache_bytes for group in groups.values()))
+                metrics.set_gauge("pipeline_prefix_cache_bytes", store.nbytes)
+
+@dataclass
+class GenerationRequest:
+    """A prompt submitted to the server, filled in as its tokens are generated."""
+    input_ids: List[int]
+    max_new_tokens: int
+    sampling: SamplingParams = field(default_factory=SamplingParams)
+    stop_token_ids: Tuple[int, ...] = ()
+    output_ids: List[int] = field(default_factory=list)
+    # For each output token, the `sampling.logprobs` most likely (token id, log-probability) pairs.
+    output_logprobs: List[List[Tuple[int, float]]] = field(default_factory=list)
+    error: Optional[str] = None
+    submitted_at: float = field(default_factory=time.perf_counter)
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    done: threading.Event = field(default_factory=threading.Event)
+    # Called from the batcher's thread once the request finishes; keep it cheap.
+    on_done: Optional[Callable[["GenerationRequest"], None]] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.done.is_set()
+
+    def add_token(self, token: int, logprobs: Optional[List[Tuple[int, float]]] = None) -> None:
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.output_ids.append(token)
+        if logprobs is not None:
+            self.output_logprobs.append(logprobs)
+        if len(self.output_ids) >= self.max_new_tokens or token in self.stop_token_ids:
+            self.finish(now)
+
+    def finish(self, now: Optional[float] = None, error: Optional[str] = None) -> None:
+        self.finished_at = now or time.perf_counter()
+        self.error = error
+        self.done.set()
+        if self.on_done:
+            self.on_done(self)
+
+class ContinuousBatcher:
+    """
+    Rank 0's scheduler. Any thread may `submit` requests; the thread that
+    calls `run` (the one using the process group) drives the pipeline until
+    `stop` is called and every accepted request has finished.
+    """
+
+    def __init__(self, stage: PipelineStage, node_config: NodeConfig,
+                 max_batch_size: Optional[int] = None, num_groups: Optional[int] = None):
+        self.stage = stage
+        self.node_config = node_config
+        self.max_batch_size = max_batch_size or SERVER_CONFIG["max_batch_size"]
+        self.num_groups = num_groups or SERVER_CONFIG["num_groups"] or node_config.world_size
+        self.max_positions = getattr(stage.config, "max_position_embeddings", None)
+        eos = stage.config.eos_token_id
+        self.eos_token_ids = tuple(eos) if isinstance(eos, (list, tuple)) else (() if eos is None else (eos,))
+        self.tokens_generated = 0
+
+        self._incoming: "queue.Queue[GenerationRequest]" = queue.Queue()
+        self._stopping = threading.Event()
+        self._waiting: Deque[GenerationRequest] = deque()
+        self._rows: List[List[GenerationRequest]] = [[] for _ in range(self.num_groups)]
+        self._states = [_GroupState() for _ in range(self.num_groups)]
+        self._local_results: Deque[List[list]] = deque()
+
+        block_size = SERVER_CONFIG["prefix_block_size"]
+        capacity = prefix_cache_capacity(stage.config, node_config.world_size, block_size)
+        self.prefix_index = PrefixIndex(block_size, capacity) if capacity else None
+        self.prefix_store = PrefixStore(block_size)
+
+    def submit(self, input_ids: List[int], max_new_tokens: Optional[int] = None,
+               sampling: Optional[SamplingParams] = None, stop_at_eos: bool = True,
+               on_done: Optional[Callable[[GenerationRequest], None]] = None) -> GenerationRequest:
+        """
+        Queue a prompt; wait on the returned request's `done` event (or pass
+        `on_done`) for the result.
+        """
+        max_new_tokens = max_new_tokens or SERVER_CONFIG["default_max_new_tokens"]
+        sampling = sampling or SamplingParams()
+        if not input_ids:
+            raise ValueError("The prompt must contain at least one token")
+        if max_new_tokens < 1:
+            raise ValueError("max_new_tokens must be positive")
+        sampling.validate()
+        if self.max_positions and len(input_ids) + max_new_tokens > self.max_positions:
+            raise ValueError(f"{len(input_ids)} prompt tokens plus {max_new_tokens} new tokens exceed "
+                             f"the model's {self.max_positions} positions")
+        if self._stopping.is_set():
+            raise RuntimeError("The server is shutting down")
+        request = GenerationRequest(
+            list(input_ids), max_new_tokens, sampling, self.eos_token_ids if stop_at_eos else (), on_done=on_done
+        )
+        self._incoming.put(request)
+        return request
+
+    def stop(self) -> None:
+        """Stop accepting requests; `run` returns once the accepted ones finish."""
+        self._stopping.set()
+
+    def status(self) -> dict:
+        status = {
+            "waiting": len(self._waiting) + self._incoming.qsize(),
+            "active": sum(not request.finished for rows in self._rows for request in rows),
+            "tokens_generated": self.tokens_generated,
+        }
+        if self.prefix_index is not None:
+            status["prefix_cache"] = {
+                **vars(self.prefix_index.stats),
+                "blocks": len(self.prefix_index),
+                "capacity_blocks": self.prefix_index.capacity,
+                "rank0_bytes": self.prefix_store.nbytes,
+            }
+        return status
+
+    def _update_gauges(self) -> None:
+        metrics.set_gauge("pipeline_queue_depth", len(self._waiting) + self._incoming.qsize())
+        metrics.set_gauge("pipeline_active_sequences",
+                          sum(not request.finished for rows in self._rows for request in rows))
+        metrics.set_gauge("pipeline_kv_cache_bytes", sum(state.cache_bytes for state in self._states))
+        metrics.set_gauge("pipeline_prefix_cache_bytes", self.prefix_store.nbytes)
+
+    def _take_incoming(self, block: bool) -> None:
+        try:
+            if block:
+                self._waiting.append(self._incoming.get(timeout=0.1))
+            while True:
+                self._waiting.append(self._incoming.get_nowait())
+        except queue.Empty:
+            pass
+
+    def _schedule(self, group: int) -> Optional[Tuple[_Plan, List[GenerationRequest]]]:
+        rows = self._rows[group]
+        kept = [index for index, request in enumerate(rows) if not request.finished]
+        # Spread the work evenly so the groups, and thus the stages' steps,
+        # stay about the same size.
+        active = sum(not request.finished for rows_ in self._rows for request in rows_)
+        target = math.ceil((active + len(self._waiting)) / self.num_groups)
+        room = min(self.max_batch_size, max(target, 1)) - len(kept)
+        new = [self._waiting.popleft() for _ in range(min(max(room, 0), len(self._waiting)))]
+
+        self._rows[group] = [rows[index] for index in kept] + new
+        if not self._rows[group]:
+            return None
+        prefix = None
+        if new and self.prefix_index is not None:
+            prefix = self.prefix_index.plan([request.input_ids for request in new])
+        # Only the part of each prompt after its cached prefix is prefilled.
+        uncached = [len(request.input_ids) - self._cached_length(prefix, row) for row, request in enumerate(new)]
+        new_length = prompt_bucket(max(uncached)) if new else 0
+        return _Plan(group, kept, new_length, [request.sampling for request in new], prefix), new
+
+    def _cached_length(self, prefix: Optional[PrefixPlan], row: int) -> int:
+        return len(prefix.reads[row]) * self.prefix_store.block_size if prefix else 0
+
+    def _issue(self, transport: PipelineTransport, plan: _Plan, new: List[GenerationRequest]) -> None:
+        device = _stage_device(self.stage)
+        if not transport.is_last:
+            transport.send_forward(plan.encode(device))
+
+        state = self._states[plan.group]
+        state.retire(plan.kept)
+        decode_outputs = prefill_outputs = None
+        if plan.kept:
+            kept_rows = self._rows[plan.group][:len(plan.kept)]
+            decode_inputs = torch.tensor([[request.output_ids[-1]] for request in kept_rows], device=device)
+            decode_outputs = state.decode(self.stage, decode_inputs)
+            if not transport.is_last:
+                transport.send_forward(decode_outputs)
+        if new:
+            prefill_inputs = torch.zeros(len(new), plan.new_length, dtype=torch.long)
+            prefill_mask = torch.zeros(len(new), plan.new_length, dtype=torch.long)
+            for row, request in enumerate(new):
+                cached = self._cached_length(plan.prefix, row)
+                prefill_inputs[row, -(len(request.input_ids) - cached):] = torch.tensor(request.input_ids[cached:])
+                prefill_mask[row, -(len(request.input_ids) - cached):] = 1
+            prefill_mask = prefill_mask.to(device)
+            prefill_outputs = state.prefill(self.stage, prefill_inputs.to(device), prefill_mask, plan.sampling,
+                                            plan.prefix, self.prefix_store)
+            if not transport.is_last:
+                transport.send_forward(prefill_mask)
+                transport.send_forward(prefill_outputs)
+        if transport.is_last:
+            self._local_results.append([result.tolist() for result in state.sample(decode_outputs, prefill_outputs)])
+
+    def _receive(self, transport: PipelineTransport, group: int) -> List[list]:
+        """The results `serve_stage` sends for a step of `group`, in the same order."""
+        # Received tensors are views of reused buffers, so each is read out before the next receive.
+        results = [transport.recv_from_last().tolist()]
+        if self._states[group].num_logprobs:
+            results += [transport.recv_from_last().tolist() for _ in range(2)]
+        return results
+
+    @torch.no_grad()
+    def run(self) -> None:
+        in_flight: Deque[int] = deque()
+        with PipelineTransport(self.node_config, _stage_device(self.stage)) as transport:
+            while True:
+                idle = not in_flight and not self._waiting
+                self._take_incoming(block=idle and not self._stopping.is_set())
+                for group in range(self.num_groups):
+                    if group not in in_flight:
+                        scheduled = self._schedule(group)
+                        if scheduled:
+                            self._issue(transport, *scheduled)
+                            in_flight.append(group)
+
+                if not in_flight:
+                    if self._stopping.is_set() and not self._waiting and self._incoming.empty():
+                        break
+                    continue
+
+                # Steps come back in the order they were issued.
+                group = in_flight.popleft()
+                results = self._local_results.popleft() if transport.is_last else self._receive(transport, group)
+                tokens, *logprobs = results
+                for row, (request, token) in enumerate(zip(self._rows[group], tokens)):
+                    count = request.sampling.logprobs
+                    top = None
+                    if count:
+                        values, indices = logprobs
+                        top = list(zip(indices[row][:count], values[row][:count]))
+                    request.add_token(token, top)
+                self.tokens_generated += len(self._rows[group])
+                metrics.inc("pipeline_tokens_generated_total", len(self._rows[group]))
+                if metrics.metrics_enabled():
+                    self._update_gauges()
+
+            if not transport.is_last:
+                transport.send_forward(_Plan(STOP_GROUP, []).encode(_stage_device(self.stage)))
+
+        # Anything submitted while the loop was exiting never ran.
+        self._take_incoming(block=False)
+        for request in self._waiting:
+            request.finish(error="The server stopped before running this request")
+
+def make_http_server(batcher: ContinuousBatcher, tokenizer, host: Optional[str] = None,
+                     port: Optional[int] = None) -> ThreadingHTTPServer:
+    """
+    HTTP front end for the batcher, served from its own threads:
+
+        POST /generate  {"prompt": "...", "max_new_tokens": 32, "temperature": 0.0,
+                         "top_k": 0, "top_p": 1.0, "seed": null, "logprobs": 0}
+                        ("input_ids": [...] may replace "prompt")
+        GET  /health
+    """
+    tokenizer_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                return self._reply(404, {"error": f"Unknown path {self.path}"})
+            self._reply(200, {"status": "ok", **batcher.status()})
+
+        def do_POST(self):
+            if self.path != "/generate":
+                return self._reply(404, {"error": f"Unknown path {self.path}"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                input_ids = body.get("input_ids")
+                if input_ids is None:
+                    if "prompt" not in body:
+                        raise ValueError("Expected a 'prompt' or 'input_ids'")
+                    with tokenizer_lock:
+                        input_ids = tokenizer(body["prompt"]).input_ids
+                request = batcher.submit(
+                    [int(token) for token in input_ids],
+                    body.get("max_new_tokens"),
+                    parse_sampling(body),
+                    bool(body.get("stop_at_eos", True)),
+                )
+            except (ValueError, TypeError) as e:
+                return self._reply(400, {"error": str(e)})
+            except RuntimeError as e:
+                return self._reply(503, {"error": str(e)})
+
+            request.done.wait()
+            if request.error:
+                return self._reply(503, {"error": request.error})
+            with tokenizer_lock:
+                text = tokenizer.decode(request.output_ids, skip_special_tokens=True)
+            result = {
+                "text": text,
+                "output_ids": request.output_ids,
+                "prompt_tokens": len(request.input_ids),
+                "completion_tokens": len(request.output_ids),
+                "time_to_first_token": request.first_token_at - request.submitted_at,
+                "latency": request.finished_at - request.submitted_at,
+            }
+            if request.sampling.logprobs:
+                result["logprobs"] = request.output_logprobs
+            self._reply(200, result)
+
+        def log_message(self, format, *args):
+            # One line per request would swamp the node's log under load.
+            pass
+
+    server = ThreadingHTTPServer((host or SERVER_CONFIG["host"], port or SERVER_CONFIG["port"]), Handler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,118 @@
+"""
+On-disk cache of pre-sharded checkpoints.
+
+Each rank's pruned weights are stored as a safetensors file next to a small
+JSON manifest describing where they came from (model, checkpoint revision,
+world size, layer partition, dtype and arch paths). A node whose manifest
+matches its current run can memory-map its shard directly instead of reading
+the full Hugging Face checkpoint.
+
+The revision is the Hugging Face snapshot commit of a hub model, or a hash of
+the sizes and modification times of a local checkpoint directory's files, so
+an updated checkpoint misses the cache instead of loading the old shard.
+
+Layout: <cache dir>/<model name>/ws<world size>-<dtype>-<partition hash>/rank<rank>.{safetensors,json}
+(the hash also covers the checkpoint revision and a quantized shard's quantization)
+"""
+import hashlib
+import json
+import os
+from typing import List, Optional, Tuple
+from torch import nn
+
+FORMAT_VERSION = 2
+
+# Files of a local checkpoint directory that a shard depends on.
+CHECKPOINT_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth", "config.json", ".index.json")
+
+def checkpoint_revision(model_name: str) -> Optional[str]:
+    """
+    Identify the checkpoint a model name currently resolves to, without
+    touching the network. None if it is not available locally.
+    """
+    if os.path.isdir(model_name):
+        stats = []
+        for name in sorted(os.listdir(model_name)):
+            if name.endswith(CHECKPOINT_SUFFIXES):
+                stat = os.stat(os.path.join(model_name, name))
+                stats.append([name, stat.st_size, stat.st_mtime_ns])
+        if not stats:
+            return None
+        return "local-" + hashlib.sha1(json.dumps(stats).encode()).hexdigest()[:12]
+
+    from huggingface_hub import try_to_load_from_cache
+
+    # Resolves the cached "main" ref to <cache>/snapshots/<commit>/config.json.
+    path = try_to_load_from_cache(model_name, "config.json")
+    if not isinstance(path, str):
+        return None
+    return os.path.basename(os.path.dirname(path))
+
+def shard_manifest(model_name: str, revision: str, arch_config: dict, dtype: str,
+                   ranges: List[Tuple[int, int]], rank: int, quantization: Optional[dict] = None) -> dict:
+    """The manifest a cached shard must have to be used for this run."""
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "model_name": model_name,
+        "revision": revision,
+        "world_size": len(ranges),
+        "rank": rank,
+        "layer_range": list(ranges[rank]),
+        "partition": [list(r) for r in ranges],
+        "dtype": dtype,
+        "arch_config": arch_config,
+    }
+    if quantization:
+        manifest["quantization"] = quantization
+    return manifest
+
+def shard_paths(cache_dir: str, manifest: dict) -> Tuple[str, str]:
+    """Weights and manifest file paths for a shard."""
+    parts = [manifest["revision"], manifest["partition"], manifest["arch_config"]]
+    if "quantization" in manifest:
+        parts.append(manifest["quantization"])
+    key = json.dumps(parts, sort_keys=True)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:10]
+    directory = os.path.join(
+        os.path.expanduser(cache_dir),
+        manifest["model_name"].replace("/", "--"),
+        f"ws{manifest['world_size']}-{manifest['dtype']}-{digest}",
+    )
+    base = os.path.join(directory, f"rank{manifest['rank']}")
+    return base + ".safetensors", base + ".json"
+
+def find_cached_shard(cache_dir: str, manifest: dict) -> Optional[str]:
+    """Path to the cached weights if a shard with exactly this manifest exists."""
+    weights_path, manifest_path = shard_paths(cache_dir, manifest)
+    if not (os.path.exists(weights_path) and os.path.exists(manifest_path)):
+        return None
+    try:
+        with open(manifest_path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return weights_path if cached == manifest else None
+
+def save_shard(model: nn.Module, cache_dir: str, manifest: dict) -> str:
+    """
+    Write a pruned model's parameters and manifest to the cache. Tensors
+    shared between modules (tied embeddings) are stored once.
+    """
+    from safetensors.torch import save_file
+
+    weights_path, manifest_path = shard_paths(cache_dir, manifest)
+    os.makedirs(os.path.dirname(weights_path), exist_ok=True)
+
+    tensors = {
+        name: param.detach().cpu().contiguous()
+        for name, param in model.named_parameters()
+    }
+
+    # Write to temporary names first so a crash never leaves a half-written
+    # shard that looks valid.
+    save_file(tensors, weights_path + ".tmp", metadata={"format": "pt"})
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(weights_path + ".tmp", weights_path)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return weights_path
@@ -0,0 +1,169 @@
+"""
+Speculative decoding across the pipeline.
+
+Plain decoding pays a round trip through every stage for each token. Here
+rank 0 runs a small draft model locally to propose a few tokens, and the
+sharded target model checks all of them in one pass: the last stage samples
+its own token after every draft prefix, and rank 0 keeps the drafted tokens
+up to the first one the target disagrees with, plus the target's token
+there. Every stage then drops the rejected positions from its KV cache.
+
+Each pass starts with a small int64 plan from rank 0 that travels down the
+pipeline ahead of the activations:
+
+    [cached positions to keep, positions to sample]  (a negative keep stops)
+
+Every committed token is one the target itself sampled, so the output
+follows the target model's distribution (with temperature 0 it is exactly
+`generate`'s); the draft only decides how many tokens each pass yields.
+"""
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+import torch
+import torch.nn as nn
+from transformers import AutoModelForCausalLM, DynamicCache
+from . import metrics
+from .config import NodeConfig, MODEL_CONFIG
+from .sampling import make_generator, sample_tokens
+from .stage import PipelineStage, cached_length, crop_cache
+from .transport import PipelineTransport
+
+STOP = -1
+
+@dataclass
+class SpeculativeStats:
+    """How one speculative_generate() call went, as seen by rank 0."""
+    passes: int = 0  # Round trips through the pipeline
+    drafted: int = 0  # Tokens the draft model proposed
+    accepted: int = 0  # Proposed tokens the target agreed with
+    draft_time: float = 0.0  # Seconds spent in the draft model
+    total_time: float = 0.0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    @property
+    def tokens_per_pass(self) -> float:
+        return (self.accepted + self.passes) / self.passes if self.passes else 0.0
+
+def load_draft_model(model_name: Optional[str] = None, device: Optional[str] = None) -> nn.Module:
+    """Load the whole draft model (default MODEL_CONFIG["draft_model"]) for rank 0."""
+    model_name = model_name or MODEL_CONFIG["draft_model"]
+    dtype = getattr(torch, MODEL_CONFIG["dtype"])
+    model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype, low_cpu_mem_usage=True)
+    return model.to(device or MODEL_CONFIG["device"]).eval()
+
+def _draft(draft_model: nn.Module, cache: DynamicCache, pending: List[int], count: int, device) -> List[int]:
+    """Greedily extend the sequence by `count` tokens, feeding the draft what its cache lacks."""
+    proposed = []
+    inputs = torch.tensor([pending], device=device)
+    for _ in range(count):
+        logits = draft_model(input_ids=inputs, past_key_values=cache, use_cache=True).logits
+        token = int(logits[0, -1].argmax())
+        proposed.append(token)
+        inputs = torch.tensor([[token]], device=device)
+    return proposed
+
+@torch.no_grad()
+def speculative_generate(
+    model: PipelineStage,
+    input_ids: torch.Tensor,
+    node_config: NodeConfig,
+    draft_model: Optional[nn.Module] = None,
+    max_new_tokens: int = 20,
+    num_draft_tokens: Optional[int] = None,
+    temperature: float = 0.0,
+    top_k: int = 0,
+    top_p: float = 1.0,
+    seed: Optional[int] = None,
+    return_stats: bool = False,
+):
+    """
+    Generate `max_new_tokens` tokens like `generate`, checking up to
+    `num_draft_tokens` (default MODEL_CONFIG["num_draft_tokens"]) tokens
+    from `draft_model` per pipeline pass.
+
+    Every rank calls this; only rank 0's `input_ids` (a single sequence) and
+    `draft_model` are used. The draft must share the target's vocabulary.
+
+    Returns:
+        The prompt plus generated tokens on rank 0, None on every other rank.
+        With `return_stats`, a (tokens, SpeculativeStats) tuple instead.
+    """
+    num_draft_tokens = MODEL_CONFIG["num_draft_tokens"] if num_draft_tokens is None else num_draft_tokens
+    device = input_ids.device
+    stats = SpeculativeStats()
+    start = time.perf_counter()
+    if node_config.rank == 0:
+        if input_ids.size(0) != 1:
+            raise ValueError("Speculative decoding handles one sequence at a time")
+        if draft_model is None:
+            raise ValueError("Rank 0 needs a draft model")
+        if draft_model.config.vocab_size != model.config.vocab_size:
+            raise ValueError(f"The draft model's vocabulary ({draft_model.config.vocab_size} tokens) differs "
+                             f"from the target's ({model.config.vocab_size})")
+
+    with PipelineTransport(node_config, device) as transport:
+        cache = DynamicCache()
+        generator = make_generator(seed, device) if transport.is_last else None
+
+        if not transport.is_first:
+            while True:
+                plan = transport.recv_forward()
+                if not transport.is_last:
+                    transport.send_forward(plan)
+                keep, num_logits = plan.tolist()
+                if keep == STOP:
+                    break
+                crop_cache(cache, keep)
+                outputs = model(transport.recv_forward(), cache, logits_to_keep=num_logits)
+                if not transport.is_last:
+                    transport.send_forward(outputs)
+                else:
+                    transport.send_to_first(sample_tokens(outputs[0], temperature, top_k, top_p, generator))
+            return (None, stats) if return_stats else None
+
+        # Rank 0: `sequence` is everything committed so far. The target's
+        # caches hold all of it but the newest token, which is fed in next.
+        sequence = input_ids[0].tolist()
+        draft_cache = DynamicCache()
+        generated = 0
+        while generated < max_new_tokens:
+            # Never propose more than could be committed.
+            count = min(num_draft_tokens, max_new_tokens - generated - 1)
+            draft_start = time.perf_counter()
+            proposed = _draft(draft_model, draft_cache, sequence[cached_length(draft_cache):], count, device)
+            stats.draft_time += time.perf_counter() - draft_start
+
+            keep = len(sequence) - 1 if generated else 0
+            plan = torch.tensor([keep, count + 1], dtype=torch.int64, device=device)
+            step_inputs = torch.tensor([sequence[keep:] + proposed], device=device)
+            crop_cache(cache, keep)
+            outputs = model(step_inputs, cache, logits_to_keep=count + 1)
+            if transport.is_last:
+                targets = sample_tokens(outputs[0], temperature, top_k, top_p, generator).tolist()
+            else:
+                transport.send_forward(plan)
+                transport.send_forward(outputs)
+                targets = transport.recv_from_last().tolist()
+
+            accepted = 0
+            while accepted < count and proposed[accepted] == targets[accepted]:
+                accepted += 1
+            sequence += proposed[:accepted] + [targets[accepted]]
+            generated += accepted + 1
+            # The draft's cache may run ahead of what was accepted.
+            crop_cache(draft_cache, len(sequence) - 1)
+            stats.passes += 1
+            stats.drafted += count
+            stats.accepted += accepted
+            metrics.inc("pipeline_tokens_generated_total", accepted + 1)
+
+        if not transport.is_last:
+            transport.send_forward(torch.tensor([STOP, 0], dtype=torch.int64, device=device))
+
+    stats.total_time = time.perf_counter() - start
+    result = torch.tensor([sequence], device=device)
+    return (result, stats) if return_stats else result
@@ -0,0 +1,157 @@
+"""
+The part of a model that one pipeline rank runs.
+
+`PipelineStage` resolves the arch config's module paths once, when the shard
+is loaded, and keeps direct references to the modules this rank owns. Its
+forward pass is then plain module calls with no per-call path lookups or
+logging, which keeps per-token overhead low and lets the stage be compiled.
+"""
+from typing import Optional
+import torch
+from torch import nn
+from transformers import DynamicCache
+from .config import NodeConfig
+from .tracing import span
+from .utils import get_nested_attr
+
+def _owned(model: nn.Module, path: Optional[str]) -> Optional[nn.Module]:
+    """The module at `path`, or None if the model has none or it was pruned away."""
+    if not path:
+        return None
+    module = get_nested_attr(model, path)
+    if module is None or isinstance(module, nn.Identity):
+        return None
+    return module
+
+def causal_mask(seq_length: int, past_length: int, dtype: torch.dtype, device,
+                padding_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Additive (batch, 1, seq, past + seq) mask letting each new token see the
+    cache and earlier new tokens. `padding_mask` ([batch, past + seq], 1 for
+    real tokens) additionally hides padding positions.
+    """
+    allowed = torch.ones(seq_length, past_length + seq_length, dtype=torch.bool, device=device)
+    allowed = torch.tril(allowed, diagonal=past_length)[None, None]
+    if padding_mask is not None:
+        allowed = allowed & padding_mask.bool()[:, None, None, :]
+    # Filling rather than adding keeps fully masked (padding) rows finite.
+    return torch.zeros(allowed.shape, dtype=dtype, device=device).masked_fill(~allowed, torch.finfo(dtype).min)
+
+def cached_length(past_key_values: DynamicCache) -> int:
+    """Number of positions already cached by the layers this rank owns."""
+    return max((past_key_values.get_seq_length(i) for i in range(len(past_key_values.layers))), default=0)
+
+def crop_cache(past_key_values: DynamicCache, length: int) -> None:
+    """Drop every cached position from `length` on, e.g. rejected speculative tokens."""
+    for layer in past_key_values.layers:
+        if layer.get_seq_length() > length:
+            layer.keys = layer.keys[..., :length, :]
+            layer.values = layer.values[..., :length, :]
+
+class PipelineStage(nn.Module):
+    """
+    One rank's slice of a pruned model: the embeddings on the first rank,
+    its range of decoder layers, and the final norm and lm_head on the last
+    rank. The first stage takes token ids, every other one hidden states;
+    the last stage returns logits, every other one hidden states.
+    """
+
+    def __init__(self, model: nn.Module, arch_config: dict, node_config: NodeConfig):
+        super().__init__()
+        self.config = model.config
+        self.is_first = node_config.rank == 0
+        self.is_last = node_config.rank == node_config.world_size - 1
+        self.embed_tokens = self.embed_positions = self.project_in = None
+        self.final_norm = self.project_out = self.lm_head = None
+
+        if self.is_first:
+            self.embed_tokens = get_nested_attr(model, arch_config["embedding_path"])
+            # Models with rotary embeddings (e.g. GPT-J) have no positional table.
+            self.embed_positions = _owned(model, arch_config.get("positional_embedding_path"))
+            self.project_in = _owned(model, arch_config.get("project_in_path"))
+        self.layers = get_nested_attr(model, arch_config["layers_path"])
+        if self.is_last:
+            # Some models (e.g. opt-350m) have no final norm at all.
+            self.final_norm = _owned(model, arch_config["final_norm_path"])
+            self.project_out = _owned(model, arch_config.get("project_out_path"))
+            self.lm_head = get_nested_attr(model, arch_config["lm_head_path"])
+
+        self.position_offset = arch_config.get("positional_embedding_offset", 0)
+        # Some subclasses (e.g. OPT's) override forward to derive positions
+        # from an attention mask; for those, call the plain lookup instead.
+        self.plain_position_lookup = isinstance(self.embed_positions, nn.Embedding)
+        self.cache_kwarg = arch_config.get("cache_kwarg", "past_key_values")
+
+    def embed(self, input_ids: torch.Tensor, position_ids: torch.Tensor) -> torch.Tensor:
+        hidden_states = self.embed_tokens(input_ids)
+        # Projections (e.g. opt-350m) map token embeddings to the model width
+        # before positions are added.
+        if self.project_in is not None:
+            hidden_states = self.project_in(hidden_states)
+        if self.embed_positions is not None:
+            positions = position_ids + self.position_offset
+            if self.plain_position_lookup:
+                hidden_states = hidden_states + nn.Embedding.forward(self.embed_positions, positions)
+            else:
+                hidden_states = hidden_states + self.embed_positions(positions)
+        return hidden_states
+
+    def head(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        if self.final_norm is not None:
+            hidden_states = self.final_norm(hidden_states)
+        if self.project_out is not None:
+            hidden_states = self.project_out(hidden_states)
+        return self.lm_head(hidden_states)
+
+    def forward(
+        self,
+        inputs: torch.Tensor,
+        past_key_values: Optional[DynamicCache] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+        logits_to_keep: int = 0,
+    ) -> torch.Tensor:
+        """
+        Run this stage on `inputs`. When `past_key_values` is given, each layer
+        appends its keys/values to it and `inputs` only needs to hold the
+        positions that are new since the previous call.
+
+        For padded batches, `attention_mask` ([batch, past + seq], 1 for real
+        tokens) hides the padding and `position_ids` ([batch, seq]) gives
+        every row's own positions; without them all rows are taken to be
+        unpadded.
+
+        On the last stage, a non-zero `logits_to_keep` only projects that
+        many final positions to the vocabulary; decoding needs just one.
+        """
+        use_cache = past_key_values is not None
+        past_length = cached_length(past_key_values) if use_cache else 0
+        seq_length = inputs.size(1)
+        if position_ids is None:
+            # Positions continue from whatever this rank's layers have already cached.
+            position_ids = torch.arange(past_length, past_length + seq_length, device=inputs.device).unsqueeze(0)
+
+        with span("forward", tokens=seq_length, layers=len(self.layers)):
+            hidden_states = self.embed(inputs, position_ids) if self.is_first else inputs
+
+            # Layers called on their own don't get the mask their parent model would
+            # build, and some attention implementations (e.g. GPT-J's) are not causal
+            # without one.
+            mask = causal_mask(seq_length, past_length, hidden_states.dtype, hidden_states.device, attention_mask)
+            cache_kwargs = {self.cache_kwarg: past_key_values}
+            for layer in self.layers:
+                layer_outputs = layer(
+                    hidden_states,
+                    attention_mask=mask,
+                    position_ids=position_ids,
+                    use_cache=use_cache,
+                    **cache_kwargs,
+                )
+                # Older transformers releases return a tuple, newer ones the tensor itself.
+                hidden_states = layer_outputs[0] if isinstance(layer_outputs, tuple) else layer_outputs
+
+            if not self.is_last:
+                return hidden_states
+            if logits_to_keep:
+                hidden_states = hidden_states[:, -logits_to_keep:, :]
+            return self.head(hidden_states)
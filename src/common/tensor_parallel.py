@@ -0,0 +1,245 @@
+"""
+Tensor parallelism: every rank runs every layer, on its own slice of it.
+
+Pipelining (see model_sharding.py) hands each rank a range of layers, so a
+single request still visits every layer one rank after another. Here each
+decoder layer is split Megatron-style instead: the attention heads and the
+MLP's hidden columns are divided between the ranks, so all of them work on
+the same token at once. Per layer that is
+
+    column layers (q/k/v, the MLP's first projection): output features split,
+        each rank computes its own heads / columns with no communication
+    row layers (attention output, the MLP's second projection): input
+        features split, each rank holds a partial sum that an all-reduce
+        over the gloo group adds up
+
+which costs two all-reduces of the hidden state per layer. The split is
+described per family by the "tensor_parallel" entry in MODEL_REGISTRY.
+Embeddings, norms and the lm_head are small next to the layers and are kept
+whole on every rank, so every rank ends each step with identical logits.
+"""
+import dataclasses
+import time
+from typing import Dict, Optional, Tuple
+import torch
+import torch.distributed as dist
+from torch import nn
+from transformers import AutoConfig, AutoModelForCausalLM, DynamicCache
+from . import metrics
+from .config import NodeConfig, MODEL_CONFIG
+from .model_sharding import (
+    GenerationStats, _build_empty_model, _find_safetensors_files, _load_shard_weights, _log,
+)
+from .quantization import quantize_layers, stage_quantization
+from .sampling import make_generator, sample_tokens
+from .stage import PipelineStage
+from .tracing import span
+from .utils import get_nested_attr, set_nested_attr, synchronize_device
+
+class RowParallel(nn.Module):
+    """A row-split layer whose partial outputs are summed across all ranks."""
+
+    def __init__(self, module: nn.Module):
+        super().__init__()
+        self.module = module
+        self.bytes_reduced = 0
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        output = self.module(hidden_states)
+        # gloo only reduces CPU tensors.
+        reduced = output.cpu() if output.device.type != "cpu" else output
+        with span("all_reduce", "transport", bytes=reduced.numel() * reduced.element_size()):
+            dist.all_reduce(reduced)
+        self.bytes_reduced += reduced.numel() * reduced.element_size()
+        return reduced.to(output.device)
+
+def _is_linear(module: nn.Module) -> bool:
+    # GPT-2's Conv1D stores its weight transposed, as [in, out].
+    return isinstance(module, nn.Linear)
+
+def _column_slice(tensor: torch.Tensor, dim: int, parts: int, rank: int, world_size: int) -> torch.Tensor:
+    """This rank's share of each of the `parts` fused blocks along `dim`."""
+    blocks = tensor.chunk(parts, dim=dim)
+    size = blocks[0].size(dim)
+    if size % world_size:
+        raise ValueError(f"{size} features cannot be split evenly across {world_size} ranks")
+    share = size // world_size
+    return torch.cat([block.narrow(dim, rank * share, share) for block in blocks], dim=dim)
+
+def _row_slice(tensor: torch.Tensor, dim: int, rank: int, world_size: int) -> torch.Tensor:
+    size = tensor.size(dim)
+    if size % world_size:
+        raise ValueError(f"{size} features cannot be split evenly across {world_size} ranks")
+    share = size // world_size
+    return tensor.narrow(dim, rank * share, share)
+
+def shard_plan(model: nn.Module, arch_config: dict) -> Dict[str, Tuple[str, int, bool]]:
+    """
+    Map each split parameter's name to ("column", fused parts, is_linear) or
+    ("row", 1, is_linear), for every decoder layer.
+    """
+    layout = arch_config.get("tensor_parallel")
+    if not layout:
+        raise ValueError(f"MODEL_REGISTRY has no tensor_parallel layout for {arch_config['model_type']} models")
+    plan = {}
+    layers = get_nested_attr(model, arch_config["layers_path"])
+    for index, layer in enumerate(layers):
+        prefix = f"{arch_config['layers_path']}.{index}"
+        for kind, paths in (("column", layout["column"]), ("row", {path: 1 for path in layout["row"]})):
+            for path, parts in paths.items():
+                module = get_nested_attr(layer, path)
+                for param_name, _ in module.named_parameters():
+                    plan[f"{prefix}.{path}.{param_name}"] = (kind, parts, _is_linear(module))
+    return plan
+
+def slice_parameter(name: str, tensor: torch.Tensor, plan: dict, rank: int, world_size: int) -> torch.Tensor:
+    """This rank's part of the full parameter `name`, as a tensor of its own."""
+    if name not in plan:
+        return tensor
+    kind, parts, is_linear = plan[name]
+    is_bias = tensor.dim() == 1
+    if kind == "column":
+        # Output features are dim 0 of a Linear weight and dim 1 of a Conv1D's.
+        dim = 0 if is_bias or is_linear else 1
+        return _column_slice(tensor, dim, parts, rank, world_size).clone()
+    if is_bias:
+        # The all-reduce would add a row layer's bias once per rank.
+        return tensor.clone() if rank == 0 else torch.zeros_like(tensor)
+    return _row_slice(tensor, 1 if is_linear else 0, rank, world_size).clone()
+
+def _finish_layers(model: nn.Module, arch_config: dict, world_size: int) -> None:
+    """Fix up module attributes for the sliced weights and wrap the row layers."""
+    layout = arch_config["tensor_parallel"]
+    for layer in get_nested_attr(model, arch_config["layers_path"]):
+        attention = get_nested_attr(layer, layout["attention_path"])
+        for attr in layout["head_attrs"]:
+            value = getattr(attention, attr)
+            if value % world_size:
+                raise ValueError(f"{attr}={value} cannot be split evenly across {world_size} ranks")
+            setattr(attention, attr, value // world_size)
+        for path in layout["column"]:
+            module = get_nested_attr(layer, path)
+            if _is_linear(module):
+                module.out_features = module.weight.size(0)
+            else:
+                module.nf = module.weight.size(1)
+        for path in layout["row"]:
+            module = get_nested_attr(layer, path)
+            if _is_linear(module):
+                module.in_features = module.weight.size(1)
+            if world_size > 1:
+                set_nested_attr(layer, path, RowParallel(module))
+
+def load_tensor_parallel_model(node_config: NodeConfig, device: Optional[str] = None) -> PipelineStage:
+    """
+    Load this rank's slice of every layer of MODEL_CONFIG's model, plus the
+    embeddings and head whole. As with `load_partial_model`, the skeleton is
+    built on the meta device and each tensor is cut down as soon as it is
+    read, so peak memory stays close to the slice.
+    """
+    model_name = MODEL_CONFIG["model_name"]
+    arch_config = MODEL_CONFIG["model_arch_config"]
+    device = device or MODEL_CONFIG["device"]
+    dtype = getattr(torch, MODEL_CONFIG["dtype"])
+    rank, world_size = node_config.rank, node_config.world_size
+
+    config = AutoConfig.from_pretrained(model_name)
+    _log(rank, f"Node {node_config.name} loading slice {rank + 1}/{world_size} of every layer")
+    model = _build_empty_model(config)
+    plan = shard_plan(model, arch_config)
+
+    def transform(name, tensor):
+        return slice_parameter(name, tensor, plan, rank, world_size)
+
+    def slice_in_place(model):
+        for name in plan:
+            param = get_nested_attr(model, name)
+            set_nested_attr(model, name, nn.Parameter(transform(name, param.data), requires_grad=False))
+
+    files = _find_safetensors_files(model_name)
+    if files:
+        # Shrink the meta skeleton first so the slices fit where they are loaded.
+        slice_in_place(model)
+        names = [name for name, _ in model.named_parameters(remove_duplicate=False)]
+        _load_shard_weights(model, files, names, dtype, arch_config, config, transform)
+    else:
+        _log(rank, "No safetensors weights found, loading full model with from_pretrained...")
+        model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype, low_cpu_mem_usage=True)
+        slice_in_place(model)
+
+    if getattr(config, "tie_word_embeddings", False):
+        lm_head_weight = f"{arch_config['lm_head_path']}.weight"
+        set_nested_attr(model, lm_head_weight, get_nested_attr(model, f"{arch_config['embedding_path']}.weight"))
+    _finish_layers(model, arch_config, world_size)
+    quantization = stage_quantization(node_config)
+    if quantization != "none":
+        replaced = quantize_layers(get_nested_attr(model, arch_config["layers_path"]), quantization)
+        _log(rank, f"Quantized {replaced} linear layers to {quantization}.")
+
+    # Every rank runs the whole (sliced) model, from token ids to logits.
+    whole = dataclasses.replace(node_config, rank=0, world_size=1)
+    return PipelineStage(model, arch_config, whole).to(device)
+
+@torch.no_grad()
+def tensor_parallel_generate(
+    model: PipelineStage,
+    input_ids: torch.Tensor,
+    node_config: NodeConfig,
+    max_new_tokens: int = 20,
+    temperature: float = 0.0,
+    return_stats: bool = False,
+    top_k: int = 0,
+    top_p: float = 1.0,
+    seed: Optional[int] = None,
+):
+    """
+    `generate` for a model loaded with `load_tensor_parallel_model`.
+
+    Every rank calls this; rank 0 broadcasts its `input_ids` once. All ranks
+    then hold identical logits after every step and sample from them with
+    identically seeded generators (rank 0 picks a seed if there is none), so
+    the only communication per token is the layers' all-reduces.
+
+    Returns:
+        The prompt plus generated tokens on rank 0, None on every other rank.
+        With `return_stats`, a (tokens, GenerationStats) tuple instead.
+    """
+    stats = GenerationStats()
+    device = input_ids.device
+    header = torch.tensor(
+        [*input_ids.shape, seed if seed is not None else int(torch.randint(2**62, ()))]
+        if node_config.rank == 0 else [0, 0, 0],
+        dtype=torch.int64,
+    )
+    dist.broadcast(header, src=0)
+    batch_size, seq_length, seed = header.tolist()
+    prompt = input_ids.cpu() if node_config.rank == 0 else torch.empty(batch_size, seq_length, dtype=torch.int64)
+    dist.broadcast(prompt, src=0)
+    prompt = prompt.to(device)
+
+    row_layers = [module for module in model.modules() if isinstance(module, RowParallel)]
+    reduced_before = sum(module.bytes_reduced for module in row_layers)
+    past_key_values = DynamicCache()
+    generator = make_generator(seed, device)
+    generated = step_inputs = prompt
+    for step in range(max_new_tokens):
+        step_start = time.perf_counter()
+        logits = model(step_inputs, past_key_values, logits_to_keep=1)
+        step_inputs = sample_tokens(logits[:, -1, :], temperature, top_k, top_p, generator).unsqueeze(-1)
+        generated = torch.cat([generated, step_inputs], dim=-1)
+        if node_config.rank == 0:
+            metrics.inc("pipeline_tokens_generated_total", step_inputs.size(0))
+        if return_stats:
+            synchronize_device(device)
+            step_time = time.perf_counter() - step_start
+            if step == 0:
+                stats.prefill_time = step_time
+            else:
+                stats.decode_times.append(step_time)
+
+    result = generated if node_config.rank == 0 else None
+    if not return_stats:
+        return result
+    # Each rank contributes its partial sums and gets the totals back.
+    stats.bytes_sent = stats.bytes_received = sum(module.bytes_reduced for module in row_layers) - reduced_before
+    return result, stats
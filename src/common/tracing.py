@@ -0,0 +1,146 @@
+"""
+Lightweight span tracing across ranks, merged into one Chrome trace.
+
+With TRACE=1, code wrapped in `span(...)` is timed into a per-rank ring
+buffer of TRACE_CONFIG["buffer_size"] spans (the oldest are dropped). The
+library traces model loading, every stage forward pass, transport sends and
+receives (the time spent waiting on a neighbour), sampling and tensor
+parallel all-reduces. With METRICS=1 the same spans also feed the live
+metrics (see metrics.py). Otherwise a span costs two dict lookups.
+
+Every rank's clock has its own epoch, and different machines' clocks drift
+apart, so `setup_distributed` estimates each rank's offset from rank 0 with
+a few ping-pongs, keeping the one with the shortest round trip (Cristian's
+algorithm). `write_trace` gathers all spans to rank 0, shifts them onto its
+clock and writes them as Chrome trace events, one process per rank, for
+chrome://tracing or https://ui.perfetto.dev.
+
+On an asynchronous device (MPS, CUDA) a compute span times the enqueueing
+of kernels, and the wait shows up in whatever synchronizes next.
+"""
+import functools
+import json
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import Optional
+import torch
+import torch.distributed as dist
+from . import metrics
+from .config import METRICS_CONFIG, NodeConfig, TRACE_CONFIG
+
+_spans: deque = deque(maxlen=TRACE_CONFIG["buffer_size"])
+_clock_offset_ns = 0  # Add to this rank's perf_counter_ns() for rank 0's clock
+_process_name = "rank 0"
+_NO_SPAN = nullcontext()
+
+class _Span:
+    __slots__ = ("name", "category", "args", "start", "waited")
+
+    def __init__(self, name: str, category: str, args: dict):
+        self.name, self.category, self.args = name, category, args
+
+    def __enter__(self):
+        self.waited = metrics.waited_so_far()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter_ns()
+        if TRACE_CONFIG["enabled"]:
+            _spans.append((self.name, self.category, self.start, end - self.start,
+                           threading.current_thread().name, self.args))
+        if METRICS_CONFIG["enabled"]:
+            metrics.record_span(self.name, self.category, (end - self.start) / 1e9, self.waited)
+
+def span(name: str, category: str = "compute", **args):
+    """Context manager timing the code it wraps as a span, if tracing or metrics are on."""
+    if not (TRACE_CONFIG["enabled"] or METRICS_CONFIG["enabled"]):
+        return _NO_SPAN
+    return _Span(name, category, args)
+
+def traced(name: str, category: str = "compute"):
+    """Decorator recording every call of a function as a span."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def reset_trace() -> None:
+    """Drop every span recorded so far, e.g. after a warm-up."""
+    _spans.clear()
+
+def estimate_clock_offset(rounds: int = 16) -> int:
+    """
+    Estimate this rank's clock offset from rank 0. Every rank must call this;
+    ranks take turns exchanging `rounds` timestamps with rank 0.
+    Returns the offset in nanoseconds (0 on rank 0).
+    """
+    global _clock_offset_ns
+    rank = dist.get_rank()
+    stamp = torch.zeros(1, dtype=torch.int64)
+    best_round_trip = None
+    for peer in range(1, dist.get_world_size()):
+        for _ in range(rounds):
+            if rank == 0:
+                dist.recv(stamp, src=peer)
+                stamp[0] = time.perf_counter_ns()
+                dist.send(stamp, dst=peer)
+            elif rank == peer:
+                sent = time.perf_counter_ns()
+                dist.send(stamp, dst=0)
+                dist.recv(stamp, src=0)
+                received = time.perf_counter_ns()
+                if best_round_trip is None or received - sent < best_round_trip:
+                    # Rank 0 read its clock about halfway through the round trip.
+                    best_round_trip = received - sent
+                    _clock_offset_ns = int(stamp[0]) - (sent + received) // 2
+    return _clock_offset_ns
+
+def start_tracing(node_config: NodeConfig) -> None:
+    """Name this rank in the trace and line its clock up with rank 0's; called by setup_distributed."""
+    global _process_name
+    _process_name = f"rank {node_config.rank} ({node_config.name})"
+    if TRACE_CONFIG["enabled"]:
+        estimate_clock_offset()
+
+def write_trace(path: Optional[str] = None) -> Optional[str]:
+    """
+    Gather every rank's spans to rank 0 and write them to `path` (default
+    TRACE_CONFIG["output"]) as a Chrome trace. Every rank must call this.
+    Returns the path on rank 0, None elsewhere or if tracing is off.
+    """
+    if not TRACE_CONFIG["enabled"]:
+        return None
+    local = {"name": _process_name, "offset": _clock_offset_ns, "spans": list(_spans)}
+    if dist.is_initialized() and dist.get_world_size() > 1:
+        gathered = [None] * dist.get_world_size() if dist.get_rank() == 0 else None
+        dist.gather_object(local, gathered, dst=0)
+        if dist.get_rank() != 0:
+            return None
+    else:
+        gathered = [local]
+
+    events = []
+    origin = min((start + rank_trace["offset"] for rank_trace in gathered for _, _, start, *_ in rank_trace["spans"]),
+                 default=0)
+    for pid, rank_trace in enumerate(gathered):
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": rank_trace["name"]}})
+        threads = {}
+        for name, category, start, duration, thread, args in rank_trace["spans"]:
+            if thread not in threads:
+                threads[thread] = len(threads)
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": threads[thread],
+                               "args": {"name": thread}})
+            events.append({
+                "name": name, "cat": category, "ph": "X", "pid": pid, "tid": threads[thread],
+                "ts": (start + rank_trace["offset"] - origin) / 1000, "dur": duration / 1000, "args": args,
+            })
+    path = path or TRACE_CONFIG["output"]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return path
@@ -0,0 +1,577 @@
+"""
+Point-to-point tensor transport between neighbouring pipeline stages.
+
+Every tensor is preceded by a small fixed-size header describing its dtype,
+shape and wire encoding, so a receiving rank never needs to know activation
+shapes ahead of time. Stages form a chain rank 0 -> 1 -> ... -> world_size - 1
+over the process group created by `setup_distributed`.
+
+`send_tensor`/`recv_tensor` are simple blocking primitives. `PipelineTransport`
+instead runs non-blocking channels: sends return as soon as the data is
+copied into a reused buffer, and the receive for the next message of a
+size is posted before the caller starts computing on the current one.
+Floating point payloads can be compressed with a codec from `codecs`.
+
+`stream_tensors`/`receive_tensors` move a long run of tensors (a shard's
+weights) in fixed-size chunks, overlapping the sender's reads and the
+receiver's copies with the transfer.
+
+Neighbours whose `NodeConfig.address` is the same (several stages on one
+machine) skip the network for payloads: they are written into shared
+memory, and the receiver gets tensors that are views straight into it.
+Only the headers still go through the process group.
+"""
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+import torch
+import torch.distributed as dist
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from .codecs import CODEC_SPECS, WireCodec, get_codec
+from .config import NodeConfig, NODES, MODEL_CONFIG
+from . import metrics
+from .tracing import span
+
+# Order matters: a dtype's index is its code on the wire.
+WIRE_DTYPES = [
+    torch.float32,
+    torch.float16,
+    torch.bfloat16,
+    torch.float64,
+    torch.int64,
+    torch.int32,
+    torch.int8,
+    torch.uint8,
+    torch.bool,
+]
+
+MAX_DIMS = 6
+# shape id, codec code, wire bytes, payload bytes, dtype code, ndim, padded shape
+HEADER_SIZE = 6 + MAX_DIMS
+HEADER_BYTES = HEADER_SIZE * 8
+
+# Async channels use their own tag range so they never match plain
+# send_tensor/recv_tensor traffic: headers go on CHANNEL_TAG and the payload
+# of shape id k on CHANNEL_TAG + 1 + k.
+CHANNEL_TAG = 1000
+CLOSE_ID = -1
+# Chunks of a tensor stream (`stream_tensors`/`receive_tensors`).
+STREAM_TAG = 900
+
+# A shared-memory segment starts with the reader's flag, then the payload
+# (offset so any dtype's view of it stays aligned).
+SEGMENT_OFFSET = 64
+SEGMENT_TIMEOUT = 1800.0  # Seconds to wait on a stalled peer, like gloo's default
+
+_RAW = WireCodec()
+
+def _fill_header(header: torch.Tensor, tensor: torch.Tensor, codec: WireCodec,
+                 wire: torch.Tensor, payload_len: int, shape_id: int = 0) -> torch.Tensor:
+    if tensor.dim() > MAX_DIMS:
+        raise ValueError(f"Cannot send a {tensor.dim()}-d tensor, at most {MAX_DIMS} dims are supported")
+    header.zero_()
+    header[0] = shape_id
+    header[1] = CODEC_SPECS.index(codec.name)
+    header[2] = wire.numel()
+    header[3] = payload_len
+    header[4] = WIRE_DTYPES.index(tensor.dtype)
+    header[5] = tensor.dim()
+    header[6:6 + tensor.dim()] = torch.tensor(tensor.shape, dtype=torch.int64)
+    return header
+
+def _parse_header(header: torch.Tensor):
+    values = header.tolist()
+    shape_id, codec_code, wire_numel, payload_len, dtype_code, ndim = values[:6]
+    shape = tuple(values[6:6 + ndim])
+    return shape_id, codec_code, wire_numel, payload_len, shape, WIRE_DTYPES[dtype_code]
+
+def _decode(wire: torch.Tensor, codec_code: int, payload_len: int, shape, dtype) -> torch.Tensor:
+    return get_codec(CODEC_SPECS[codec_code]).decode(wire, payload_len, shape, dtype)
+
+def send_tensor(tensor: torch.Tensor, dst: int) -> None:
+    """Send a header followed by the tensor's data to rank `dst`."""
+    # gloo only moves CPU tensors, so activations are staged through host memory.
+    tensor = tensor.detach().contiguous().cpu()
+    wire, payload_len = _RAW.encode(tensor)
+    header = _fill_header(torch.empty(HEADER_SIZE, dtype=torch.int64), tensor, _RAW, wire, payload_len)
+    dist.send(header, dst=dst)
+    dist.send(wire, dst=dst)
+
+def recv_tensor(src: int, device: Optional[str] = None) -> torch.Tensor:
+    """Receive a tensor sent with `send_tensor` from rank `src`."""
+    header = torch.empty(HEADER_SIZE, dtype=torch.int64)
+    dist.recv(header, src=src)
+    _, codec_code, wire_numel, payload_len, shape, dtype = _parse_header(header)
+    wire = torch.empty(wire_numel, dtype=torch.uint8)
+    dist.recv(wire, src=src)
+    tensor = _decode(wire, codec_code, payload_len, shape, dtype)
+    return tensor.to(device) if device else tensor
+
+def _byte_view(tensor: torch.Tensor) -> torch.Tensor:
+    return tensor.reshape(-1).view(torch.uint8)
+
+def _chunk_sizes(total: int, chunk_bytes: int) -> List[int]:
+    return [min(chunk_bytes, total - offset) for offset in range(0, total, chunk_bytes)]
+
+def stream_tensors(tensors: Iterable[torch.Tensor], dst: int, total_bytes: int, chunk_bytes: int) -> None:
+    """
+    Send the bytes of `tensors`, back to back, to rank `dst` in chunks of
+    `chunk_bytes`. Two chunk buffers take turns, so the next chunk is filled
+    (e.g. read from disk) while the previous one is on the wire. The
+    receiver calls `receive_tensors` with tensors of the same sizes.
+    """
+    buffers = [torch.empty(min(chunk_bytes, total_bytes), dtype=torch.uint8) for _ in range(2)]
+    in_flight: List[Optional[dist.Work]] = [None, None]
+    slot, filled, sent = 0, 0, 0
+
+    def flush():
+        nonlocal slot, filled, sent
+        in_flight[slot] = dist.isend(buffers[slot][:filled], dst, tag=STREAM_TAG)
+        metrics.inc("pipeline_bytes_sent_total", filled, peer=dst)
+        sent, slot, filled = sent + filled, 1 - slot, 0
+        # The buffer about to be refilled must be off the wire (a gloo Work is waited on once).
+        if in_flight[slot] is not None:
+            in_flight[slot].wait()
+            in_flight[slot] = None
+
+    for tensor in tensors:
+        data = _byte_view(tensor.detach().contiguous().cpu())
+        offset = 0
+        while offset < data.numel():
+            size = min(data.numel() - offset, buffers[slot].numel() - filled)
+            buffers[slot][filled:filled + size].copy_(data[offset:offset + size])
+            offset, filled = offset + size, filled + size
+            if filled == buffers[slot].numel():
+                flush()
+    if filled:
+        flush()
+    for work in in_flight:
+        if work is not None:
+            work.wait()
+    if sent != total_bytes:
+        raise RuntimeError(f"Streamed {sent} bytes to rank {dst}, expected {total_bytes}")
+
+def receive_tensors(tensors: Sequence[torch.Tensor], src: int, chunk_bytes: int) -> None:
+    """
+    Fill the contiguous CPU `tensors`, in order, with the bytes streamed by
+    rank `src`'s `stream_tensors`. The next chunk's receive is posted before
+    the current one is copied out.
+    """
+    sizes = _chunk_sizes(sum(tensor.numel() * tensor.element_size() for tensor in tensors), chunk_bytes)
+    if not sizes:
+        return
+    buffers = [torch.empty(sizes[0], dtype=torch.uint8) for _ in range(2)]
+    posted = [dist.irecv(buffers[index][:size], src, tag=STREAM_TAG) for index, size in enumerate(sizes[:2])]
+    targets = iter(_byte_view(tensor) for tensor in tensors)
+    target, offset = next(targets), 0
+    for index, size in enumerate(sizes):
+        slot = index % 2
+        posted[slot].wait()
+        metrics.inc("pipeline_bytes_received_total", size, peer=src)
+        chunk, position = buffers[slot][:size], 0
+        while position < size:
+            while offset == target.numel():
+                target, offset = next(targets), 0
+            count = min(size - position, target.numel() - offset)
+            target[offset:offset + count].copy_(chunk[position:position + count])
+            position, offset = position + count, offset + count
+        if index + 2 < len(sizes):
+            posted[slot] = dist.irecv(buffers[slot][:sizes[index + 2]], src, tag=STREAM_TAG)
+
+class _SendChannel:
+    """
+    Non-blocking sender. Each distinct payload size gets a shape id and two
+    host buffers that are reused in turn, so a send only has to wait for the
+    transfer from two messages ago.
+    """
+
+    def __init__(self, dst: int, codec: WireCodec = _RAW):
+        self.dst = dst
+        self.codec = codec
+        self.shape_ids: Dict[int, int] = {}
+        self.headers: Dict[Tuple[int, int], torch.Tensor] = {}
+        self.buffers: Dict[int, List[torch.Tensor]] = {}
+        self.next_slot: Dict[int, int] = {}
+        self.in_flight: Dict[Tuple[int, int], List[dist.Work]] = {}
+        self.bytes_sent = 0  # Header and payload bytes put on the wire
+        self.raw_bytes = 0  # What the same tensors would take uncompressed
+
+    def _acquire(self, wire_numel: int) -> Tuple[int, int]:
+        if wire_numel not in self.shape_ids:
+            shape_id = len(self.shape_ids)
+            self.shape_ids[wire_numel] = shape_id
+            self.buffers[shape_id] = [torch.empty(wire_numel, dtype=torch.uint8) for _ in range(2)]
+            for slot in range(2):
+                self.headers[(shape_id, slot)] = torch.empty(HEADER_SIZE, dtype=torch.int64)
+            self.next_slot[shape_id] = 0
+        shape_id = self.shape_ids[wire_numel]
+        slot = self.next_slot[shape_id]
+        self.next_slot[shape_id] = 1 - slot
+        for work in self.in_flight.pop((shape_id, slot), []):
+            work.wait()
+        return shape_id, slot
+
+    def send(self, tensor: torch.Tensor) -> None:
+        tensor = tensor.detach()
+        codec = self.codec if tensor.is_floating_point() else _RAW
+        wire, payload_len = codec.encode(tensor)
+        shape_id, slot = self._acquire(wire.numel())
+        buffer = self.buffers[shape_id][slot]
+        buffer.copy_(wire)
+        header = _fill_header(self.headers[(shape_id, slot)], tensor, codec, wire, payload_len, shape_id)
+        self.in_flight[(shape_id, slot)] = [
+            dist.isend(header, self.dst, tag=CHANNEL_TAG),
+            dist.isend(buffer, self.dst, tag=CHANNEL_TAG + 1 + shape_id),
+        ]
+        self.bytes_sent += HEADER_BYTES + buffer.numel()
+        self.raw_bytes += HEADER_BYTES + tensor.numel() * tensor.element_size()
+
+    def close(self) -> None:
+        """Tell the receiver to stop, then satisfy its pre-posted receives."""
+        close_header = torch.full((HEADER_SIZE,), CLOSE_ID, dtype=torch.int64)
+        works = [dist.isend(close_header, self.dst, tag=CHANNEL_TAG)]
+        # The contents are never read, any buffer of the right size will do.
+        for shape_id, buffers in self.buffers.items():
+            works.append(dist.isend(buffers[0], self.dst, tag=CHANNEL_TAG + 1 + shape_id))
+        for pending in self.in_flight.values():
+            works.extend(pending)
+        for work in works:
+            work.wait()
+        self.in_flight.clear()
+
+class _RecvChannel:
+    """
+    Non-blocking receiver matching `_SendChannel`. The next header is always
+    posted, and for every payload size seen so far a receive into the spare
+    buffer is posted as soon as the previous one completes.
+    """
+
+    def __init__(self, src: int, device: Optional[str] = None):
+        self.src = src
+        self.device = device
+        self.buffers: Dict[int, List[torch.Tensor]] = {}
+        self.posted: Dict[int, Tuple[int, dist.Work]] = {}
+        self.header = torch.empty(HEADER_SIZE, dtype=torch.int64)
+        self.header_work = dist.irecv(self.header, self.src, tag=CHANNEL_TAG)
+        self.bytes_received = 0
+
+    def _post(self, shape_id: int, slot: int) -> None:
+        work = dist.irecv(self.buffers[shape_id][slot], self.src, tag=CHANNEL_TAG + 1 + shape_id)
+        self.posted[shape_id] = (slot, work)
+
+    def _next_header(self):
+        self.header_work.wait()
+        parsed = _parse_header(self.header) if self.header[0] != CLOSE_ID else None
+        if parsed is not None:
+            self.header_work = dist.irecv(self.header, self.src, tag=CHANNEL_TAG)
+        return parsed
+
+    def recv(self) -> torch.Tensor:
+        """
+        Return the next tensor. On CPU an uncompressed tensor is a view of a
+        reused buffer, valid until the next `recv` of the same size.
+        """
+        parsed = self._next_header()
+        if parsed is None:
+            raise RuntimeError(f"Rank {self.src} closed the channel")
+        shape_id, codec_code, wire_numel, payload_len, shape, dtype = parsed
+        if shape_id not in self.buffers:
+            self.buffers[shape_id] = [torch.empty(wire_numel, dtype=torch.uint8) for _ in range(2)]
+            self._post(shape_id, 0)
+        slot, work = self.posted.pop(shape_id)
+        work.wait()
+        # Have the next message of this size land in the spare buffer while
+        # the caller computes on this one.
+        self._post(shape_id, 1 - slot)
+        self.bytes_received += HEADER_BYTES + wire_numel
+        tensor = _decode(self.buffers[shape_id][slot], codec_code, payload_len, shape, dtype)
+        return tensor.to(self.device) if self.device else tensor
+
+    def close(self) -> None:
+        if self._next_header() is not None:
+            raise RuntimeError(f"Closing a channel from rank {self.src} with unread messages")
+        for _, work in self.posted.values():
+            work.wait()
+        self.posted.clear()
+
+def shares_host(node_config: NodeConfig, peer_rank: int) -> bool:
+    """Whether `peer_rank` runs on the same machine as this node, going by the addresses in NODES."""
+    peer = next((node for node in NODES.values() if node.rank == peer_rank), None)
+    return peer is not None and peer.address == node_config.address
+
+# Segment names must be unique per channel on a host, and both ends must
+# derive the same one. Every rank opens its transports in the same order, so
+# counting them per rank pair gives each channel its own generation.
+_generations: Dict[Tuple[int, int], int] = {}
+
+def _segment_prefix(node_config: NodeConfig, src: int, dst: int) -> str:
+    generation = _generations.get((src, dst), 0)
+    _generations[(src, dst)] = generation + 1
+    # macOS caps shared-memory names at 31 characters.
+    return f"mmc{node_config.master_port}_{src}_{dst}_{generation}"
+
+def _wait_until(condition, what: str) -> None:
+    deadline = time.monotonic() + SEGMENT_TIMEOUT
+    delay = 0.0
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Timed out waiting for {what}")
+        time.sleep(delay)
+        delay = min(delay * 2 or 1e-5, 1e-3)
+
+class _Segment:
+    """
+    One shared-memory payload buffer. The writer raises its flag when it
+    fills the buffer and the reader lowers it once it has let go of the
+    contents, so the writer knows when the buffer may be reused.
+    """
+
+    def __init__(self, name: str, size: int, create: bool):
+        if create:
+            try:
+                self.memory = SharedMemory(name, create=True, size=SEGMENT_OFFSET + size)
+            except FileExistsError:
+                # Left behind by a run that crashed.
+                SharedMemory(name).unlink()
+                self.memory = SharedMemory(name, create=True, size=SEGMENT_OFFSET + size)
+        else:
+            self.memory = SharedMemory(name)
+            # Attaching registers the segment with the resource tracker too,
+            # which would unlink it when this process exits; that is the
+            # writer's job.
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.flag = self.memory.buf[:8].cast("q")
+        self.data = torch.frombuffer(self.memory.buf, dtype=torch.uint8)[SEGMENT_OFFSET:SEGMENT_OFFSET + size]
+        if create:
+            self.flag[0] = 0
+
+    def close(self, unlink: bool = False) -> None:
+        self.flag.release()
+        self.data = None
+        try:
+            self.memory.close()
+        except BufferError:
+            # A caller still holds a tensor received from this segment.
+            _busy_segments.append(self.memory)
+        if unlink:
+            # Ranks started by one launcher share a tracker, where the
+            # reader's unregister also dropped the writer's registration.
+            resource_tracker.register(self.memory._name, "shared_memory")
+            self.memory.unlink()
+
+# Segments that could not be unmapped yet because received tensors still
+# point into them; retried whenever another channel closes.
+_busy_segments: List[SharedMemory] = []
+
+def _close_busy_segments() -> None:
+    for memory in list(_busy_segments):
+        try:
+            memory.close()
+            _busy_segments.remove(memory)
+        except BufferError:
+            pass
+
+class _SharedMemorySendChannel(_SendChannel):
+    """
+    Sender to a neighbour on the same host. Payloads are copied into two
+    shared-memory segments per size, used in turn like `_SendChannel`'s
+    buffers, and the header sent over the process group tells the receiver
+    which one to read. Codecs are skipped since nothing crosses the network.
+    """
+
+    def __init__(self, dst: int, prefix: str):
+        super().__init__(dst)
+        self.prefix = prefix
+        self.segments: Dict[Tuple[int, int], _Segment] = {}
+
+    def send(self, tensor: torch.Tensor) -> None:
+        tensor = tensor.detach()
+        wire, payload_len = _RAW.encode(tensor)
+        shape_id, slot = self._acquire(wire.numel())
+        if (shape_id, slot) not in self.segments:
+            self.segments[(shape_id, slot)] = _Segment(f"{self.prefix}_{shape_id}_{slot}", wire.numel(), create=True)
+        segment = self.segments[(shape_id, slot)]
+        _wait_until(lambda: segment.flag[0] == 0, f"rank {self.dst} to release a shared-memory buffer")
+        segment.flag[0] = 1
+        segment.data.copy_(wire)
+        header = _fill_header(self.headers[(shape_id, slot)], tensor, _RAW, wire, payload_len, shape_id)
+        self.in_flight[(shape_id, slot)] = [dist.isend(header, self.dst, tag=CHANNEL_TAG)]
+        self.bytes_sent += HEADER_BYTES + wire.numel()
+        self.raw_bytes += HEADER_BYTES + wire.numel()
+
+    def _acquire(self, wire_numel: int) -> Tuple[int, int]:
+        if wire_numel not in self.shape_ids:
+            # Only headers need host buffers, the payloads live in the segments.
+            shape_id = len(self.shape_ids)
+            self.shape_ids[wire_numel] = shape_id
+            for slot in range(2):
+                self.headers[(shape_id, slot)] = torch.empty(HEADER_SIZE, dtype=torch.int64)
+            self.next_slot[shape_id] = 0
+        shape_id = self.shape_ids[wire_numel]
+        slot = self.next_slot[shape_id]
+        self.next_slot[shape_id] = 1 - slot
+        for work in self.in_flight.pop((shape_id, slot), []):
+            work.wait()
+        return shape_id, slot
+
+    def close(self) -> None:
+        """Tell the receiver to stop; `unlink` frees the segments once it has."""
+        close_header = torch.full((HEADER_SIZE,), CLOSE_ID, dtype=torch.int64)
+        works = [dist.isend(close_header, self.dst, tag=CHANNEL_TAG)]
+        for pending in self.in_flight.values():
+            works.extend(pending)
+        for work in works:
+            work.wait()
+        self.in_flight.clear()
+
+    def unlink(self) -> None:
+        for segment in self.segments.values():
+            _wait_until(lambda: segment.flag[0] == 0, f"rank {self.dst} to close its channel")
+            segment.close(unlink=True)
+        self.segments.clear()
+
+class _SharedMemoryRecvChannel(_RecvChannel):
+    """
+    Receiver matching `_SharedMemorySendChannel`. A received tensor is a view
+    into shared memory, valid until the next `recv` of the same size.
+    """
+
+    def __init__(self, src: int, prefix: str, device: Optional[str] = None):
+        super().__init__(src, device)
+        self.prefix = prefix
+        self.segments: Dict[Tuple[int, int], _Segment] = {}
+        self.next_slot: Dict[int, int] = {}
+
+    def recv(self) -> torch.Tensor:
+        parsed = self._next_header()
+        if parsed is None:
+            raise RuntimeError(f"Rank {self.src} closed the channel")
+        shape_id, codec_code, wire_numel, payload_len, shape, dtype = parsed
+        slot = self.next_slot.get(shape_id, 0)
+        self.next_slot[shape_id] = 1 - slot
+        if (shape_id, slot) not in self.segments:
+            self.segments[(shape_id, slot)] = _Segment(f"{self.prefix}_{shape_id}_{slot}", wire_numel, create=False)
+        # The previous message of this size is no longer valid to the caller.
+        previous = self.segments.get((shape_id, 1 - slot))
+        if previous is not None:
+            previous.flag[0] = 0
+        self.bytes_received += HEADER_BYTES + wire_numel
+        tensor = _decode(self.segments[(shape_id, slot)].data, codec_code, payload_len, shape, dtype)
+        return tensor.to(self.device) if self.device else tensor
+
+    def close(self) -> None:
+        if self._next_header() is not None:
+            raise RuntimeError(f"Closing a channel from rank {self.src} with unread messages")
+        for segment in self.segments.values():
+            segment.flag[0] = 0
+            segment.close()
+        self.segments.clear()
+        _close_busy_segments()
+
+class PipelineTransport:
+    """
+    A stage's view of the pipeline chain: activations go forward to
+    rank + 1, and the last stage can return results straight to rank 0.
+
+    Use as a context manager (or call `close`) so every rank drains its
+    channels at the same point. Activations are encoded with `codec`
+    (default MODEL_CONFIG["wire_codec"]). Neighbours on the same host use
+    shared memory unless `shared_memory` (default
+    MODEL_CONFIG["shared_memory_transport"]) is off; it must be set the same
+    on every rank.
+    """
+
+    def __init__(self, node_config: NodeConfig, device: Optional[str] = None, codec: Optional[str] = None,
+                 shared_memory: Optional[bool] = None):
+        self.rank = node_config.rank
+        self.world_size = node_config.world_size
+        self.device = device
+        self.is_first = self.rank == 0
+        self.is_last = self.rank == self.world_size - 1
+        self.prev_rank = None if self.is_first else self.rank - 1
+        self.next_rank = None if self.is_last else self.rank + 1
+
+        self.codec = get_codec(codec or MODEL_CONFIG.get("wire_codec", "none"))
+        if shared_memory is None:
+            shared_memory = MODEL_CONFIG.get("shared_memory_transport", True)
+        self._node_config = node_config
+        self._shared_memory = shared_memory
+        self._forward_out = self._send_channel(self.next_rank, self.codec) if not self.is_last else None
+        self._forward_in = self._recv_channel(self.prev_rank) if not self.is_first else None
+        self._result_out = self._send_channel(0) if self.is_last and not self.is_first else None
+        self._result_in = self._recv_channel(self.world_size - 1) if self.is_first and not self.is_last else None
+
+    def _send_channel(self, dst: int, codec: WireCodec = _RAW) -> _SendChannel:
+        if self._shared_memory and shares_host(self._node_config, dst):
+            return _SharedMemorySendChannel(dst, _segment_prefix(self._node_config, self.rank, dst))
+        return _SendChannel(dst, codec)
+
+    def _recv_channel(self, src: int) -> _RecvChannel:
+        if self._shared_memory and shares_host(self._node_config, src):
+            return _SharedMemoryRecvChannel(src, _segment_prefix(self._node_config, src, self.rank), self.device)
+        return _RecvChannel(src, self.device)
+
+    def _send(self, channel: _SendChannel, tensor: torch.Tensor) -> None:
+        before = channel.bytes_sent
+        channel.send(tensor)
+        metrics.inc("pipeline_bytes_sent_total", channel.bytes_sent - before, peer=channel.dst)
+
+    def _recv(self, channel: _RecvChannel) -> torch.Tensor:
+        before = channel.bytes_received
+        tensor = channel.recv()
+        metrics.inc("pipeline_bytes_received_total", channel.bytes_received - before, peer=channel.src)
+        return tensor
+
+    def send_forward(self, tensor: torch.Tensor) -> None:
+        """Send activations to the next stage."""
+        with span("send_forward", "transport", dst=self.next_rank):
+            self._send(self._forward_out, tensor)
+
+    def recv_forward(self) -> torch.Tensor:
+        """Receive activations from the previous stage."""
+        with span("recv_forward", "transport", src=self.prev_rank):
+            return self._recv(self._forward_in)
+
+    def send_to_first(self, tensor: torch.Tensor) -> None:
+        """Send a result (e.g. sampled tokens) from the last stage to rank 0."""
+        with span("send_to_first", "transport", dst=0):
+            self._send(self._result_out, tensor)
+
+    def recv_from_last(self) -> torch.Tensor:
+        """Receive a result from the last stage on rank 0."""
+        with span("recv_from_last", "transport", src=self.world_size - 1):
+            return self._recv(self._result_in)
+
+    @property
+    def bytes_sent(self) -> int:
+        """Bytes this rank has put on the wire, headers included."""
+        return sum(channel.bytes_sent for channel in (self._forward_out, self._result_out) if channel)
+
+    @property
+    def raw_bytes_sent(self) -> int:
+        """What `bytes_sent` would have been without a codec."""
+        return sum(channel.raw_bytes for channel in (self._forward_out, self._result_out) if channel)
+
+    @property
+    def bytes_received(self) -> int:
+        """Bytes this rank has taken off the wire, headers included."""
+        return sum(channel.bytes_received for channel in (self._forward_in, self._result_in) if channel)
+
+    def close(self) -> None:
+        """Finish outstanding sends and drain pre-posted receives."""
+        for channel in (self._forward_out, self._result_out, self._forward_in, self._result_in):
+            if channel is not None:
+                channel.close()
+        # Only once every rank has closed its receivers (which the loop above
+        # does not wait for) are shared-memory segments safe to free.
+        for channel in (self._forward_out, self._result_out):
+            if isinstance(channel, _SharedMemorySendChannel):
+                channel.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # After an error the peers are out of step, so draining would hang.
+        if exc_type is None:
+            self.close()
@@ -0,0 +1,48 @@
+"""
+Pre-shard the configured model for every rank into the shard cache.
+
+Run once on any machine, then sync the cache directory to the nodes so each
+one starts by memory-mapping its own shard:
+
+    MODEL_NAME=gpt2-large python -m src.export_shards --world-size 2 --cache-dir ~/.cache/mac-mini-connect/shards
+
+Each rank's shard is cut with its NODES entry's settings (quantization,
+compute weight) when NODES describes this world size. Shards are keyed by
+the checkpoint's revision, so a node only uses them if
+its own copy of the model resolves to the same snapshot, or, with
+WEIGHT_SOURCE=stream, if rank 0's does.
+"""
+import argparse
+import gc
+
+from src.common.config import NODES, MODEL_CONFIG, NodeConfig
+from src.common.model_sharding import load_partial_model
+from src.common.partitioner import get_stage_nodes
+
+def main():
+    parser = argparse.ArgumentParser(description="Export per-rank shards of MODEL_CONFIG's model")
+    parser.add_argument("--world-size", type=int, default=len(NODES), help="Number of pipeline stages")
+    parser.add_argument("--cache-dir", default=MODEL_CONFIG["shard_cache_dir"], help="Shard cache directory")
+    args = parser.parse_args()
+
+    if not args.cache_dir:
+        parser.error("A shard cache directory is required (set SHARD_CACHE_DIR or pass --cache-dir)")
+    MODEL_CONFIG["shard_cache_dir"] = args.cache_dir
+    # Every shard is cut here from the local checkpoint, without a process group.
+    MODEL_CONFIG["weight_source"] = "local"
+
+    # The configured nodes, so each shard gets its node's quantization and
+    # the partition the nodes will compute.
+    stage_nodes = get_stage_nodes(args.world_size)
+    for rank in range(args.world_size):
+        node_config = stage_nodes[rank] or NodeConfig(
+            name=f"export-rank{rank}", address="127.0.0.1", rank=rank, world_size=args.world_size)
+        # Loading on a miss writes the shard through to the cache.
+        model = load_partial_model(node_config, device="cpu")
+        del model
+        gc.collect()
+
+    print(f"Exported {args.world_size} shard(s) of {MODEL_CONFIG['model_name']} to {args.cache_dir}", flush=True)
+
+if __name__ == "__main__":
+    main()
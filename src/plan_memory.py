@@ -0,0 +1,82 @@
+"""
+Dry run: predict every node's memory footprint without loading any weights.
+
+Only the model's config is fetched. Each stage's weights, KV cache and
+activation buffers are worked out for a batch and context length, and the
+largest batch and context each node can sustain are reported:
+
+    MODEL_NAME=gpt2-xl python -m src.plan_memory --batch-size 4 --seq-len 1024 --memory-gb 16
+    MODEL_NAME=gpt2-xl python -m src.plan_memory --partition 0-30,30-48 --quantization int8
+
+It exits non-zero if some stage would not fit, so it can gate a launch.
+"""
+import argparse
+import dataclasses
+import json
+import sys
+
+import psutil
+from transformers import AutoConfig
+
+from src.common.config import NODES, MODEL_CONFIG, MODEL_REGISTRY
+from src.common.memory_planner import format_plan, plan_memory
+
+def parse_partition(text: str):
+    """"0-12,12-24" -> [(0, 12), (12, 24)]"""
+    try:
+        return [tuple(int(bound) for bound in part.split("-", 1)) for part in text.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected ranges like 0-12,12-24, not {text!r}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Predict per-rank memory for MODEL_CONFIG's model before loading it")
+    parser.add_argument("--model", default=MODEL_CONFIG["model_name"], help="Model name or local path")
+    parser.add_argument("--architecture", help="MODEL_REGISTRY entry describing the model (default: --model)")
+    parser.add_argument("--world-size", type=int, default=len(NODES), help="Number of pipeline stages")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--seq-len", type=int, default=1024, help="Context per sequence, prompt plus generated")
+    parser.add_argument("--partition", type=parse_partition,
+                        help="Proposed layer ranges, e.g. 0-12,12-24 (default: MODEL_CONFIG's strategy)")
+    parser.add_argument("--dtype", default=MODEL_CONFIG["dtype"])
+    parser.add_argument("--quantization", choices=["none", "int8", "int4"],
+                        help="Quantize every stage (default: MODEL_CONFIG's, or each node's own)")
+    parser.add_argument("--memory-gb", type=float, default=psutil.virtual_memory().total / 1024**3,
+                        help="Memory of nodes without NodeConfig.memory_gb (default: this machine's)")
+    parser.add_argument("--overhead-gb", type=float, default=1.0,
+                        help="Set aside on every node for the interpreter, torch and the allocator")
+    parser.add_argument("--serving", action="store_true", help="Also set aside each node's prefix cache budget")
+    parser.add_argument("--json", action="store_true", help="Print the plan as JSON")
+    args = parser.parse_args()
+
+    architecture = args.architecture or args.model
+    if architecture not in MODEL_REGISTRY:
+        parser.error(f"No MODEL_REGISTRY entry {architecture!r}, expected one of {list(MODEL_REGISTRY)}")
+    MODEL_CONFIG.update(model_name=args.model, model_arch_config=MODEL_REGISTRY[architecture], dtype=args.dtype)
+    if args.quantization:
+        MODEL_CONFIG["quantization"] = args.quantization
+        for node in NODES.values():
+            node.quantization = None
+    config = AutoConfig.from_pretrained(args.model)
+    try:
+        plans = plan_memory(
+            config, args.world_size, args.batch_size, args.seq_len, args.partition,
+            memory_gb=args.memory_gb, overhead_gb=args.overhead_gb, serving=args.serving,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.json:
+        print(json.dumps([
+            dict(dataclasses.asdict(plan), kv_bytes=plan.kv_bytes, activation_bytes=plan.activation_bytes,
+                 total_bytes=plan.total_bytes, fits=plan.fits)
+            for plan in plans
+        ], indent=2))
+    else:
+        print(f"{args.model} ({args.dtype}), {args.world_size} stage(s), "
+              f"batch {args.batch_size} x {args.seq_len} tokens")
+        print(format_plan(plans))
+    if any(plan.fits is False for plan in plans):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,62 @@
 """
-Distributed ML testing script that can run on any node.
+Serve the sharded model from the cluster. Rank 0 runs an HTTP server with
+continuous batching; every other rank runs its pipeline stage for each step
+rank 0 schedules. Start it on every node:
+
+    NODE_NAME=mini-red python -m src.run_distributed
+    curl -d '{"prompt": "Hello, my name is", "max_new_tokens": 20}' http://127.0.0.1:8000/generate
 """
-import os
-import socket
-import torch
-from common import NODES, setup_distributed_env, cleanup_distributed, is_master, synchronize
-
-def get_node_config():
-    """Determine which node this is based on hostname."""
-    hostname = socket.gethostname()
-    for node_config in NODES.values():
-        if node_config.name in hostname:
-            return node_config
-    raise ValueError(f"Unknown host: {hostname}. Must be one of: {list(NODES.keys())}")
+import signal
+import threading
+from transformers import AutoTokenizer
+
+from src.common import (
+    MODEL_CONFIG, SERVER_CONFIG, setup_distributed, cleanup_distributed, is_master, synchronize, write_trace,
+)
+from src.common.config import get_node_config
+from src.common.model_sharding import load_partial_model
+from src.common.serving import ContinuousBatcher, make_http_server, serve_stage
 
 def main():
     # Figure out which node we are
     node_config = get_node_config()
-    print(f"Starting up on {node_config.name} (rank {node_config.rank})")
-    
+    if MODEL_CONFIG["parallelism"] != "pipeline":
+        raise ValueError("Continuous batching runs on the pipeline; serve tensor parallel models with src.stage_daemon")
+    print(f"Starting up on {node_config.name} (rank {node_config.rank})", flush=True)
+
     # Set up distributed environment
-    setup_distributed_env(node_config)
-    
+    setup_distributed(node_config)
+
     try:
-        # Both nodes do the same work, just with different ranks
-        if is_master():
-            print("I am the master node (rank 0)")
-        else:
-            print("I am a worker node")
-            
+        model = load_partial_model(node_config)
+
         # Synchronize to make sure all nodes are ready
         synchronize()
-        print(f"Node {node_config.name} ready for distributed operations")
-        
-        # TODO: Add actual ML work here
-        
+        print(f"Node {node_config.name} ready for distributed operations", flush=True)
+
+        if not is_master():
+            serve_stage(model, node_config)
+            write_trace()
+            return
+
+        tokenizer = AutoTokenizer.from_pretrained(MODEL_CONFIG["model_name"])
+        batcher = ContinuousBatcher(model, node_config)
+        server = make_http_server(batcher, tokenizer)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving on http://{SERVER_CONFIG['host']}:{SERVER_CONFIG['port']} "
+              f"({batcher.num_groups} batch groups of up to {batcher.max_batch_size})", flush=True)
+
+        # Ctrl-C drains the requests already accepted, then stops every rank.
+        signal.signal(signal.SIGINT, lambda *_: batcher.stop())
+        batcher.run()
+        server.shutdown()
+        trace = write_trace()
+        if trace:
+            print(f"Wrote the trace to {trace}", flush=True)
+
     finally:
         # Clean up
         cleanup_distributed()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,325 @@
+"""
+Long-running stage workers. Each node starts once, joins the process group
+and loads its shard, then runs the jobs rank 0 hands out until it is told to
+shut down, so a job only pays for its own compute:
+
+    NODE_NAME=mini-red python -m src.stage_daemon
+    NODE_NAME=mini-yellow python -m src.stage_daemon
+    python scripts/submit_job.py generate "Hello, my name is"
+
+Rank 0 takes jobs over HTTP on DAEMON_CONFIG's address and runs them one at
+a time:
+
+    POST /jobs  {"type": "generate", "prompt": "...", "max_new_tokens": 20,
+                 "temperature": 0.0, "top_k": 0, "top_p": 1.0, "seed": null,
+                 "speculative": true}
+                ("input_ids": [...] may replace "prompt"; generation is
+                 speculative by default when a draft model is loaded)
+                {"type": "load_model", "model_name": "gpt2-medium", "draft_model": "distilgpt2"}
+                ("architecture" names the MODEL_REGISTRY entry if the model
+                 name is a local path)
+                {"type": "shutdown"}
+    GET  /status
+
+Before running a job, rank 0 broadcasts it to every rank so they all take
+the same collective steps in the same order. If a job fails, rank 0 tells
+the workers to stop before it exits, as the ranks are out of step. With PARALLELISM=tensor every
+rank holds a slice of every layer instead of a range of layers, which
+suits these one-at-a-time jobs (but not speculative decoding).
+"""
+import gc
+import json
+import queue
+import signal
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+import torch
+import torch.distributed as dist
+from transformers import AutoTokenizer
+
+from src.common import (
+    DAEMON_CONFIG, MODEL_CONFIG, setup_distributed, cleanup_distributed, is_master, synchronize, write_trace,
+)
+from src.common.config import MODEL_REGISTRY, NodeConfig, get_node_config
+from src.common.model_sharding import generate, load_partial_model
+from src.common.serving import parse_sampling
+from src.common.speculative import load_draft_model, speculative_generate
+from src.common.tensor_parallel import load_tensor_parallel_model, tensor_parallel_generate
+
+JOB_TYPES = ("generate", "load_model", "shutdown")
+
+@dataclass
+class Job:
+    """A job submitted to rank 0, filled in once it has run."""
+    spec: dict
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    status: int = 200  # HTTP status for the reply: 400 for a rejected job, 500 for one that failed
+    done: threading.Event = field(default_factory=threading.Event)
+
+class StageDaemon:
+    """
+    One node's resident shard. Rank 0 calls `run_master`, which runs queued
+    jobs; every other rank calls `run_worker`, which follows along.
+    """
+
+    def __init__(self, node_config: NodeConfig):
+        self.node_config = node_config
+        self.model = None
+        self.draft_model = None  # Only on rank 0
+        self.tokenizer = None
+        self.jobs: "queue.Queue[Job]" = queue.Queue()
+        self.jobs_run = 0
+        self.started_at = time.perf_counter()
+
+    def load(self, model_name: str, architecture: Optional[str] = None, draft_model: str = "") -> float:
+        """
+        Swap in this rank's shard of `model_name`, described by the
+        MODEL_REGISTRY entry `architecture` (default: the current one), and
+        on rank 0 the `draft_model` for speculative decoding, if any.
+        Returns the seconds it took.
+        """
+        start = time.perf_counter()
+        # Let the old shard go first so two never have to fit at once.
+        self.model = self.draft_model = None
+        gc.collect()
+        MODEL_CONFIG["model_name"] = model_name
+        MODEL_CONFIG["draft_model"] = draft_model
+        if architecture:
+            MODEL_CONFIG["model_arch_config"] = MODEL_REGISTRY[architecture]
+        tensor_parallel = MODEL_CONFIG["parallelism"] == "tensor"
+        self.model = (load_tensor_parallel_model if tensor_parallel else load_partial_model)(self.node_config)
+        if self.node_config.rank == 0:
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+            if draft_model:
+                self.draft_model = load_draft_model(draft_model)
+        return time.perf_counter() - start
+
+    def submit(self, spec: dict) -> Job:
+        """Queue a job for rank 0's loop; wait on the returned job's `done` event."""
+        job = Job(spec)
+        self.jobs.put(job)
+        return job
+
+    def status(self) -> dict:
+        return {
+            "model_name": MODEL_CONFIG["model_name"],
+            "draft_model": MODEL_CONFIG["draft_model"] or None,
+            "parallelism": MODEL_CONFIG["parallelism"],
+            "world_size": self.node_config.world_size,
+            "jobs_run": self.jobs_run,
+            "queued": self.jobs.qsize(),
+            "uptime": time.perf_counter() - self.started_at,
+        }
+
+    def _prepare(self, spec: dict) -> dict:
+        """Validate a job on rank 0 and resolve it into what every rank needs to run it."""
+        kind = spec.get("type")
+        if kind not in JOB_TYPES:
+            raise ValueError(f"Unknown job type {kind!r}, expected one of {JOB_TYPES}")
+        if kind == "load_model":
+            architecture = spec.get("architecture") or spec.get("model_name")
+            if architecture not in MODEL_REGISTRY:
+                raise ValueError(f"No MODEL_REGISTRY entry {architecture!r}, expected one of {list(MODEL_REGISTRY)}")
+            return {
+                "type": kind,
+                "model_name": spec.get("model_name") or architecture,
+                "architecture": architecture,
+                "draft_model": spec.get("draft_model") or "",
+            }
+        if kind == "shutdown":
+            return {"type": kind}
+
+        input_ids = spec.get("input_ids")
+        if input_ids is None:
+            if "prompt" not in spec:
+                raise ValueError("Expected a 'prompt' or 'input_ids'")
+            input_ids = self.tokenizer(spec["prompt"]).input_ids
+        input_ids = [int(token) for token in input_ids]
+        max_new_tokens = int(spec.get("max_new_tokens", 20))
+        if not input_ids or max_new_tokens < 1:
+            raise ValueError("The prompt must contain at least one token and max_new_tokens must be positive")
+        max_positions = getattr(self.model.config, "max_position_embeddings", None)
+        if max_positions and len(input_ids) + max_new_tokens > max_positions:
+            raise ValueError(f"{len(input_ids)} prompt tokens plus {max_new_tokens} new tokens exceed "
+                             f"the model's {max_positions} positions")
+        sampling = parse_sampling(spec)
+        sampling.validate(max_logprobs=0)
+        pipeline = MODEL_CONFIG["parallelism"] == "pipeline"
+        speculative = bool(spec.get("speculative", pipeline and self.draft_model is not None))
+        if speculative and not pipeline:
+            raise ValueError("Speculative decoding needs pipeline parallelism")
+        if speculative and self.draft_model is None:
+            raise ValueError("Speculative decoding needs a draft model; load one with load_model")
+        if speculative and self.draft_model.config.vocab_size != self.model.config.vocab_size:
+            raise ValueError("The draft model's vocabulary differs from the target's")
+        return {
+            "type": kind,
+            "speculative": speculative,
+            "input_ids": input_ids,
+            "max_new_tokens": max_new_tokens,
+            "temperature": sampling.temperature,
+            "top_k": sampling.top_k,
+            "top_p": sampling.top_p,
+            "seed": sampling.seed,
+        }
+
+    def _execute(self, job: dict) -> Optional[dict]:
+        """Run a job on this rank; the result is rank 0's."""
+        if job["type"] == "load_model":
+            load_time = self.load(job["model_name"], job["architecture"], job["draft_model"])
+            return {"model_name": job["model_name"], "draft_model": job["draft_model"] or None, "load_time": load_time}
+
+        input_ids = torch.tensor([job["input_ids"]], device=MODEL_CONFIG["device"])
+        sampling = {"temperature": job["temperature"], "top_k": job["top_k"], "top_p": job["top_p"], "seed": job["seed"]}
+        start = time.perf_counter()
+        if job["speculative"]:
+            output, stats = speculative_generate(
+                self.model, input_ids, self.node_config, self.draft_model, job["max_new_tokens"],
+                return_stats=True, **sampling,
+            )
+        else:
+            run = tensor_parallel_generate if MODEL_CONFIG["parallelism"] == "tensor" else generate
+            output, stats = run(
+                self.model, input_ids, self.node_config, job["max_new_tokens"], return_stats=True, **sampling,
+            )
+        if self.node_config.rank != 0:
+            return None
+        output_ids = output[0, input_ids.size(1):].tolist()
+        result = {
+            "text": self.tokenizer.decode(output_ids, skip_special_tokens=True),
+            "output_ids": output_ids,
+            "latency": time.perf_counter() - start,
+        }
+        if job["speculative"]:
+            result.update(pipeline_passes=stats.passes, acceptance_rate=stats.acceptance_rate)
+        else:
+            result["time_to_first_token"] = stats.prefill_time
+        return result
+
+    def _broadcast(self, job: Optional[dict] = None) -> dict:
+        box = [job]
+        dist.broadcast_object_list(box, src=0)
+        return box[0]
+
+    @torch.no_grad()
+    def run_master(self) -> None:
+        while True:
+            try:
+                job = self.jobs.get(timeout=DAEMON_CONFIG["heartbeat_seconds"])
+            except queue.Empty:
+                # Idle workers sit in a collective, which the process group would time out.
+                self._broadcast({"type": "ping"})
+                continue
+            try:
+                spec = self._prepare(job.spec)
+            except (ValueError, TypeError, KeyError) as e:
+                job.error, job.status = str(e), 400
+                job.done.set()
+                continue
+
+            self._broadcast(spec)
+            try:
+                job.result = self._execute(spec) if spec["type"] != "shutdown" else {"status": "shutting down"}
+            except Exception as e:
+                # The other ranks are out of step now, so the daemon cannot go on.
+                job.error, job.status = f"{type(e).__name__}: {e}", 500
+                # Workers that finished their part are waiting for the next
+                # job; tell them to stop rather than leave them hanging.
+                self._broadcast({"type": "abort", "error": job.error})
+                raise
+            finally:
+                self.jobs_run += 1
+                job.done.set()
+            if spec["type"] == "shutdown":
+                return
+
+    @torch.no_grad()
+    def run_worker(self) -> None:
+        while True:
+            job = self._broadcast()
+            if job["type"] == "shutdown":
+                return
+            if job["type"] == "abort":
+                print(f"Rank {self.node_config.rank} stopping: a job failed on rank 0 ({job['error']})", flush=True)
+                return
+            if job["type"] != "ping":
+                try:
+                    self._execute(job)
+                except Exception as e:
+                    print(f"Rank {self.node_config.rank} stopping: its part of a {job['type']} job failed "
+                          f"({type(e).__name__}: {e})", flush=True)
+                    raise
+                self.jobs_run += 1
+
+def make_control_server(daemon: StageDaemon, host: Optional[str] = None,
+                        port: Optional[int] = None) -> ThreadingHTTPServer:
+    """HTTP front end that queues jobs on rank 0 and replies once each has run."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/status":
+                return self._reply(404, {"error": f"Unknown path {self.path}"})
+            self._reply(200, daemon.status())
+
+        def do_POST(self):
+            if self.path != "/jobs":
+                return self._reply(404, {"error": f"Unknown path {self.path}"})
+            try:
+                spec = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not isinstance(spec, dict):
+                    raise ValueError("Expected a JSON object")
+            except ValueError as e:
+                return self._reply(400, {"error": str(e)})
+            job = daemon.submit(spec)
+            job.done.wait()
+            self._reply(job.status, {"error": job.error} if job.error else job.result)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host or DAEMON_CONFIG["host"], port or DAEMON_CONFIG["port"]), Handler)
+    server.daemon_threads = True
+    return server
+
+def main():
+    node_config = get_node_config()
+    print(f"Starting stage daemon on {node_config.name} (rank {node_config.rank})", flush=True)
+    setup_distributed(node_config)
+    try:
+        daemon = StageDaemon(node_config)
+        load_time = daemon.load(MODEL_CONFIG["model_name"], draft_model=MODEL_CONFIG["draft_model"])
+        synchronize()
+        print(f"Node {node_config.name} loaded its shard of {MODEL_CONFIG['model_name']} in {load_time:.1f}s",
+              flush=True)
+
+        if not is_master():
+            daemon.run_worker()
+            write_trace()
+            return
+
+        server = make_control_server(daemon)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Taking jobs on http://{DAEMON_CONFIG['host']}:{DAEMON_CONFIG['port']}", flush=True)
+        signal.signal(signal.SIGINT, lambda *_: daemon.submit({"type": "shutdown"}))
+        daemon.run_master()
+        server.shutdown()
+        trace = write_trace()
+        if trace:
+            print(f"Wrote the trace to {trace}", flush=True)
+    finally:
+        cleanup_distributed()
+
+if __name__ == "__main__":
+    main()
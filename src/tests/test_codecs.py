@@ -0,0 +1,53 @@
+"""
+Unit tests for the activation wire codecs.
+
+    python -m pytest src/tests/test_codecs.py
+"""
+import pytest
+import torch
+
+from src.common.codecs import CODEC_SPECS, get_codec
+
+# Worst-case relative error of each lossy base codec.
+TOLERANCE = {"none": 0.0, "fp16": 1e-3, "bf16": 1e-2, "int8": 1e-2}
+
+def _round_trip(spec: str, tensor: torch.Tensor, spare_bytes: int = 0) -> torch.Tensor:
+    codec = get_codec(spec)
+    wire, payload_len = codec.encode(tensor)
+    assert payload_len <= wire.numel()
+    # The transport receives into buffers that may be larger than the payload.
+    buffer = torch.cat([wire[:payload_len], torch.full((spare_bytes,), 255, dtype=torch.uint8)])
+    return codec.decode(buffer, payload_len, tuple(tensor.shape), tensor.dtype)
+
+@pytest.mark.parametrize("spec", CODEC_SPECS)
+@pytest.mark.parametrize("shape", [(2, 3, 5), (1, 1, 64), (4, 7)])
+def test_round_trip(spec, shape):
+    torch.manual_seed(0)
+    tensor = torch.randn(shape)
+    decoded = _round_trip(spec, tensor, spare_bytes=13)
+    assert decoded.shape == tensor.shape and decoded.dtype == tensor.dtype
+    tolerance = TOLERANCE[spec.partition("+")[0]]
+    scale = tensor.abs().amax(dim=-1, keepdim=True)
+    assert ((decoded - tensor).abs() <= tolerance * scale).all()
+
+@pytest.mark.parametrize("spec", ["none", "none+zlib"])
+def test_lossless_codecs_are_exact(spec):
+    tensor = torch.randn(3, 9, dtype=torch.float16)
+    assert torch.equal(_round_trip(spec, tensor), tensor)
+
+def test_int8_keeps_a_zero_row():
+    tensor = torch.randn(3, 8)
+    tensor[1] = 0
+    decoded = _round_trip("int8", tensor)
+    assert not decoded[1].any()
+
+def test_zlib_shrinks_redundant_payloads():
+    tensor = torch.zeros(16, 256)
+    wire, payload_len = get_codec("none+zlib").encode(tensor)
+    assert payload_len < tensor.numel() * tensor.element_size() // 10
+    # Padded up to a bucket: at most 1/8 overhead, or 64 bytes for small payloads.
+    assert payload_len <= wire.numel() <= payload_len + max(64, payload_len // 8)
+
+def test_unknown_spec_is_rejected():
+    with pytest.raises(ValueError):
+        get_codec("int4")
@@ -0,0 +1,133 @@
+"""
+Test script for the optional execution modes, each compared against plain
+pipelined generate(). A mode runs when its configuration enables it:
+
+    REBALANCE=1                  adaptive rebalancing
+    DRAFT_MODEL=distilgpt2       speculative decoding
+    PARALLELISM=tensor           tensor parallelism
+    WIRE_CODEC=int8              activation codec report
+    TRACE=1                      merged Chrome trace of the run
+
+The continuous batcher always runs. Start it on every node like
+src/tests/test_sharding.py:
+
+    NODE_NAME=mini-red python -m src.tests.test_modes
+"""
+import os
+import time
+import torch
+import torch.distributed as dist
+from transformers import AutoTokenizer
+
+from src.common.config import get_node_config, MODEL_CONFIG, REBALANCE_CONFIG
+from src.common.distributed import setup_distributed, cleanup_distributed
+from src.common.tracing import write_trace
+from src.common.model_sharding import load_partial_model, generate
+from src.common.pipeline import run_pipeline
+from src.common.serving import ContinuousBatcher, serve_stage
+from src.common.speculative import load_draft_model, speculative_generate
+from src.common.tensor_parallel import load_tensor_parallel_model, tensor_parallel_generate
+
+def log(msg):
+    """Helper to ensure logs are flushed immediately"""
+    print(f"[{dist.get_rank() if dist.is_initialized() else '?'}] {msg}", flush=True)
+
+def main():
+    node_config = get_node_config()
+    log(f"Starting on node {node_config.name} (rank {node_config.rank})")
+
+    try:
+        setup_distributed(node_config)
+        model_name = MODEL_CONFIG["model_name"]
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = load_partial_model(node_config)
+
+        text = os.environ.get("TEXT", "Hello, my name is")
+        max_new_tokens = int(os.environ.get("MAX_NEW_TOKENS", "20"))
+        input_ids = tokenizer(text, return_tensors="pt").input_ids.to(MODEL_CONFIG["device"])
+
+        # The reference every mode is checked against.
+        log(f"Generating {max_new_tokens} tokens without rebalancing...")
+        output_ids = generate(model, input_ids, node_config, max_new_tokens=max_new_tokens, rebalance=False)
+
+        # --- Adaptive rebalancing: layers may move between stages while generating ---
+        if REBALANCE_CONFIG["enabled"]:
+            generate(model, input_ids, node_config, max_new_tokens=max_new_tokens, rebalance=True)
+            log(f"Stage runs {len(model.layers)} layers after rebalancing")
+            rebalanced_ids = generate(model, input_ids, node_config, max_new_tokens=max_new_tokens, rebalance=False)
+            if node_config.rank == 0:
+                log(f"Output after rebalancing matches: {torch.equal(rebalanced_ids, output_ids)}")
+
+        # --- Speculative decoding: a draft model on rank 0 proposes tokens ---
+        if MODEL_CONFIG["draft_model"]:
+            draft_model = load_draft_model() if node_config.rank == 0 else None
+            log(f"Generating {max_new_tokens} tokens with draft model {MODEL_CONFIG['draft_model']}...")
+            start = time.perf_counter()
+            speculative_ids, speculative_stats = speculative_generate(
+                model, input_ids, node_config, draft_model, max_new_tokens=max_new_tokens, return_stats=True
+            )
+            elapsed = time.perf_counter() - start
+            if node_config.rank == 0:
+                log(f"Speculative: {elapsed:.2f}s ({max_new_tokens / elapsed:.2f} tokens/s), "
+                    f"{speculative_stats.passes} pipeline passes, "
+                    f"{speculative_stats.acceptance_rate:.0%} of drafted tokens accepted")
+                log(f"Speculative output matches generate(): {torch.equal(speculative_ids, output_ids)}")
+
+        # --- Tensor parallelism: every rank runs a slice of every layer ---
+        if MODEL_CONFIG["parallelism"] == "tensor":
+            log(f"Loading a tensor parallel slice on {node_config.name}...")
+            tensor_model = load_tensor_parallel_model(node_config)
+            start = time.perf_counter()
+            tensor_ids = tensor_parallel_generate(tensor_model, input_ids, node_config, max_new_tokens=max_new_tokens)
+            elapsed = time.perf_counter() - start
+            del tensor_model
+            if node_config.rank == 0:
+                log(f"Tensor parallel: {elapsed:.2f}s ({max_new_tokens / elapsed:.2f} tokens/s)")
+                log(f"Tensor parallel output matches generate(): {torch.equal(tensor_ids, output_ids)}")
+
+        # --- Wire codec report: bytes on the wire and effect on the logits ---
+        wire_codec = MODEL_CONFIG["wire_codec"]
+        if wire_codec != "none":
+            batch = input_ids.repeat(int(os.environ.get("BATCH_SIZE", "8")), 1)
+            logits, stats = run_pipeline(model, batch, node_config)
+            reference_logits, reference_stats = run_pipeline(model, batch, node_config, codec="none")
+            log(f"Codec '{wire_codec}': sent {stats.bytes_sent} bytes vs {reference_stats.bytes_sent} uncompressed "
+                f"({stats.bytes_sent / max(reference_stats.bytes_sent, 1):.1%})")
+            if logits is not None:
+                delta = (logits.float() - reference_logits.float()).abs()
+                same_top1 = (logits.argmax(-1) == reference_logits.argmax(-1)).float().mean()
+                log(f"Codec '{wire_codec}': max |logit delta| {delta.max().item():.4f}, "
+                    f"mean {delta.mean().item():.5f}, top-1 agreement {same_top1.item():.2%}")
+
+        # --- Continuous batching: prompts of different lengths share batches ---
+        prompt = input_ids[0].tolist()
+        log(f"Serving {len(prompt)} prompts through the continuous batcher...")
+        if node_config.rank == 0:
+            batcher = ContinuousBatcher(model, node_config)
+            requests = [batcher.submit(prompt[:length], max_new_tokens, stop_at_eos=False)
+                        for length in range(len(prompt), 0, -1)]
+            batcher.stop()
+            start = time.perf_counter()
+            batcher.run()
+            elapsed = time.perf_counter() - start
+            log(f"Batcher: {batcher.tokens_generated} tokens in {elapsed:.2f}s "
+                f"({batcher.tokens_generated / elapsed:.2f} tokens/s)")
+            matches = requests[0].output_ids == output_ids[0, input_ids.shape[1]:].tolist()
+            log(f"Batcher output for the full prompt matches generate(): {matches}")
+        else:
+            serve_stage(model, node_config)
+
+        trace = write_trace()
+        if trace:
+            log(f"Wrote the trace to {trace}")
+
+    except Exception as e:
+        log(f"Error: {str(e)}")
+        import traceback
+        log(traceback.format_exc())
+
+    finally:
+        cleanup_distributed()
+
+if __name__ == "__main__":
+    main()
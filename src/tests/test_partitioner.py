@@ -0,0 +1,52 @@
+"""
+Unit tests for the cost-model layer partitioner.
+
+    python -m pytest src/tests/test_partitioner.py
+"""
+import pytest
+
+from src.common.partitioner import ModelCosts, partition_layers
+
+def _costs(num_layers: int, first_flops: float = 0.0, last_flops: float = 0.0) -> ModelCosts:
+    return ModelCosts(
+        layer_flops=[1.0] * num_layers, layer_bytes=[10] * num_layers,
+        first_flops=first_flops, first_bytes=0, last_flops=last_flops, last_bytes=0,
+    )
+
+def _covers(ranges, num_layers):
+    return ranges[0][0] == 0 and ranges[-1][1] == num_layers and all(
+        start < end for start, end in ranges) and all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+
+def test_equal_nodes_split_evenly():
+    ranges = partition_layers(_costs(8), [1.0, 1.0])
+    assert ranges == [(0, 4), (4, 8)]
+
+def test_faster_node_takes_more_layers():
+    ranges = partition_layers(_costs(9), [2.0, 1.0])
+    assert ranges == [(0, 6), (6, 9)]
+
+def test_lm_head_cost_shifts_layers_off_the_last_stage():
+    ranges = partition_layers(_costs(8, last_flops=4.0), [1.0, 1.0])
+    assert ranges == [(0, 6), (6, 8)]
+
+def test_memory_limit_caps_a_stage():
+    ranges = partition_layers(_costs(8), [1.0, 1.0], memory_limits=[None, 30])
+    assert ranges == [(0, 5), (5, 8)]
+
+def test_quantized_stage_fits_more_layers():
+    assert partition_layers(_costs(8), [1.0, 1.0], [20, None]) == [(0, 2), (2, 8)]
+    assert partition_layers(_costs(8), [1.0, 1.0], [20, None], layer_byte_scales=[0.5, 1.0]) == [(0, 4), (4, 8)]
+
+def test_impossible_memory_limits_are_rejected():
+    with pytest.raises(ValueError):
+        partition_layers(_costs(8), [1.0, 1.0], memory_limits=[30, 30])
+
+@pytest.mark.parametrize("num_layers,world_size", [(5, 3), (12, 4), (3, 3)])
+def test_every_stage_gets_a_contiguous_range(num_layers, world_size):
+    ranges = partition_layers(_costs(num_layers), [1.0] * world_size)
+    assert len(ranges) == world_size
+    assert _covers(ranges, num_layers)
+
+def test_more_stages_than_layers_is_rejected():
+    with pytest.raises(ValueError):
+        partition_layers(_costs(2), [1.0, 1.0, 1.0])
@@ -0,0 +1,50 @@
+"""
+Unit tests for rank 0's prompt-prefix index.
+
+    python -m pytest src/tests/test_prefix_cache.py
+"""
+from src.common.prefix_cache import PrefixIndex
+
+BLOCK = 4
+PROMPT_A = list(range(10, 19))  # Two full blocks and a spare token
+PROMPT_B = list(range(50, 59))
+
+def test_stores_full_blocks_and_reads_them_back():
+    index = PrefixIndex(BLOCK, capacity=8)
+    plan = index.plan([PROMPT_A])
+    assert (plan.reads, plan.store_from, plan.stores, plan.evicted) == ([[]], [0], [[0, 1]], [])
+    plan = index.plan([PROMPT_A + [99]])
+    assert plan.reads == [[0, 1]] and plan.stores == [[]]
+    assert index.stats.hits == 1 and index.stats.hit_tokens == 2 * BLOCK
+
+def test_last_token_is_always_computed():
+    index = PrefixIndex(BLOCK, capacity=8)
+    index.plan([PROMPT_A[:8]])
+    # Both blocks are cached, but reading the second would leave nothing to prefill.
+    assert index.match(PROMPT_A[:8]) == [0]
+
+def test_least_recently_used_chain_tail_goes_first():
+    index = PrefixIndex(BLOCK, capacity=3)
+    index.plan([PROMPT_A])
+    plan = index.plan([PROMPT_B])
+    # A's second block is only reachable through its first, so it goes first.
+    assert plan.evicted == [1] and plan.stores == [[2, 3]]
+    assert index.match(PROMPT_A) == [0]
+    assert len(index) == 3 and index.stats.evicted_blocks == 1
+
+def test_reading_a_block_makes_it_recent():
+    index = PrefixIndex(BLOCK, capacity=2)
+    index.plan([PROMPT_A[:5]])
+    index.plan([PROMPT_B[:5]])
+    index.plan([PROMPT_A[:5]])
+    plan = index.plan([list(range(90, 95))])
+    assert plan.evicted == [1]
+    assert index.match(PROMPT_A[:5]) == [0]
+
+def test_blocks_in_use_are_never_evicted():
+    index = PrefixIndex(BLOCK, capacity=2)
+    index.plan([PROMPT_A])
+    plan = index.plan([PROMPT_A + [99], PROMPT_B])
+    # A's blocks are read this step, so B finds no room to store its own.
+    assert plan.reads == [[0, 1], []]
+    assert plan.stores == [[], []] and plan.evicted == []
@@ -0,0 +1,61 @@
+"""
+Unit tests for the int8 and 4-bit quantized linear layers.
+
+    python -m pytest src/tests/test_quantization.py
+"""
+import pytest
+import torch
+from torch import nn
+from transformers.pytorch_utils import Conv1D
+
+from src.common.quantization import QuantizedLinear, quantize_layers
+
+def _linear(in_features: int = 64, out_features: int = 48) -> nn.Linear:
+    torch.manual_seed(0)
+    return nn.Linear(in_features, out_features)
+
+def _relative_error(output: torch.Tensor, reference: torch.Tensor) -> float:
+    return ((output - reference).norm() / reference.norm()).item()
+
+@pytest.mark.parametrize("mode,tolerance", [("int8", 0.01), ("int4", 0.15)])
+def test_matches_the_dense_layer(mode, tolerance):
+    dense = _linear()
+    quantized = QuantizedLinear.from_module(dense, mode, group_size=32)
+    hidden = torch.randn(3, 5, 64)
+    with torch.no_grad():
+        reference = dense(hidden)
+        output = quantized(hidden)
+    assert output.shape == reference.shape
+    assert _relative_error(output, reference) < tolerance
+
+@pytest.mark.parametrize("mode", ["int8", "int4"])
+def test_forward_matches_the_dequantized_weight(mode):
+    quantized = QuantizedLinear.from_module(_linear(), mode, group_size=16)
+    hidden = torch.randn(4, 64)
+    with torch.no_grad():
+        expected = hidden @ quantized.dequantize(torch.float32).T + quantized.bias
+        torch.testing.assert_close(quantized(hidden), expected, rtol=1e-4, atol=1e-4)
+
+def test_conv1d_weights_are_transposed():
+    torch.manual_seed(0)
+    conv = Conv1D(48, 64)  # GPT-2 layout: weight is [in, out]
+    quantized = QuantizedLinear.from_module(conv, "int8", group_size=32)
+    assert (quantized.in_features, quantized.out_features) == (64, 48)
+    hidden = torch.randn(2, 64)
+    with torch.no_grad():
+        assert _relative_error(quantized(hidden), conv(hidden)) < 0.01
+
+def test_ungroupable_inputs_use_one_group_per_row():
+    quantized = QuantizedLinear.from_module(_linear(in_features=40), "int4", group_size=32)
+    assert quantized.group_size == 40 and quantized.scales.shape == (48, 1)
+
+def test_quantize_layers_replaces_every_linear():
+    block = nn.Sequential(_linear(), nn.ReLU(), nn.Sequential(_linear(48, 64)), nn.LayerNorm(64))
+    assert quantize_layers(block, "int8") == 2
+    assert isinstance(block[0], QuantizedLinear) and isinstance(block[2][0], QuantizedLinear)
+    assert quantize_layers(block, "none") == 0
+
+def test_int4_weights_take_an_eighth_of_float32():
+    quantized = QuantizedLinear.from_module(_linear(), "int4", group_size=32)
+    dense_bytes = 64 * 48 * 4
+    assert quantized.qweight.numel() * quantized.qweight.element_size() == dense_bytes // 8
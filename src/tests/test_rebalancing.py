@@ -0,0 +1,47 @@
+"""
+Unit tests for deciding which layer to move between stages.
+
+    python -m pytest src/tests/test_rebalancing.py
+"""
+from src.common.rebalancing import _format_ranges, plan_move
+
+def test_balanced_pipeline_stays_put():
+    assert plan_move([1.0, 1.05, 1.0], [4, 4, 4], threshold=1.15) is None
+
+def test_slow_stage_hands_a_layer_to_its_faster_neighbour():
+    assert plan_move([1.0, 3.0, 2.0], [4, 4, 4], threshold=1.15) == (1, 0)
+    assert plan_move([2.0, 3.0, 1.0], [4, 4, 4], threshold=1.15) == (1, 2)
+
+def test_end_stages_only_have_one_neighbour():
+    assert plan_move([3.0, 1.0, 1.0], [4, 4, 4], threshold=1.15) == (0, 1)
+    assert plan_move([1.0, 1.0, 3.0], [4, 4, 4], threshold=1.15) == (2, 1)
+
+def test_stage_keeps_its_last_layer():
+    assert plan_move([1.0, 3.0], [5, 1], threshold=1.1) is None
+
+def test_no_move_that_would_make_the_neighbour_slower():
+    # One layer costs the neighbour 2.0 more, so it would become the slowest.
+    assert plan_move([2.0, 2.6], [1, 2], threshold=1.1) is None
+
+def test_move_must_beat_the_slowest_stage_by_the_threshold():
+    # Moving would only take the slowest stage from 2.0 to 1.75.
+    assert plan_move([1.0, 2.0], [8, 8], threshold=1.15) is None
+
+def test_previous_move_is_not_undone_at_the_next_check():
+    first = plan_move([1.5, 3.6], [3, 3], threshold=1.15)
+    assert first == (1, 0)
+    # Noisy timings after the move would send the layer straight back.
+    assert plan_move([2.3, 1.3], [4, 2], threshold=1.15) == (0, 1)
+    assert plan_move([2.3, 1.3], [4, 2], threshold=1.15, previous=first) is None
+
+def test_fixed_cost_is_not_counted_per_layer():
+    # Without its lm_head's 1.2 s, the last stage's layers take 0.2 s each,
+    # and moving one would leave it at 1.8 s.
+    assert plan_move([1.0, 2.0], [4, 4], threshold=1.15) == (1, 0)
+    assert plan_move([1.0, 2.0], [4, 4], threshold=1.15, fixed=[0.0, 1.2]) is None
+
+def test_single_stage_never_moves():
+    assert plan_move([5.0], [12], threshold=1.0) is None
+
+def test_format_ranges():
+    assert _format_ranges([5, 2, 5]) == "0-5,5-7,7-12"
@@ -0,0 +1,47 @@
+"""
+Unit tests for sampling on the last stage.
+
+    python -m pytest src/tests/test_sampling.py
+"""
+import torch
+
+from src.common.sampling import make_generator, sample_tokens
+
+def _logits(batch_size: int = 4, vocab_size: int = 50) -> torch.Tensor:
+    return torch.randn(batch_size, vocab_size, generator=torch.Generator().manual_seed(0))
+
+def test_zero_temperature_is_greedy():
+    logits = _logits()
+    assert torch.equal(sample_tokens(logits), logits.argmax(-1))
+
+def test_top_k_of_one_and_tiny_top_p_are_greedy():
+    logits = _logits()
+    assert torch.equal(sample_tokens(logits, temperature=1.5, top_k=1), logits.argmax(-1))
+    assert torch.equal(sample_tokens(logits, temperature=1.5, top_p=1e-6), logits.argmax(-1))
+
+def test_samples_stay_inside_top_k():
+    logits = _logits(batch_size=1).repeat(200, 1)
+    allowed = set(logits[0].topk(3).indices.tolist())
+    tokens = sample_tokens(logits, temperature=2.0, top_k=3, generators=make_generator(1, "cpu"))
+    assert set(tokens.tolist()) <= allowed
+    assert len(set(tokens.tolist())) > 1
+
+def test_samples_stay_inside_top_p():
+    logits = torch.tensor([[4.0, 3.0, -2.0, -2.0, -2.0]]).repeat(200, 1)
+    # The first two tokens alone hold over 98% of the probability.
+    tokens = sample_tokens(logits, temperature=1.0, top_p=0.9, generators=make_generator(2, "cpu"))
+    assert set(tokens.tolist()) <= {0, 1}
+
+def test_per_row_parameters():
+    logits = _logits()
+    temperature = torch.tensor([0.0, 1.0, 0.0, 1.0])
+    top_k = torch.tensor([0, 1, 0, 1])
+    tokens = sample_tokens(logits, temperature=temperature, top_k=top_k)
+    assert torch.equal(tokens, logits.argmax(-1))
+
+def test_per_row_generators_do_not_depend_on_the_batch():
+    logits = _logits()
+    alone = sample_tokens(logits[2:3], temperature=1.0, generators=[make_generator(7, "cpu")])
+    batched = sample_tokens(logits, temperature=1.0,
+                            generators=[make_generator(seed, "cpu") for seed in (3, 4, 7, None)])
+    assert batched[2] == alone[0]
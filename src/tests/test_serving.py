@@ -0,0 +1,36 @@
+"""
+Unit tests for the continuous batcher's per-step plan, which rank 0 sends
+down the pipeline as a single int64 tensor.
+
+    python -m pytest src/tests/test_serving.py
+"""
+from src.common.prefix_cache import PrefixPlan
+from src.common.sampling import SamplingParams
+from src.common.serving import _Plan
+
+def test_plan_round_trip():
+    plan = _Plan(
+        group=3,
+        kept=[0, 2, 5],
+        new_length=17,
+        sampling=[SamplingParams(0.7, 40, 0.95, 1234, 5), SamplingParams(0.0, 0, 1.0, None, 0)],
+        prefix=PrefixPlan(reads=[[4, 9], []], store_from=[2, 0], stores=[[11], [12, 13]], evicted=[1, 7]),
+    )
+    assert _Plan.decode(plan.encode()) == plan
+
+def test_plan_without_new_rows():
+    plan = _Plan(group=0, kept=[1, 2])
+    decoded = _Plan.decode(plan.encode())
+    assert (decoded.group, decoded.kept, decoded.new_length, decoded.sampling) == (0, [1, 2], 0, [])
+    assert decoded.prefix == PrefixPlan([], [], [], [])
+
+def test_plan_without_prefix_cache_reads_and_stores_nothing():
+    plan = _Plan(group=1, kept=[], new_length=4, sampling=[SamplingParams(1.0, 0, 0.5, 7, 0)] * 2)
+    decoded = _Plan.decode(plan.encode())
+    assert decoded.sampling == plan.sampling
+    assert decoded.prefix == PrefixPlan([[], []], [0, 0], [[], []], [])
+
+def test_sampling_floats_survive_exactly():
+    params = SamplingParams(0.1 + 0.2, 1, 1 / 3, 2**40, 20)
+    decoded = _Plan.decode(_Plan(group=0, kept=[], new_length=1, sampling=[params]).encode())
+    assert decoded.sampling == [params]
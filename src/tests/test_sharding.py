@@ -1,15 +1,20 @@
 """
-Test script for model sharding across devices.
+Test script for model sharding across devices. The optional modes
+(rebalancing, speculative decoding, tensor parallelism, wire codecs,
+continuous batching, tracing) are exercised by src/tests/test_modes.py.
 """
+import os
+import time
 import torch
 import torch.distributed as dist
 from transformers import AutoTokenizer
-from transformers import AutoConfig
 
-from src.common.config import get_node_config, MODEL_CONFIG
+from src.common.config import get_node_config, MODEL_CONFIG, PIPELINE_CONFIG
 from src.common.distributed import setup_distributed, cleanup_distributed
-from src.common.model_sharding import load_partial_model, forward_sequence
-from src.common.utils import get_nested_attr
+from src.common.model_sharding import load_partial_model, generate
+from src.common.memory_planner import plan_memory
+from src.common.quantization import stage_quantization
+from src.common.pipeline import run_pipeline
 
 def log(msg):
     """Helper to ensure logs are flushed immediately"""
@@ -37,54 +42,41 @@ def main():
         log(f"Loading partial model on {node_config.name}...")
         # Load partial model on each node
         model = load_partial_model(node_config)
-        log("Model loaded")
+        shard_bytes = sum(t.numel() * t.element_size() for t in [*model.parameters(), *model.buffers()])
+        log(f"Model loaded ({stage_quantization(node_config)} weights, {shard_bytes / 1024**2:.1f} MB)")
+        planned = plan_memory(model.config, node_config.world_size)[node_config.rank]
+        log(f"Memory planner predicted {planned.weight_bytes / 1024**2:.1f} MB of weights "
+            f"({'matches' if planned.weight_bytes == shard_bytes else 'differs'})")
         
         # Test input
-        text = "Hello, my name is"
+        text = os.environ.get("TEXT", "Hello, my name is")
+        max_new_tokens = int(os.environ.get("MAX_NEW_TOKENS", "20"))
         log(f"Processing text: {text}")
         input_ids = tokenizer(text, return_tensors="pt").input_ids.to(MODEL_CONFIG["device"])
         log(f"Input shape: {input_ids.shape}")
         
         # --- Pipeline Execution ---
+        # Every rank runs the same loop; activations flow rank 0 -> ... -> last
+        # rank and each sampled token flows back to rank 0.
+        log(f"Generating {max_new_tokens} tokens...")
+        start = time.perf_counter()
+        output_ids = generate(model, input_ids, node_config, max_new_tokens=max_new_tokens)
+        elapsed = time.perf_counter() - start
+        log(f"Generation complete in {elapsed:.2f}s ({max_new_tokens / elapsed:.2f} tokens/s)")
+
         if node_config.rank == 0:
-            # Rank 0 starts with token IDs and gets intermediate hidden states
-            log("Rank 0: Executing forward pass...")
-            hidden_states = forward_sequence(model, input_ids, node_config)
-            log(f"Rank 0: Output shape: {hidden_states.shape}")
-            
-            # Send hidden states to the next node
-            log("Rank 0: Broadcasting hidden states to Rank 1...")
-            dist.broadcast(hidden_states, src=0)
-            log("Rank 0: Broadcast complete.")
+            log(f"Input: '{text}'")
+            log(f"Generated: '{tokenizer.decode(output_ids[0, input_ids.shape[1]:])}'")
 
-        elif node_config.rank == 1:
-            # Rank 1 needs a placeholder to receive the hidden states
-            config = AutoConfig.from_pretrained(model_name)
-            hidden_size = get_nested_attr(config, MODEL_CONFIG["model_arch_config"]["hidden_size_key"])
-            # Shape: [batch_size, sequence_length, hidden_size]
-            placeholder_shape = (input_ids.shape[0], input_ids.shape[1], hidden_size)
-            hidden_states = torch.empty(
-                placeholder_shape,
-                dtype=getattr(torch, MODEL_CONFIG["dtype"]),
-                device=MODEL_CONFIG["device"]
-            )
-            
-            # Receive hidden states from the previous node
-            log("Rank 1: Waiting to receive hidden states from Rank 0...")
-            dist.broadcast(hidden_states, src=0)
-            log("Rank 1: Received hidden states.")
+        # --- Batched forward pass with the configured schedule ---
+        batch_size = int(os.environ.get("BATCH_SIZE", "8"))
+        batch = input_ids.repeat(batch_size, 1)
+        log(f"Running a batch of {batch_size} with the '{PIPELINE_CONFIG['schedule']}' schedule...")
+        logits, stats = run_pipeline(model, batch, node_config)
+        log(f"Pipeline: {stats.num_micro_batches} micro-batches, wall {stats.wall_time:.3f}s, "
+            f"busy {stats.busy_time:.3f}s, bubble {stats.bubble_fraction:.1%} "
+            f"(cluster {stats.cluster_bubble_fraction:.1%})")
 
-            # Rank 1 processes the hidden states to get final logits
-            log("Rank 1: Executing forward pass...")
-            logits = forward_sequence(model, hidden_states, node_config)
-            log(f"Rank 1: Output logits shape: {logits.shape}")
-            
-            # Decode the result
-            next_token = torch.argmax(logits[0, -1])
-            next_word = tokenizer.decode(next_token)
-            log(f"Input: '{text}'")
-            log(f"Next word prediction: '{next_word}'")
-    
     except Exception as e:
         log(f"Error: {str(e)}")
         import traceback
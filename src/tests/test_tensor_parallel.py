@@ -0,0 +1,71 @@
+"""
+Unit tests for splitting decoder layers between tensor parallel ranks.
+
+    python -m pytest src/tests/test_tensor_parallel.py
+"""
+import copy
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from src.common.config import MODEL_REGISTRY
+from src.common.tensor_parallel import shard_plan, slice_parameter
+
+ARCH_CONFIG = MODEL_REGISTRY["gpt2"]
+
+def _tiny_gpt2() -> GPT2LMHeadModel:
+    torch.manual_seed(0)
+    config = GPT2Config(n_layer=2, n_embd=32, n_head=4, n_positions=16, vocab_size=64)
+    return GPT2LMHeadModel(config).eval()
+
+def test_shard_plan_covers_every_layer():
+    plan = shard_plan(_tiny_gpt2(), ARCH_CONFIG)
+    for index in range(2):
+        prefix = f"transformer.h.{index}"
+        assert plan[f"{prefix}.attn.c_attn.weight"] == ("column", 3, False)
+        assert plan[f"{prefix}.mlp.c_fc.bias"] == ("column", 1, False)
+        assert plan[f"{prefix}.attn.c_proj.weight"] == ("row", 1, False)
+        assert plan[f"{prefix}.mlp.c_proj.bias"] == ("row", 1, False)
+    assert "transformer.wte.weight" not in plan
+
+def test_fused_columns_split_per_block():
+    model = _tiny_gpt2()
+    plan = shard_plan(model, ARCH_CONFIG)
+    name = "transformer.h.0.attn.c_attn.weight"
+    full = model.state_dict()[name]  # Conv1D: [in, 3 * out]
+    slices = [slice_parameter(name, full, plan, rank, 2) for rank in range(2)]
+    assert all(piece.shape == (32, 48) for piece in slices)
+    # Each rank holds its half of q, of k and of v.
+    for block in range(3):
+        rebuilt = torch.cat([piece[:, block * 16:(block + 1) * 16] for piece in slices], dim=1)
+        assert torch.equal(rebuilt, full[:, block * 32:(block + 1) * 32])
+
+def test_row_bias_counted_once():
+    model = _tiny_gpt2()
+    plan = shard_plan(model, ARCH_CONFIG)
+    name = "transformer.h.0.mlp.c_proj.bias"
+    full = model.state_dict()[name]
+    assert torch.equal(slice_parameter(name, full, plan, 0, 2), full)
+    assert not slice_parameter(name, full, plan, 1, 2).any()
+
+def test_unplanned_parameters_are_kept_whole():
+    model = _tiny_gpt2()
+    plan = shard_plan(model, ARCH_CONFIG)
+    full = model.state_dict()["transformer.wte.weight"]
+    assert slice_parameter("transformer.wte.weight", full, plan, 1, 2) is full
+
+def test_split_mlp_sums_to_the_full_mlp():
+    model = _tiny_gpt2()
+    plan = shard_plan(model, ARCH_CONFIG)
+    full_mlp = model.transformer.h[0].mlp
+    hidden = torch.randn(2, 5, 32)
+    partial_sum = torch.zeros(2, 5, 32)
+    for rank in range(2):
+        mlp = copy.deepcopy(full_mlp)
+        for param_name, param in mlp.named_parameters():
+            name = f"transformer.h.0.mlp.{param_name}"
+            param.data = slice_parameter(name, param.data, plan, rank, 2)
+        mlp.c_fc.nf = mlp.c_fc.weight.size(1)
+        with torch.no_grad():
+            partial_sum += mlp(hidden)
+    with torch.no_grad():
+        torch.testing.assert_close(partial_sum, full_mlp(hidden))